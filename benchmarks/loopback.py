@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+
+"""In-process stand-in of an MQTT broker, to benchmark the messaging path of services without a real broker"""
+
+__author__ = 'leferrad'
+
+from tateti.util.mqtt import MQTTClient, MessageQueue
+
+import threading
+
+
+class LoopbackMessage(object):
+    # Same attributes used by services from the messages of paho-mqtt
+    __slots__ = ('topic', 'payload')
+
+    def __init__(self, topic, payload):
+        self.topic = topic
+        self.payload = payload
+
+
+def topic_matches(pattern, topic):
+    # Support of the single-level wildcard '+', which is the one used by services
+    pattern_levels, topic_levels = pattern.split("/"), topic.split("/")
+    if len(pattern_levels) != len(topic_levels):
+        return False
+    return all(p == "+" or p == t for (p, t) in zip(pattern_levels, topic_levels))
+
+
+class LoopbackBroker(object):
+    """Route every message published to the inbound queues of the clients subscribed to its topic"""
+    def __init__(self):
+        self.subscriptions = []
+        self.lock = threading.Lock()
+        self.n_published = 0
+
+    def subscribe(self, client, pattern):
+        with self.lock:
+            self.subscriptions.append((pattern, client))
+
+    def publish(self, topic, payload):
+        with self.lock:
+            clients = [c for (p, c) in self.subscriptions if topic_matches(p, topic)]
+            self.n_published += 1
+
+        # Payloads are copied to bytes, as they would be received from the network
+        msg = LoopbackMessage(topic, bytes(payload))
+        for client in clients:
+            client.msgs_queue.put(msg)
+
+
+class LoopbackClient(object):
+    """Client with the same interface as MQTTClient, connected to a LoopbackBroker"""
+    def __init__(self, broker, max_buffer=4, overflow_policy=MessageQueue.DROP_OLDEST):
+        self.broker = broker
+        self.msgs_queue = MessageQueue(max_size=max_buffer, policy=overflow_policy)
+        self.connected = False
+
+    def connect(self):
+        self.connected = True
+        return self.connected
+
+    def disconnect(self):
+        self.connected = False
+
+    def publish(self, topic, payload):
+        if self.connected:
+            self.broker.publish(topic, payload)
+
+    def subscribe(self, list_topics=None):
+        for topic in list_topics or []:
+            self.broker.subscribe(self, str(topic))
+
+    def get_message(self):
+        return self.msgs_queue.get()
+
+    def wait_message(self, timeout=None):
+        return self.msgs_queue.get(block=True, timeout=timeout)
+
+    # Collecting a batch only relies on the methods above
+    wait_messages = MQTTClient.wait_messages
+
+    def get_stats(self):
+        return self.msgs_queue.stats()
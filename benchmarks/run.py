@@ -0,0 +1,503 @@
+# -*- coding: utf-8 -*-
+
+"""Benchmarks of training and inference of agents, with results in a machine-readable format to compare runs"""
+
+__author__ = 'leferrad'
+
+from tateti.agent.base import BaseAgent, play_batch, play_one
+from tateti.agent.dqn import DQNAgent
+from tateti.agent.inference import NumpyQNetwork
+from tateti.agent.perfect import PerfectAgent
+from tateti.agent.strategy import masked_argmax
+from tateti.environment.tictactoe import Environment
+from tateti.environment.vector import VectorEnvironment
+from tateti.util.codec import available_codecs, decode_message, encode_message
+from tateti.util.fileio import get_logger
+from tateti.util.mqtt import MQTTClient
+from tateti.util.rng import make_rng
+
+from benchmarks.loopback import LoopbackBroker, LoopbackClient
+
+import numpy as np
+
+from collections import OrderedDict
+import argparse
+import csv
+import datetime
+import importlib.util
+import json
+import logging
+import platform
+import sys
+import threading
+import time
+
+
+logger = get_logger(name="benchmark", level="info")
+
+
+class RandomAgent(BaseAgent):
+    """Agent that takes random legal actions, as a cheap opponent and a baseline of the environment cost"""
+    def __init__(self, env, seed=123):
+        BaseAgent.__init__(self, env=env, seed=seed)
+        self.rng = make_rng(seed)
+
+    def act(self, state, env_string, explore=True, action_mask=None):
+        if action_mask is None:
+            action_mask = Environment.get_action_mask_from_str(env_string)
+        legal_actions = np.flatnonzero(action_mask)
+        return self.available_actions[legal_actions[self.rng.integers(len(legal_actions))]]
+
+    def act_batch(self, states, action_masks, explore=True):
+        return masked_argmax(self.rng.random(action_masks.shape), action_masks)
+
+    def punish_lost(self):
+        pass
+
+
+def has_keras():
+    # Training benchmarks need Keras, while the inference ones can run on NumPy only
+    return importlib.util.find_spec("keras") is not None
+
+
+def default_numpy_network(seed=123, n_hidden=24):
+    # Random weights with the architecture of DQNAgent._build_default_model, to benchmark inference without Keras
+    rng = make_rng(seed)
+    sizes = [Environment.n_dimensions, n_hidden, n_hidden, n_hidden, Environment.n_actions]
+    weights = [rng.normal(scale=0.5, size=(n_in, n_out)) for (n_in, n_out) in zip(sizes[:-1], sizes[1:])]
+    biases = [np.zeros(n_out) for n_out in sizes[1:]]
+    return NumpyQNetwork(weights, biases, activations=["relu"] * (len(weights) - 1) + ["linear"])
+
+
+def random_boards(n, seed=123, board_length=Environment.BOARD_LENGTH, win_length=None):
+    # Boards reached by random play, so they are valid positions of the game
+    env = Environment(seed=seed, board_length=board_length, win_length=win_length)
+    agent = RandomAgent(env, seed=seed)
+    boards = []
+    while len(boards) < n:
+        if env.game_over():
+            env.reset()
+        boards.append(env.get_state())
+        env.take_action(env.turn, agent.act(None, env.get_env_string()))
+    return np.asarray(boards)
+
+
+def latency_stats(latencies):
+    # Percentiles of latencies given in seconds, reported in microseconds
+    latencies = np.asarray(latencies) * 1e6
+    return OrderedDict([("mean_us", float(np.mean(latencies))),
+                        ("p50_us", float(np.percentile(latencies, 50))),
+                        ("p90_us", float(np.percentile(latencies, 90))),
+                        ("p99_us", float(np.percentile(latencies, 99))),
+                        ("max_us", float(np.max(latencies)))])
+
+
+def result(benchmark, params, metrics):
+    return OrderedDict([("benchmark", benchmark), ("params", params), ("metrics", metrics)])
+
+
+def skipped(benchmark, params, reason):
+    logger.warning("Benchmark '%s' skipped: %s", benchmark, reason)
+    return OrderedDict([("benchmark", benchmark), ("params", params), ("metrics", {}), ("skipped", reason)])
+
+
+# --- Benchmarks ---
+
+# Sizes of board (length, win length) to benchmark the environments on, from the classic game to gomoku
+BOARD_SIZES = ((3, 3), (7, 4), (15, 5))
+
+
+def bench_environment(n_games, seed, board_length=Environment.BOARD_LENGTH, win_length=None):
+    """Throughput of Environment.take_action on random games, and of full win checks on random positions"""
+    env = Environment(seed=seed, board_length=board_length, win_length=win_length)
+    agent = RandomAgent(env, seed=seed)
+    n_steps = 0
+
+    start = time.perf_counter()
+    for _ in range(n_games):
+        env.reset()
+        while not env.game_over():
+            env.take_action(env.turn, agent.act(None, env.get_env_string()))
+            n_steps += 1
+    elapsed = time.perf_counter() - start
+
+    # Setting a position scans all its winning lines from scratch, as game_over just reads what moves track
+    boards = [np.reshape(board, (board_length, board_length))
+              for board in random_boards(1000, seed=seed, board_length=board_length, win_length=win_length)]
+    env_check = Environment(seed=seed, board_length=board_length, win_length=win_length)
+
+    start_check = time.perf_counter()
+    for board in boards:
+        env_check.board = board
+        env_check.game_over()
+    elapsed_check = time.perf_counter() - start_check
+    n_checks = len(boards)
+
+    return [result("environment", {"n_games": n_games, "board_length": env.board_length, "win_length": env.win_length},
+                   OrderedDict([("steps_per_sec", n_steps / elapsed),
+                                ("games_per_sec", n_games / elapsed),
+                                ("win_checks_per_sec", n_checks / elapsed_check)]))]
+
+
+def bench_vector_environment(n_envs, n_steps, seed, board_length=Environment.BOARD_LENGTH, win_length=None):
+    """Throughput of VectorEnvironment.take_action with random legal actions"""
+    venv = VectorEnvironment(n_envs=n_envs, seed=seed, board_length=board_length, win_length=win_length)
+    rng = make_rng(seed)
+
+    start = time.perf_counter()
+    for _ in range(n_steps):
+        venv.take_action(masked_argmax(rng.random((n_envs, venv.n_actions)), venv.get_action_masks()))
+    elapsed = time.perf_counter() - start
+
+    return [result("vector_environment", {"n_envs": n_envs, "n_steps": n_steps, "board_length": venv.board_length,
+                                          "win_length": venv.win_length},
+                   {"steps_per_sec": n_envs * n_steps / elapsed})]
+
+
+def make_pairing(pairing, env, seed):
+    if pairing == "random":
+        return RandomAgent(env, seed=seed), RandomAgent(env, seed=seed + 1)
+    if pairing == "perfect_random":
+        return PerfectAgent(env, sym=Environment.SYMBOL_X, seed=seed), RandomAgent(env, seed=seed + 1)
+    if pairing == "dqn_random":
+        return DQNAgent(env, phi_function="scaled", seed=seed), RandomAgent(env, seed=seed + 1)
+    if pairing == "selfplay":
+        # A single agent playing both sides, learning from all the moves
+        agent = DQNAgent(env, phi_function="scaled", seed=seed)
+        return agent, agent
+    raise ValueError("Pairing '%s' not supported" % pairing)
+
+
+PAIRINGS = ("random", "perfect_random", "dqn_random", "selfplay")
+KERAS_PAIRINGS = ("dqn_random", "selfplay")
+
+
+def bench_play_one(pairings, n_games, n_games_dqn, seed):
+    """Games per second of play_one (including the learning of agents) for several pairings"""
+    results = []
+    for pairing in pairings:
+        n = n_games_dqn if pairing in KERAS_PAIRINGS else n_games
+        params = {"pairing": pairing, "n_games": n}
+        if pairing in KERAS_PAIRINGS and not has_keras():
+            results.append(skipped("play_one", params, "keras not installed"))
+            continue
+
+        env = Environment(seed=seed)
+        agent_x, agent_o = make_pairing(pairing, env, seed)
+        n_steps = 0
+
+        start = time.perf_counter()
+        for _ in range(n):
+            steps = play_one(agent_x, agent_o, env)[1]
+            env.reset()
+            n_steps += steps
+        elapsed = time.perf_counter() - start
+
+        results.append(result("play_one", params, OrderedDict([("games_per_sec", n / elapsed),
+                                                               ("steps_per_sec", n_steps / elapsed)])))
+    return results
+
+
+def bench_play_batch(pairings, n_envs, n_steps, seed):
+    """Games per second of play_batch on a VectorEnvironment, where agents act on all the boards at once"""
+    results = []
+    for pairing in pairings:
+        params = {"pairing": pairing, "n_envs": n_envs, "n_steps": n_steps}
+        if pairing in KERAS_PAIRINGS and not has_keras():
+            results.append(skipped("play_batch", params, "keras not installed"))
+            continue
+
+        venv = VectorEnvironment(n_envs=n_envs, seed=seed)
+        agent_x, agent_o = make_pairing(pairing, Environment(seed=seed), seed)
+
+        start = time.perf_counter()
+        _, n_games = play_batch(agent_x, agent_o, venv, n_steps=n_steps)
+        elapsed = time.perf_counter() - start
+
+        results.append(result("play_batch", params, OrderedDict([("games_per_sec", n_games / elapsed),
+                                                                 ("steps_per_sec", n_envs * n_steps / elapsed)])))
+    return results
+
+
+def bench_replay(batch_sizes, memory_sizes, n_replays, seed, prioritized=False):
+    """Steps per second of DQNAgent.experience_replay, over a memory filled with random transitions"""
+    results = []
+    for memory_size in memory_sizes:
+        for batch_size in batch_sizes:
+            params = {"batch_size": batch_size, "memory_size": memory_size, "prioritized": prioritized,
+                      "n_replays": n_replays}
+            if not has_keras():
+                results.append(skipped("experience_replay", params, "keras not installed"))
+                continue
+
+            agent = DQNAgent(Environment(seed=seed), phi_function="scaled", memory_size=memory_size,
+                             batch_size=batch_size, prioritized=prioritized, seed=seed)
+            rng = make_rng(seed)
+            boards = random_boards(memory_size + 1, seed=seed)
+            for k in range(memory_size):
+                agent.memory.append(boards[k], rng.integers(Environment.n_actions), rng.random(),
+                                    boards[k + 1], rng.random() < 0.1)
+
+            agent.experience_replay()  # Warm-up, since the first call of a model may be much slower
+            start = time.perf_counter()
+            for _ in range(n_replays):
+                agent.experience_replay()
+            elapsed = time.perf_counter() - start
+
+            results.append(result("experience_replay", params,
+                                  OrderedDict([("replays_per_sec", n_replays / elapsed),
+                                               ("transitions_per_sec", n_replays * batch_size / elapsed)])))
+    return results
+
+
+def bench_predict(n_calls, batch_sizes, seed):
+    """Latency percentiles of single-board predictions (plain and through the Q-value cache) and batched ones"""
+    boards = random_boards(n_calls, seed=seed)
+    models = OrderedDict([("numpy", default_numpy_network(seed=seed))])
+    if has_keras():
+        models["keras"] = DQNAgent._build_default_model(observation_space=Environment.n_dimensions,
+                                                         action_space=Environment.n_actions)
+    else:
+        logger.warning("Keras not installed, so predictions are benchmarked only on NumPy")
+
+    results = []
+    for name, model in models.items():
+        for cached in (False, True):
+            agent = DQNAgent(Environment(seed=seed), model=model, phi_function="scaled", cache_q_values=cached,
+                             seed=seed)
+            agent.get_q_values(boards[0])  # Warm-up
+
+            latencies = np.empty(n_calls)
+            for k, board in enumerate(boards):
+                start = time.perf_counter()
+                agent.get_q_values(board)
+                latencies[k] = time.perf_counter() - start
+
+            metrics = latency_stats(latencies)
+            if cached:
+                metrics["cache_hit_rate"] = agent.q_cache.hits / float(agent.q_cache.hits + agent.q_cache.misses)
+            results.append(result("predict", {"model": name, "cached": cached, "batch_size": 1,
+                                              "n_calls": n_calls}, metrics))
+
+        for batch_size in batch_sizes:
+            agent = DQNAgent(Environment(seed=seed), model=model, phi_function="scaled", seed=seed)
+            batch = boards[:batch_size]
+            n_batches = max(1, n_calls // batch_size)
+
+            latencies = np.empty(n_batches)
+            for k in range(n_batches):
+                start = time.perf_counter()
+                agent.predict(agent.phi(batch))
+                latencies[k] = time.perf_counter() - start
+
+            metrics = latency_stats(latencies)
+            metrics["boards_per_sec"] = batch_size / float(np.mean(latencies))
+            results.append(result("predict", {"model": name, "cached": False, "batch_size": batch_size,
+                                              "n_calls": n_batches}, metrics))
+    return results
+
+
+def env_message(env):
+    # Same message the environment service publishes after each move
+    return {"state": env.get_state(), "reward": 0.0, "is_over": int(env.game_over()),
+            "turn": Environment.sym_repr[env.turn], "env_str": env.get_env_string()}
+
+
+def agent_service_loop(client, agent, sym, in_topic, out_topic, codec, stop_event):
+    # Minimal version of the loop of the DQN agent service
+    client.subscribe([in_topic])
+    while not stop_event.is_set():
+        msg_in = client.wait_message(timeout=0.1)
+        if msg_in is None:
+            continue
+
+        msg_in = decode_message(msg_in.payload)
+        if msg_in["turn"] != sym or msg_in["is_over"]:
+            continue
+
+        action = agent.act(msg_in["state"], msg_in["env_str"], explore=False)
+        client.publish(out_topic, encode_message({"action": action, "env_str": msg_in["env_str"], "sym": sym},
+                                                 codec))
+
+
+def bench_mqtt_round_trip(codecs, n_moves, seed, host=None, port=1883):
+    """
+    Latency of a move through MQTT: from the environment publishing its status to receiving the action
+    from the agent, that runs on its own thread. A real broker is used if 'host' is given, otherwise
+    messages go through an in-process LoopbackBroker.
+    """
+    topics = {Environment.SYMBOL_X: "/bench/p1", Environment.SYMBOL_O: "/bench/p2"}
+    env_topic = "/bench/env"
+
+    results = []
+    for codec in codecs:
+        broker = LoopbackBroker() if host is None else None
+
+        def make_client():
+            client = LoopbackClient(broker) if host is None else MQTTClient(host=host, port=port)
+            client.connect()
+            return client
+
+        stop_event = threading.Event()
+        threads = []
+        for sym, out_topic in topics.items():
+            agent = DQNAgent(Environment(seed=seed), model=default_numpy_network(seed=seed), phi_function="scaled",
+                             cache_q_values=True, seed=seed)
+            thread = threading.Thread(target=agent_service_loop,
+                                      args=(make_client(), agent, Environment.sym_repr[sym], env_topic,
+                                            out_topic, codec, stop_event), daemon=True)
+            thread.start()
+            threads.append(thread)
+
+        env_client = make_client()
+        env_client.subscribe(list(topics.values()))
+        time.sleep(0.2)  # Let agents subscribe
+
+        env = Environment(seed=seed)
+        message = env_message(env)
+        latencies, n_timeouts = [], 0
+
+        for _ in range(n_moves):
+            start = time.perf_counter()
+            env_client.publish(env_topic, encode_message(message, codec))
+            reply = env_client.wait_message(timeout=1.0)
+            if reply is None:
+                n_timeouts += 1
+                continue
+            latencies.append(time.perf_counter() - start)
+
+            reply = decode_message(reply.payload)
+            env.take_action(env.turn, tuple(reply["action"]))
+            if env.game_over():
+                env.reset()
+            message = env_message(env)
+
+        stop_event.set()
+        for thread in threads:
+            thread.join()
+
+        params = {"codec": codec, "n_moves": n_moves, "broker": "loopback" if host is None else host}
+        if not latencies:
+            results.append(skipped("mqtt_round_trip", params, "no replies received from agents"))
+            continue
+
+        metrics = latency_stats(latencies)
+        metrics["moves_per_sec"] = len(latencies) / float(np.sum(latencies))
+        metrics["timeouts"] = n_timeouts
+        results.append(result("mqtt_round_trip", params, metrics))
+    return results
+
+
+available_benchmarks = ("environment", "vector_environment", "play_one", "play_batch", "replay", "predict", "mqtt")
+
+
+def run_benchmarks(args):
+    # Sizes of quick runs are just to check that everything works, not to get stable numbers
+    scale = 0.1 if args.quick else 1.0
+
+    def n(x):
+        return max(1, int(x * scale))
+
+    results = []
+    for name in args.benchmarks:
+        logger.info("Running benchmark '%s'...", name)
+        if name == "environment":
+            for (board_length, win_length) in BOARD_SIZES:
+                # Games are longer on larger boards, so there are less of them to keep a similar number of moves
+                results += bench_environment(n_games=n(5000 * 9 // board_length ** 2), seed=args.seed,
+                                             board_length=board_length, win_length=win_length)
+        elif name == "vector_environment":
+            for (board_length, win_length) in BOARD_SIZES:
+                for n_envs in (1, 64, 1024):
+                    results += bench_vector_environment(n_envs=n_envs, n_steps=n(1000), seed=args.seed,
+                                                        board_length=board_length, win_length=win_length)
+        elif name == "play_one":
+            results += bench_play_one(PAIRINGS, n_games=n(2000), n_games_dqn=n(100), seed=args.seed)
+        elif name == "play_batch":
+            results += bench_play_batch(("random", "dqn_random", "selfplay"), n_envs=256, n_steps=n(100),
+                                        seed=args.seed)
+        elif name == "replay":
+            for prioritized in (False, True):
+                results += bench_replay(batch_sizes=(10, 32, 128), memory_sizes=(400, 10000), n_replays=n(200),
+                                        seed=args.seed, prioritized=prioritized)
+        elif name == "predict":
+            results += bench_predict(n_calls=n(5000), batch_sizes=(32, 256), seed=args.seed)
+        elif name == "mqtt":
+            results += bench_mqtt_round_trip(list(available_codecs.keys()), n_moves=n(2000), seed=args.seed,
+                                             host=args.mqtt_host, port=args.mqtt_port)
+
+    return results
+
+
+def write_json(results, meta, f):
+    json.dump(OrderedDict([("meta", meta), ("results", results)]), f, indent=2)
+    f.write("\n")
+
+
+def write_csv(results, meta, f):
+    # One row per result, with params flattened as 'key=value' pairs and a column per metric
+    metric_names = []
+    for r in results:
+        metric_names += [m for m in r["metrics"] if m not in metric_names]
+
+    writer = csv.DictWriter(f, fieldnames=["timestamp", "benchmark", "params", "skipped"] + metric_names)
+    writer.writeheader()
+    for r in results:
+        row = {"timestamp": meta["timestamp"], "benchmark": r["benchmark"],
+               "params": ";".join("%s=%s" % (k, v) for (k, v) in sorted(r["params"].items())),
+               "skipped": r.get("skipped", "")}
+        row.update(r["metrics"])
+        writer.writerow(row)
+
+
+available_formats = {"json": write_json, "csv": write_csv}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmarks of training and inference of Tic-Tac-Toe agents")
+    parser.add_argument('-b', '--benchmarks', type=str, dest='benchmarks', nargs='+',
+                        default=list(available_benchmarks), choices=available_benchmarks,
+                        help='Benchmarks to run (all of them by default)')
+    parser.add_argument('-o', '--output', type=str, dest='output', default=None,
+                        help='File to write results on (stdout by default)')
+    parser.add_argument('-f', '--format', type=str, dest='format', default=None,
+                        choices=list(available_formats.keys()),
+                        help='Format of results (by default, given by the extension of --output, or JSON)')
+    parser.add_argument('-s', '--seed', type=int, dest='seed', default=123,
+                        help='Seed for every random generator, so runs are comparable')
+    parser.add_argument('-q', '--quick', dest='quick', action='store_true',
+                        help='Run with small sizes, just to check that benchmarks work')
+    parser.add_argument('-mh', '--mqtt-host', type=str, dest='mqtt_host', default=None,
+                        help='Host of a MQTT broker for the round-trip benchmark (an in-process stand-in by default)')
+    parser.add_argument('-mp', '--mqtt-port', type=int, dest='mqtt_port', default=1883,
+                        help='Port of the MQTT broker given by --mqtt-host')
+    parser.add_argument('-v', '--verbose', dest='verbose', action='store_true',
+                        help='Keep the logs of the library (e.g. every game over), which slow down benchmarks')
+
+    args = parser.parse_args()
+
+    if not args.verbose:
+        for name in list(logging.root.manager.loggerDict):
+            if name.startswith("tateti"):
+                logging.getLogger(name).setLevel(logging.WARNING)
+
+    fmt = args.format
+    if fmt is None:
+        fmt = "csv" if args.output is not None and args.output.endswith(".csv") else "json"
+
+    meta = OrderedDict([("timestamp", datetime.datetime.now().isoformat()),
+                        ("python", platform.python_version()),
+                        ("numpy", np.__version__),
+                        ("platform", platform.platform()),
+                        ("keras", has_keras()),
+                        ("seed", args.seed),
+                        ("quick", args.quick)])
+
+    results = run_benchmarks(args)
+
+    if args.output is None:
+        available_formats[fmt](results, meta, sys.stdout)
+    else:
+        with open(args.output, "w", newline="") as f:
+            available_formats[fmt](results, meta, f)
+        logger.info("Results written on '%s'", args.output)
@@ -5,92 +5,282 @@
 __author__ = 'leferrad'
 
 from tateti.agent.dqn import DQNAgent
+from tateti.agent.inference import NumpyQNetwork
+from tateti.agent.learner import BackgroundLearner
+from tateti.agent.reload import ModelReloader
 from tateti.environment.tictactoe import Environment
-from tateti.util.fileio import get_logger
-from tateti.util.mqtt import MQTTClient
+from tateti.util.checkpoint import CHECKPOINT_EXTENSION
+from tateti.util.codec import available_codecs, decode_message, detect_codec, encode_message
+from tateti.util import metrics
+from tateti.util.fileio import add_logging_arguments, configure_logging_from_args, get_logger
+from tateti.util.mqtt import MQTTClient, MessageQueue
 
+import numpy as np
+
+from collections import OrderedDict
 import argparse
-import json
 import os
 import time
 
 logger = get_logger(name="main", level="debug")
 
+MESSAGES = metrics.counter("tateti_service_messages_total", "Messages received by the service loop")
+MESSAGE_SECONDS = metrics.histogram("tateti_service_message_seconds", "Time to process a message, from decoding it "
+                                                                      "to publishing the reply")
+BATCH_SECONDS = metrics.histogram("tateti_service_batch_seconds", "Time to serve a batch of move requests")
+
+
+def send_action(mqtt, out_topic, msg_in, action, sym, codec):
+    # Include 'env_str' as a way to synchronize this message with the last one sent by the environment
+    player_message = {"action": action, "env_str": msg_in["env_str"], "sym": sym}
+
+    # Messages of games hosted in multi-game mode are answered on the subtopic of the game
+    game_topic = out_topic
+    if "game_id" in msg_in:
+        player_message["game_id"] = msg_in["game_id"]
+        game_topic = out_topic + "/" + str(msg_in["game_id"])
+
+    logger.debug("Sending action to take through this message: %s", player_message)
+
+    mqtt.publish(game_topic, payload=encode_message(player_message, codec))
+
+
+def run_batched(mqtt, agent, sym, out_topic, max_batch, window, learning, codec, reloader=None, reload_topic=None):
+    """
+    Serve the move requests received within a time window (or up to 'max_batch' of them) all at once,
+    through a single forward pass of the agent's model
+    """
+    sym_empty = Environment.sym_repr[Environment.SYMBOL_EMPTY]
+
+    while True:
+        msgs = mqtt.wait_messages(max_messages=max_batch, window=window, timeout=1.0)
+        MESSAGES.inc(len(msgs))
+
+        if reloader is not None:
+            # Between batches, so all the requests of a batch are served by the same model
+            reloader.apply_pending()
+
+        # Keep just the last request per game, since the environment re-publishes its status as a ping
+        requests = OrderedDict()
+        for msg_in in msgs:
+            if reload_topic is not None and msg_in.topic == reload_topic:
+                reloader.request_reload()
+                continue
+
+            msg_codec = detect_codec(msg_in.payload) if codec == "auto" else codec
+            msg_in = decode_message(msg_in.payload)  # Payload is in bytes format, as JSON or binary
+
+            if not sym == msg_in["turn"] or sym_empty not in msg_in["env_str"]:
+                # Not the turn of this player, or no actions available
+                continue
+
+            requests[msg_in.get("game_id")] = (msg_in, msg_codec)
+
+        if not requests:
+            continue
+
+        logger.debug("Serving a batch of %i move requests", len(requests))
+
+        with BATCH_SECONDS.time():
+            # Get the actions to take for all the boards at once, by exploiting agent experience
+            states = np.asarray([msg_in["state"] for (msg_in, _) in requests.values()])
+            action_masks = np.asarray([Environment.get_action_mask_from_str(msg_in["env_str"])
+                                       for (msg_in, _) in requests.values()])
+            actions = agent.act_batch(states, action_masks, explore=False)
+
+            if learning and len(agent.memory) >= agent.batch_size:
+                # Just to still learning from previous matches, apply experience learning (once per batch)
+                agent.experience_replay()
+
+            for (msg_in, msg_codec), a in zip(requests.values(), actions):
+                send_action(mqtt, out_topic, msg_in, agent.available_actions[a], sym, msg_codec)
+
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description="Agent service to play Tic-Tac-Toe game performing MQTT communication")
-    parser.add_argument('-mb', '--max-buffer', type=int, dest='mqtt_max_buffer', default=4,
-                        help='Max of messages to retain on the MQTT queue')
+    parser.add_argument('-mb', '--max-buffer', type=int, dest='mqtt_max_buffer', default=None,
+                        help='Max of messages to retain on the MQTT queue (default: 4, or --max-batch in multi-game '
+                             'or batched mode, so moves of some games are not dropped because of others)')
+    parser.add_argument('-op', '--overflow-policy', type=str, dest='mqtt_overflow_policy', default="drop_oldest",
+                        choices=MessageQueue.policies, help='What to do when the MQTT queue is full')
     parser.add_argument('-fn', '--filename', type=str, dest='filename', default="/models/tateti_model.pkl",
-                        help='Filename of agent model to be loaded')
+                        help="Filename of agent model to be loaded (a pickle, or a checkpoint if its extension is "
+                             "'%s')" % CHECKPOINT_EXTENSION)
+    parser.add_argument('-nm', '--numpy-model', type=str, dest='numpy_model', default=None,
+                        help='Filename of a NumpyQNetwork exported from an agent, to serve it without Keras '
+                             '(and without learning). If given, --filename is ignored')
+    parser.add_argument('-phi', '--phi-function', type=str, dest='phi_function', default="scaled",
+                        help='Phi function used by the agent exported through --numpy-model')
+    parser.add_argument('-bl', '--board-length', type=int, dest='board_length', default=Environment.BOARD_LENGTH,
+                        help='Number of rows and columns of the board, for agents loaded from a checkpoint or '
+                             'through --numpy-model')
+    parser.add_argument('-cs', '--cache-size', type=int, dest='cache_size', default=8192,
+                        help='Max of boards with Q-values cached (0 to disable the cache). Only used on boards of '
+                             'the default size')
+    parser.add_argument('-csy', '--cache-symmetric', dest='cache_symmetric', action='store_true',
+                        help='Cache Q-values per canonical board, sharing them among symmetric boards. Only allowed '
+                             'for models trained with augmentation of symmetries')
+    parser.add_argument('-ed', '--event-driven', dest='event_driven', action='store_true',
+                        help='React to messages as soon as they arrive, instead of polling with a fixed sleep')
+    parser.add_argument('-cd', '--codec', type=str, dest='codec', default="auto",
+                        choices=["auto"] + list(available_codecs.keys()),
+                        help="Format of messages sent ('auto' to answer with the same format of the environment)")
+    parser.add_argument('-mg', '--multi-game', dest='multi_game', action='store_true',
+                        help='Play on all the games hosted by an environment in multi-game mode')
+    parser.add_argument('-al', '--async-learning', dest='async_learning', action='store_true',
+                        help='Keep learning on a background thread, so the actions are served with inference only')
+    parser.add_argument('-li', '--learn-interval', type=float, dest='learn_interval', default=0.05,
+                        help='Min seconds between replays of the background learner (--async-learning), to bound '
+                             'the CPU it takes from serving')
+    parser.add_argument('-bw', '--batch-window', type=float, dest='batch_window', default=0.0,
+                        help='Milliseconds to collect move requests to be served as a batch (0 to serve one by one)')
+    parser.add_argument('-xb', '--max-batch', type=int, dest='max_batch', default=256,
+                        help='Max of move requests to serve as a batch')
+    parser.add_argument('-w', '--watch', type=float, dest='watch_interval', default=0.0,
+                        help='Seconds between checks of changes on the model file, to reload it without restarting '
+                             '(0 to disable). Reloads can be also requested through MQTT_RELOAD_TOPIC')
+    metrics.add_arguments(parser)
+    add_logging_arguments(parser)
 
     args = parser.parse_args()
 
+    if args.mqtt_max_buffer is None:
+        args.mqtt_max_buffer = args.max_batch if args.multi_game or args.batch_window > 0 else 4
+    elif args.batch_window > 0 and args.mqtt_max_buffer < args.max_batch:
+        parser.error("--max-buffer can't be smaller than --max-batch, or requests of a batch would be dropped")
+
+    if args.multi_game and args.mqtt_overflow_policy == MessageQueue.KEEP_LATEST:
+        parser.error("--overflow-policy %s keeps a message per topic, which would mix games in multi-game mode "
+                     "(where a game may be identified by the 'game_id' of messages)" % MessageQueue.KEEP_LATEST)
+
+    configure_logging_from_args(args)
+
     MQTT_HOST_ADDRESS = os.environ["MQTT_HOST_ADDRESS"]
     MQTT_HOST_PORT = int(os.environ["MQTT_HOST_PORT"])
 
     # --- Start MQTT Client ---
-    mqtt = MQTTClient(host=MQTT_HOST_ADDRESS, port=MQTT_HOST_PORT, max_buffer=args.mqtt_max_buffer)
+    mqtt = MQTTClient(host=MQTT_HOST_ADDRESS, port=MQTT_HOST_PORT, max_buffer=args.mqtt_max_buffer,
+                      overflow_policy=args.mqtt_overflow_policy)
     mqtt.connect()
 
     # Subscribe
     env_topic = os.environ['MQTT_ENV_TOPIC']
     assert env_topic is not None
 
-    mqtt.subscribe([env_topic])
+    # In multi-game mode, each game is reported on its own subtopic '{env_topic}/{game_id}'
+    topics = [env_topic + "/+" if args.multi_game else env_topic]
+
+    # Optional topic to request a reload of the model (e.g. after a new one is deployed)
+    reload_topic = os.environ.get('MQTT_RELOAD_TOPIC') if args.watch_interval > 0 else None
+    if reload_topic is not None:
+        topics.append(reload_topic)
+
+    mqtt.subscribe(topics)
+
+    # Metrics can be also published as JSON on a MQTT topic
+    metrics.setup_from_args(args, mqtt=mqtt, topic=os.environ.get('MQTT_STATS_TOPIC'))
 
     # Create agent
     p = os.environ.get("PLAYER", '1')
     player = Environment.SYMBOL_X if int(p) == 1 else Environment.SYMBOL_O
     sym = Environment.sym_repr[player]
 
-    agent = DQNAgent.load(args.filename)
+    if args.numpy_model is not None:
+        # Inference-only agent, that doesn't need Keras at all
+        agent = DQNAgent(env=Environment(board_length=args.board_length), model=NumpyQNetwork.load(args.numpy_model),
+                         phi_function=args.phi_function)
+        learning = False
+        model_filename = args.numpy_model
+    elif args.filename.endswith(CHECKPOINT_EXTENSION):
+        agent = DQNAgent.load_checkpoint(args.filename, env=Environment(board_length=args.board_length),
+                                         load_memory=True)
+        learning = True
+        model_filename = args.filename
+    else:
+        agent = DQNAgent.load(args.filename)
+        learning = True
+        model_filename = args.filename
 
     if agent is None:
-        logger.error("Model couldn't be loaded from '%s'", args.filename)
+        logger.error("Model couldn't be loaded from '%s'", model_filename)
         exit(0)
 
+    if args.cache_size > 0 and agent.n_actions == Environment.n_actions:
+        # Reachable boards are just a few thousands, so most of the moves can be resolved from the cache
+        # (which is not the case on larger boards, where boards are rarely repeated)
+        try:
+            agent.enable_q_cache(max_size=args.cache_size, symmetric=args.cache_symmetric)
+        except ValueError as e:
+            logger.error("Q-values can't be cached: %s", str(e))
+            exit(1)
+
+    if learning and args.async_learning:
+        # Learning is taken out of the request path, which gets new weights through the learner
+        learner = BackgroundLearner(agent, interval=args.learn_interval)
+        learner.start()
+        learning = False
+
+    reloader = None
+    if args.watch_interval > 0:
+        # New models are loaded on a background thread, and swapped in between moves
+        reloader = ModelReloader(agent, model_filename, poll_interval=args.watch_interval,
+                                 inference_only=args.numpy_model is not None)
+        reloader.start()
+
     out_topic = os.environ['MQTT_P1_TOPIC'] if player == Environment.SYMBOL_X else os.environ["MQTT_P2_TOPIC"]
     
-    logger.info("Agent topic: %s" % str(out_topic))
-    logger.info("Agent symbol: %s" % sym)
+    logger.info("Agent topic: %s", out_topic)
+    logger.info("Agent symbol: %s", sym)
 
     # -------------------------
 
     logger.info("Start looping...")
 
+    if args.batch_window > 0:
+        run_batched(mqtt, agent, sym, out_topic, max_batch=args.max_batch, window=args.batch_window / 1000.0,
+                    learning=learning, codec=args.codec, reloader=reloader, reload_topic=reload_topic)
+
     while True:
         current_timestamp = time.time()
-        msg_in = mqtt.get_message()
+        msg_in = mqtt.wait_message(timeout=1.0) if args.event_driven else mqtt.get_message()
 
-        if msg_in is not None:
-            # New message to process
-            msg_in = json.loads(msg_in.payload.decode())  # Payload is in bytes format, so it must be decoded
+        if reloader is not None:
+            reloader.apply_pending()
 
-            logger.debug("A message has been received! Payload: %s", str(msg_in))
+        if msg_in is not None and reload_topic is not None and msg_in.topic == reload_topic:
+            logger.info("Reload of the model requested")
+            reloader.request_reload()
+            continue
 
-            if not sym == msg_in["turn"]:
-                # Not the turn of this player
-                logger.info("It is not my turn to play, ignoring this message...")
-                continue
+        if msg_in is not None:
+            MESSAGES.inc()
+            with MESSAGE_SECONDS.time():
+                # New message to process
+                msg_codec = detect_codec(msg_in.payload) if args.codec == "auto" else args.codec
+                msg_in = decode_message(msg_in.payload)  # Payload is in bytes format, as JSON or binary
 
-            state, env_str = msg_in["state"], msg_in["env_str"]
+                logger.debug("A message has been received! Payload: %s", msg_in)
 
-            if Environment.sym_repr[Environment.SYMBOL_EMPTY] not in env_str:
-                # No empty cells, no actions available
-                logger.info("Board is full, no action to take..")
-                continue
+                if not sym == msg_in["turn"]:
+                    # Not the turn of this player
+                    logger.debug("It is not my turn to play, ignoring this message...")
+                    continue
 
-            # Get the action to take, by exploiting (not exploring) agent experience
-            action = agent.act(state, env_str, explore=False)
+                state, env_str = msg_in["state"], msg_in["env_str"]
 
-            # Just to still learning from previous matches, apply experience learning
-            agent.experience_replay()
+                if Environment.sym_repr[Environment.SYMBOL_EMPTY] not in env_str:
+                    # No empty cells, no actions available
+                    logger.debug("Board is full, no action to take..")
+                    continue
 
-            # Include 'env_str' as a way to synchronize this message with the last one sent by the environment
-            player_message = {"action": action, "env_str": env_str, "sym": sym}
+                # Get the action to take, by exploiting (not exploring) agent experience
+                action = agent.act(state, env_str, explore=False)
 
-            logger.info("Sending action to take through this message: %s", str(player_message))
+                if learning and len(agent.memory) >= agent.batch_size:
+                    # Just to still learning from previous matches, apply experience learning
+                    agent.experience_replay()
 
-            mqtt.publish(out_topic, payload=json.dumps(player_message))
+                send_action(mqtt, out_topic, msg_in, action, sym, msg_codec)
 
-        time.sleep(0.5)
+        if not args.event_driven:
+            time.sleep(0.5)
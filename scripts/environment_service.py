@@ -4,20 +4,31 @@
 
 __author__ = 'leferrad'
 
+from tateti.environment.session import SessionManager
 from tateti.environment.tictactoe import Environment
-from tateti.util.fileio import get_logger
-from tateti.util.mqtt import MQTTClient
+from tateti.util.codec import available_codecs, decode_message, encode_message
+from tateti.util import metrics
+from tateti.util.fileio import RateLimiter, add_logging_arguments, configure_logging_from_args, get_logger
+from tateti.util.mqtt import MQTTClient, MessageQueue
 
 import argparse
-import json
 import os
 import time
 
 
 logger = get_logger(name="main", level="debug")
 
+MESSAGES = metrics.counter("tateti_service_messages_total", "Messages received by the service loop")
+MESSAGE_SECONDS = metrics.histogram("tateti_service_message_seconds", "Time to process a message, from decoding it "
+                                                                      "to publishing the reply")
+GAMES = metrics.gauge("tateti_service_games", "Games hosted in multi-game mode")
+DISCARDED = metrics.counter("tateti_service_discarded_total", "Messages discarded for being malformed or illegal")
 
-def get_first_message():
+# Min seconds between logs of discarded messages, so a misbehaving client can't flood the logs
+DISCARDED_LOG_INTERVAL = 10.0
+
+
+def get_first_message(env):
     return {"state": env.get_state(),
             "reward": 0.0,
             "is_over": int(env.game_over()),
@@ -25,20 +36,211 @@ def get_first_message():
             "env_str": env.get_env_string()}
 
 
+def parse_action(action):
+    # Action given as a pair of (row, column), e.g. a list on JSON messages
+    try:
+        i, j = action
+        return int(i), int(j)
+    except (TypeError, ValueError):
+        raise ValueError("Action %r is not a pair of row and column" % (action,))
+
+
+def apply_action(env, player, msg_in):
+    """
+    Apply on the environment the action requested by a player
+
+    :param env: Environment
+    :param player: symbol of the player that sent the message
+    :param msg_in: dict, message received from the player
+    :return: dict, message reporting the result of the action (or None if the message was ignored)
+    :raises ValueError: if the message is malformed, or its action is not legal
+    """
+    if player != env.turn:
+        logger.debug("It's not its turn to play, ignoring message...")
+        return None
+
+    for field in ("env_str", "action"):
+        if field not in msg_in:
+            raise ValueError("Message without '%s'" % field)
+
+    # Check if the input message belongs to the last output message sent
+    if msg_in["env_str"] != env.get_env_string():
+        # Then it is not synchronized with the current status, so it can be discarded
+        logger.debug("Message is not synchronized with current status of environment, so it will be ignored...")
+        return None
+
+    # Get the action to take from message
+    action = parse_action(msg_in["action"])
+    if not env.is_legal(action):
+        raise ValueError("Action %s is not legal on the current board" % (action,))
+
+    # Perform action and get information about the result
+    state, reward, is_over, turn = env.take_action(sym=player, action=action)
+
+    # Get the next turn for the game
+    turn = Environment.sym_repr[turn]  # TODO: decide: sym string or int?
+
+    # Report the status of environment on string representation
+    env_str = env.get_env_string()
+
+    return {"state": state, "reward": reward, "is_over": is_over, "turn": turn, "env_str": env_str}
+
+
+def discard_message(topic, error, limiter):
+    # A malformed or illegal message just loses its move, instead of stopping the games of every client
+    DISCARDED.inc()
+    if limiter.allow():
+        logger.warning("Message on topic '%s' discarded: %s (%i discarded messages not logged so far)",
+                       topic, str(error), limiter.n_skipped)
+
+
+def run_multi_game(mqtt, args, p1_topic, p2_topic, out_topic):
+    """
+    Host many games at once, each of them identified by a game ID given as the last level of the topics
+    (e.g. '/p1/{game_id}' for inputs and '/env/{game_id}' for outputs).
+    A game is created when a message for an unknown game ID is received, and evicted once idle.
+    """
+    sessions = SessionManager(max_sessions=args.max_games, idle_timeout=args.idle_timeout, seed=args.seed,
+                              board_length=args.board_length, win_length=args.win_length)
+    players = {p1_topic: Environment.SYMBOL_X, p2_topic: Environment.SYMBOL_O}
+    GAMES.set_function(sessions.__len__)
+
+    mqtt.subscribe([p1_topic + "/+", p2_topic + "/+"])
+    discarded_limiter = RateLimiter(interval=DISCARDED_LOG_INTERVAL)
+
+    def publish(session, message):
+        session.last_message = dict(message, game_id=session.game_id)
+        session.last_published = time.time()
+        mqtt.publish(out_topic + "/" + session.game_id, payload=encode_message(session.last_message, args.codec))
+
+    def start_game(session):
+        publish(session, get_first_message(session.env))
+
+    for i in range(args.n_games):
+        start_game(sessions.get(str(i))[0])
+
+    logger.info("Start looping over %i games...", len(sessions))
+
+    last_ping = time.time()
+
+    while True:
+        if args.event_driven:
+            msg_in = mqtt.wait_message(timeout=max(0.0, last_ping + args.ping_interval - time.time()))
+        else:
+            msg_in = mqtt.get_message()
+
+        if msg_in is not None:
+            MESSAGES.inc()
+            with MESSAGE_SECONDS.time():
+                topic = msg_in.topic
+                try:
+                    msg_in = decode_message(msg_in.payload)  # Payload is in bytes format, as JSON or binary
+                except ValueError as e:
+                    discard_message(topic, e, discarded_limiter)
+                    continue
+
+                logger.debug("A message has been received! Topic: '%s', Payload: %s", topic, msg_in)
+
+                # Recognize player and game from topic
+                prefix, _, game_id = topic.rpartition("/")
+                player = players.get(prefix)
+                if player is None:
+                    logger.info("Topic not supported, ignoring message...")
+                    continue
+
+                game_id = str(msg_in.get("game_id", game_id))
+                session, created = sessions.get(game_id)
+
+                if created:
+                    # A new game was requested, so just announce its beginning
+                    logger.info("Game '%s' created (%i games hosted)", game_id, len(sessions))
+                    start_game(session)
+                    continue
+
+                try:
+                    env_message = apply_action(session.env, player, msg_in)
+                except ValueError as e:
+                    discard_message(topic, e, discarded_limiter)
+                    continue
+
+                if env_message is None:
+                    continue
+
+                publish(session, env_message)
+
+                if session.env.game_over():
+                    logger.info("GAME OVER on game '%s'! Winner: %s", game_id, session.env.winner)
+                    session.env.reset()
+                    start_game(session)
+
+        current_timestamp = time.time()
+        if current_timestamp - last_ping >= args.ping_interval:
+            n_evicted = sessions.evict_idle(now=current_timestamp)
+            if n_evicted:
+                logger.info("%i idle games evicted (%i games hosted)", n_evicted, len(sessions))
+
+            # Report last state of games not updated lately, as a continuous ping
+            for session in sessions:
+                if current_timestamp - session.last_published >= args.ping_interval:
+                    publish(session, session.last_message)
+
+            last_ping = current_timestamp
+
+        if msg_in is None and not args.event_driven:
+            # Nothing to process, so wait a bit before polling again
+            time.sleep(0.05)
+
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description="Environment of Tic-Tac-Toe game performing MQTT communication")
-    parser.add_argument('-mb', '--max-buffer', type=int, dest='mqtt_max_buffer', default=4,
-                        help='Max of messages to retain on the MQTT queue')
+    parser.add_argument('-mb', '--max-buffer', type=int, dest='mqtt_max_buffer', default=None,
+                        help='Max of messages to retain on the MQTT queue (default: 4, or --max-games in multi-game '
+                             'mode, so moves of some games are not dropped because of others)')
+    parser.add_argument('-op', '--overflow-policy', type=str, dest='mqtt_overflow_policy', default="drop_oldest",
+                        choices=MessageQueue.policies, help='What to do when the MQTT queue is full')
     parser.add_argument('-s', '--seed', type=int, dest='seed', default=123,
                         help='Seed for random methods on Environment')
+    parser.add_argument('-bl', '--board-length', type=int, dest='board_length', default=Environment.BOARD_LENGTH,
+                        help='Number of rows and columns of the board')
+    parser.add_argument('-wl', '--win-length', type=int, dest='win_length', default=None,
+                        help='Number of symbols in a row to win (default: the board length)')
+    parser.add_argument('-ed', '--event-driven', dest='event_driven', action='store_true',
+                        help='React to messages as soon as they arrive, instead of polling with a fixed sleep')
+    parser.add_argument('-pi', '--ping-interval', type=float, dest='ping_interval', default=1.0,
+                        help='Seconds between re-publications of the environment status in event-driven mode')
+    parser.add_argument('-cd', '--codec', type=str, dest='codec', default="json",
+                        choices=list(available_codecs.keys()),
+                        help='Format of messages sent (messages received are decoded whatever their format is)')
+    parser.add_argument('-mg', '--multi-game', dest='multi_game', action='store_true',
+                        help='Host many games at once, identified by the last level of the MQTT topics')
+    parser.add_argument('-ng', '--n-games', type=int, dest='n_games', default=0,
+                        help='Number of games to create at startup in multi-game mode (IDs from 0 to n-1)')
+    parser.add_argument('-xg', '--max-games', type=int, dest='max_games', default=10000,
+                        help='Max of games hosted at once in multi-game mode')
+    parser.add_argument('-it', '--idle-timeout', type=float, dest='idle_timeout', default=300.0,
+                        help='Seconds without activity after which a game is evicted in multi-game mode')
+    metrics.add_arguments(parser)
+    add_logging_arguments(parser)
+    parser.add_argument('-bi', '--board-interval', type=float, dest='board_interval', default=None,
+                        help='Min seconds between dumps of the board on logs (default: 0, or 10 in production mode)')
 
     args = parser.parse_args()
 
+    if args.mqtt_max_buffer is None:
+        args.mqtt_max_buffer = args.max_games if args.multi_game else 4
+
+    if args.multi_game and args.mqtt_overflow_policy == MessageQueue.KEEP_LATEST:
+        parser.error("--overflow-policy %s keeps a message per topic, which would mix games in multi-game mode "
+                     "(where a game may be identified by the 'game_id' of messages)" % MessageQueue.KEEP_LATEST)
+
+    board_limiter = configure_logging_from_args(args)
+
     MQTT_HOST_ADDRESS = os.environ["MQTT_HOST_ADDRESS"]
     MQTT_HOST_PORT = int(os.environ["MQTT_HOST_PORT"])
 
     # --- Start MQTT Client ---
-    mqtt = MQTTClient(host=MQTT_HOST_ADDRESS, port=MQTT_HOST_PORT, max_buffer=args.mqtt_max_buffer)
+    mqtt = MQTTClient(host=MQTT_HOST_ADDRESS, port=MQTT_HOST_PORT, max_buffer=args.mqtt_max_buffer,
+                      overflow_policy=args.mqtt_overflow_policy)
     mqtt.connect()
 
     # Subscribe
@@ -47,97 +249,110 @@ if __name__ == '__main__':
     p2_topic = os.environ['MQTT_P2_TOPIC']
     assert p2_topic is not None
 
+    out_topic = os.environ['MQTT_ENV_TOPIC']
+
+    # Metrics can be also published as JSON on a MQTT topic
+    metrics.setup_from_args(args, mqtt=mqtt, topic=os.environ.get('MQTT_STATS_TOPIC'))
+
+    if args.multi_game:
+        run_multi_game(mqtt, args, p1_topic, p2_topic, out_topic)
+
     mqtt.subscribe([p1_topic, p2_topic])
 
     # Create environment, as well as the players
-    env = Environment(seed=args.seed)
+    env = Environment(seed=args.seed, board_length=args.board_length, win_length=args.win_length)
     player_1 = Environment.SYMBOL_X
     player_2 = Environment.SYMBOL_O
 
-    out_topic = os.environ['MQTT_ENV_TOPIC']
-
     # -------------------------
 
     # Send first message of beginning of game
-    env_message = get_first_message()
-    mqtt.publish(topic=out_topic, payload=json.dumps(env_message))
+    env_message = get_first_message(env)
+    mqtt.publish(topic=out_topic, payload=encode_message(env_message, args.codec))
 
     # -------------------------
 
     logger.info("Start looping...")
 
+    last_ping = time.time()
+    last_board_logged = None
+    discarded_limiter = RateLimiter(interval=DISCARDED_LOG_INTERVAL)
+
     while True:
-        current_timestamp = time.time()  # TODO: not used
-        msg_in = mqtt.get_message()
+        if args.event_driven:
+            # Wait for a message, but no longer than the time left for the next ping
+            msg_in = mqtt.wait_message(timeout=max(0.0, last_ping + args.ping_interval - time.time()))
+        else:
+            msg_in = mqtt.get_message()
 
         if msg_in is not None:
-            # New message to process
-            topic = msg_in.topic
-            msg_in = json.loads(msg_in.payload.decode())  # Payload is in bytes format, so it must be decoded
-
-            logger.debug("A message has been received! Topic: '%s', Payload: %s", str(topic), str(msg_in))
-
-            # Recognize player from topic
-            if topic == p1_topic:
-                player = player_1
-            elif topic == p2_topic:
-                player = player_2
-            else:
-                # Not recognized message should be ignored
-                logger.info("Topic not supported, ignoring message...")
-                continue
-
-            logger.info("Message belongs to player with symbol '%s'", Environment.sym_repr[player])
-
-            if player != env.turn:
-                logger.info("It's not its turn to play, ignoring message...")
-                continue
-
-            # Check if the input message belongs to the last output message sent
-            assert "env_str" in msg_in
-
-            if msg_in["env_str"] != env.get_env_string():
-                # Then it is not synchronized with the current status, so it can be discarded
-                logger.info("Message is not synchronized with current status of environment, so it will be ignored...")
-                continue
-
-            # Get the action to take from message
-            assert "action" in msg_in
-            action = tuple(msg_in["action"])
-
-            # Perform action and get information about the result
-            state, reward, is_over, turn = env.take_action(sym=player, action=action)
-
-            # Get the next turn for the game
-            turn = Environment.sym_repr[turn]  # TODO: decide: sym string or int?
-
-            # Report the status of environment on string representation
-            env_str = env.get_env_string()
-
-            # Report result of action 'out_topic'
-            env_message = {"state": state, "reward": reward, "is_over": is_over, "turn": turn, "env_str": env_str}
-
-            logger.info("Sending message with results of action to player with symbol '%s'...",
-                        Environment.sym_repr[player])
-
-            mqtt.publish(out_topic, payload=json.dumps(env_message))
-
-        # Draw board through logger
-        logger.info("Current status of board:")
-        env.draw_board(logger_func=logger.info)
-
-        logger.info("Score board: %s", str(env.score))
-
+            MESSAGES.inc()
+            with MESSAGE_SECONDS.time():
+                # New message to process
+                topic = msg_in.topic
+                try:
+                    msg_in = decode_message(msg_in.payload)  # Payload is in bytes format, as JSON or binary
+                except ValueError as e:
+                    discard_message(topic, e, discarded_limiter)
+                    continue
+
+                logger.debug("A message has been received! Topic: '%s', Payload: %s", topic, msg_in)
+
+                # Recognize player from topic
+                if topic == p1_topic:
+                    player = player_1
+                elif topic == p2_topic:
+                    player = player_2
+                else:
+                    # Not recognized message should be ignored
+                    logger.info("Topic not supported, ignoring message...")
+                    continue
+
+                logger.debug("Message belongs to player with symbol '%s'", Environment.sym_repr[player])
+
+                # Perform action and report result on 'out_topic'
+                try:
+                    result_message = apply_action(env, player, msg_in)
+                except ValueError as e:
+                    discard_message(topic, e, discarded_limiter)
+                    continue
+
+                if result_message is None:
+                    continue
+
+                env_message = result_message
+
+                logger.debug("Sending message with results of action to player with symbol '%s'...",
+                             Environment.sym_repr[player])
+
+                mqtt.publish(out_topic, payload=encode_message(env_message, args.codec))
+
+        # Draw board through logger, just when it changed (and not too often, to keep logging cheap)
+        env_str = env.get_env_string()
+        if env_str != last_board_logged and board_limiter.allow():
+            logger.info("Current status of board:")
+            env.draw_board(logger_func=logger.info)
+
+            logger.info("Score board: %s", env.score)
+            last_board_logged = env_str
+
+        game_restarted = False
         if env.game_over():
-            logger.info("GAME OVER! Winner: %s", str(env.winner))
+            logger.info("GAME OVER! Winner: %s", env.winner)
+            logger.info("MQTT inbound queue stats: %s", mqtt.get_stats())
             logger.info("Now restarting game ...")
             env.reset()
+            game_restarted = True
 
             # Get first message of the game
-            env_message = get_first_message()
+            env_message = get_first_message(env)
 
-        # Report last state of environment on 'out_topic', as a continuous ping
-        mqtt.publish(out_topic, payload=json.dumps(env_message))
+        current_timestamp = time.time()
+        if game_restarted or not args.event_driven or current_timestamp - last_ping >= args.ping_interval:
+            # Report last state of environment on 'out_topic', as a continuous ping
+            mqtt.publish(out_topic, payload=encode_message(env_message, args.codec))
+            last_ping = current_timestamp
 
-        # One second of delay to easily follow the game status
-        time.sleep(1)
+        if not args.event_driven:
+            # One second of delay to easily follow the game status
+            time.sleep(1)
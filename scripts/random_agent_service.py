@@ -5,38 +5,62 @@
 __author__ = 'leferrad'
 
 from tateti.environment.tictactoe import Environment
-from tateti.util.fileio import get_logger
-from tateti.util.mqtt import MQTTClient
+from tateti.util.codec import available_codecs, decode_message, detect_codec, encode_message
+from tateti.util.fileio import add_logging_arguments, configure_logging_from_args, get_logger
+from tateti.util.mqtt import MQTTClient, MessageQueue
+from tateti.util.rng import make_rng
 
 import argparse
-import json
 import os
-import random
 import time
 
 logger = get_logger(name="main", level="debug")
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description="Agent service to play Tic-Tac-Toe game performing MQTT communication")
-    parser.add_argument('-mb', '--max-buffer', type=int, dest='mqtt_max_buffer', default=4,
-                        help='Max of messages to retain on the MQTT queue')
+    parser.add_argument('-mb', '--max-buffer', type=int, dest='mqtt_max_buffer', default=None,
+                        help='Max of messages to retain on the MQTT queue (default: 4, or --max-games in multi-game '
+                             'mode, so moves of some games are not dropped because of others)')
+    parser.add_argument('-op', '--overflow-policy', type=str, dest='mqtt_overflow_policy', default="drop_oldest",
+                        choices=MessageQueue.policies, help='What to do when the MQTT queue is full')
     parser.add_argument('-s', '--seed', type=int, dest='seed', default=123,
-                        help='Seed for random methods on Environment')
+                        help='Seed for the random choice of actions')
+    parser.add_argument('-ed', '--event-driven', dest='event_driven', action='store_true',
+                        help='React to messages as soon as they arrive, instead of polling with a fixed sleep')
+    parser.add_argument('-cd', '--codec', type=str, dest='codec', default="auto",
+                        choices=["auto"] + list(available_codecs.keys()),
+                        help="Format of messages sent ('auto' to answer with the same format of the environment)")
+    parser.add_argument('-mg', '--multi-game', dest='multi_game', action='store_true',
+                        help='Play on all the games hosted by an environment in multi-game mode')
+    parser.add_argument('-xg', '--max-games', type=int, dest='max_games', default=10000,
+                        help='Max of games expected to be played at once in multi-game mode')
+    add_logging_arguments(parser)
 
     args = parser.parse_args()
 
+    if args.mqtt_max_buffer is None:
+        args.mqtt_max_buffer = args.max_games if args.multi_game else 4
+
+    if args.multi_game and args.mqtt_overflow_policy == MessageQueue.KEEP_LATEST:
+        parser.error("--overflow-policy %s keeps a message per topic, which would mix games in multi-game mode "
+                     "(where a game may be identified by the 'game_id' of messages)" % MessageQueue.KEEP_LATEST)
+
+    configure_logging_from_args(args)
+
     MQTT_HOST_ADDRESS = os.environ["MQTT_HOST_ADDRESS"]
     MQTT_HOST_PORT = int(os.environ["MQTT_HOST_PORT"])
 
     # --- Start MQTT Client ---
-    mqtt = MQTTClient(host=MQTT_HOST_ADDRESS, port=MQTT_HOST_PORT, max_buffer=args.mqtt_max_buffer)
+    mqtt = MQTTClient(host=MQTT_HOST_ADDRESS, port=MQTT_HOST_PORT, max_buffer=args.mqtt_max_buffer,
+                      overflow_policy=args.mqtt_overflow_policy)
     mqtt.connect()
 
     # Subscribe
     env_topic = os.environ['MQTT_ENV_TOPIC']
     assert env_topic is not None
 
-    mqtt.subscribe([env_topic])
+    # In multi-game mode, each game is reported on its own subtopic '{env_topic}/{game_id}'
+    mqtt.subscribe([env_topic + "/+" if args.multi_game else env_topic])
 
     # Create agent
     p = os.environ.get("PLAYER", '1')
@@ -44,19 +68,22 @@ if __name__ == '__main__':
 
     out_topic = os.environ['MQTT_P1_TOPIC'] if player == Environment.SYMBOL_X else os.environ["MQTT_P2_TOPIC"]
 
+    rng = make_rng(args.seed)
+
     # -------------------------
 
     logger.info("Start looping...")
 
     while True:
         current_timestamp = time.time()
-        msg_in = mqtt.get_message()
+        msg_in = mqtt.wait_message(timeout=1.0) if args.event_driven else mqtt.get_message()
 
         if msg_in is not None:
             # New message to process
-            msg_in = json.loads(msg_in.payload.decode())  # Payload is in bytes format, so it must be decoded
+            msg_codec = detect_codec(msg_in.payload) if args.codec == "auto" else args.codec
+            msg_in = decode_message(msg_in.payload)  # Payload is in bytes format, as JSON or binary
 
-            logger.debug("A message has been received! Payload: %s", str(msg_in))
+            logger.debug("A message has been received! Payload: %s", msg_in)
 
             turn = msg_in["turn"]
 
@@ -68,14 +95,22 @@ if __name__ == '__main__':
             actions = Environment.get_possible_moves_from_str(env_str)
 
             # TEST: A random action
-            action = random.choice(actions)
+            action = actions[rng.integers(len(actions))]
 
             # Include 'env_str' as a way to synchronize this message with the last one sent by the environment
             player_message = {"action": action, "env_str": env_str}
-            mqtt.publish(out_topic, payload=json.dumps(player_message))
+
+            # Messages of games hosted in multi-game mode are answered on the subtopic of the game
+            game_topic = out_topic
+            if "game_id" in msg_in:
+                player_message["game_id"] = msg_in["game_id"]
+                game_topic = out_topic + "/" + str(msg_in["game_id"])
+
+            mqtt.publish(game_topic, payload=encode_message(player_message, msg_codec))
 
         # Draw board through logger
         #logger.info("Status of board:")
         #env.draw_board(logger_func=logger.info)
 
-        time.sleep(0.5)
+        if not args.event_driven:
+            time.sleep(0.5)
@@ -10,7 +10,7 @@ setup(
     author="Leandro Ferrado",
     author_email="ljferrado@gmail.com",
     url="https://github.com/leferrad/rl-iot-example",
-    packages=find_packages(exclude=['scripts', 'docs', 'test']),
+    packages=find_packages(exclude=['scripts', 'docs', 'test', 'benchmarks']),
     license="LICENSE",
     description="Reinforcement Learning agent to solve Tic Tac Toe game, deployed on an IoT environment",
     long_description=open("README.md").read(),
@@ -9,6 +9,7 @@ from tateti.util.fileio import get_logger, serialize_python_object, deserialize_
 
 import numpy as np
 
+import functools
 
 logger = get_logger(__name__, level="debug")
 
@@ -19,33 +20,57 @@ def argmax_value(v):
     return np.argmax(v)
 
 
-available_phis = {"identity": phi.IdentityPhi(n_dims=Environment.n_dimensions),
-                  "scaled": phi.ScaledPhi(n_dims=Environment.n_dimensions,
-                                          min_value=min(Environment.SYMBOL_X, Environment.SYMBOL_O),
-                                          max_value=max(Environment.SYMBOL_X, Environment.SYMBOL_O))}
+# Factories of phis, which take the number of dimensions of the board of each environment
+available_phis = {"identity": phi.IdentityPhi,
+                  "scaled": functools.partial(phi.ScaledPhi,
+                                              min_value=min(Environment.SYMBOL_X, Environment.SYMBOL_O),
+                                              max_value=max(Environment.SYMBOL_X, Environment.SYMBOL_O))}
 
 
-available_strategies = {"egreedy": strategy.EpsilonGreedy(exploit_func=argmax_value, epsilon=0.7),
-                        "boltzmann": strategy.Boltzmann(exploit_func=argmax_value, epsilon=0.9)}
+# Factories of strategies, since each agent needs its own instance (strategies keep state and a random generator)
+available_strategies = {"egreedy": functools.partial(strategy.EpsilonGreedy, exploit_func=argmax_value, epsilon=0.7),
+                        "boltzmann": functools.partial(strategy.Boltzmann, exploit_func=argmax_value, epsilon=0.9)}
 
 
 class BaseAgent(object):
-    def __init__(self, env, gamma=0.95, phi_function="scaled", strategy_function='egreedy'):
-        self.phi = available_phis[phi_function]
-        self.strategy = available_strategies[strategy_function]
+    # Actions of the default board, for agents serialized before they were taken from the environment
+    available_actions = Environment.available_actions
 
+    def __init__(self, env, gamma=0.95, phi_function="scaled", strategy_function='egreedy', seed=123):
+        self.phi = available_phis[phi_function](n_dims=env.n_dimensions)
+        self.strategy = available_strategies[strategy_function](seed=seed)
+        self.phi_function = phi_function
+        self.strategy_function = strategy_function
+
+        self.available_actions = list(env.available_actions)
         self.actions = dict([(a, i) for (i, a) in enumerate(env.available_actions)])
         self.n_actions = env.n_actions
         self.n_dims = self.phi.n_dimensions
         self.gamma = gamma
         self.model = None
 
-    def act(self, state, env_string, explore=True):
+    def act(self, state, env_string, explore=True, action_mask=None):
+        # 'action_mask' flags the legal actions (as given by Environment.get_action_mask()),
+        # otherwise they have to be derived from 'env_string'
         pass
 
+    def act_batch(self, states, action_masks, explore=True):
+        # Default implementation: one call to 'act' per state. Returns indexes of actions to take
+        actions = np.empty(len(states), dtype=int)
+        for k, state in enumerate(states):
+            env_string = "".join([Environment.sym_repr[x] for x in state])
+            actions[k] = self.actions[self.act(list(state), env_string, explore=explore,
+                                               action_mask=action_masks[k])]
+        return actions
+
     def update(self, state, action, reward, next_state, terminal):
         pass
 
+    def update_batch(self, transitions):
+        # Default implementation: one call to 'update' per transition of (state, action, reward, next_state, terminal)
+        for state, action, reward, next_state, terminal in transitions:
+            self.update(state=state, action=action, reward=reward, next_state=next_state, terminal=terminal)
+
     def save(self, filename):
         # TODO: pickle whole object
         success = serialize_python_object(self, filename)
@@ -68,7 +93,7 @@ def play_one(agent_x, agent_o, env):
         sym = env.turn
         agent = agent_x if sym == Environment.SYMBOL_X else agent_o
 
-        action = agent.act(observation, env.get_env_string(), explore=True)
+        action = agent.act(observation, env.get_env_string(), explore=True, action_mask=env.get_action_mask())
 
         next_observation, reward, done, turn = env.take_action(sym, action)
         
@@ -79,7 +104,7 @@ def play_one(agent_x, agent_o, env):
         # env.draw_board(logger_func=logger.info)
 
         if done:
-            logger.info("GAME OVER! Winner: %s" % str(env.winner))
+            logger.info("GAME OVER! Winner: %s", env.winner)
 
             # In order to teach agents how they have lost, punish previous actions that lead them to lose
             losing_player = agent_x if sym == Environment.SYMBOL_O else agent_o
@@ -89,3 +114,62 @@ def play_one(agent_x, agent_o, env):
         steps += 1
 
     return total_reward, steps, env.game_over()
+
+
+def play_batch(agent_x, agent_o, venv, n_steps=100):
+    """
+    Play many games at once on a VectorEnvironment, asking each agent for all of its moves in a single call.
+
+    Transitions are kept pending until the opponent replies, so the last move of a losing player
+    can be punished (as 'punish_lost' does on 'play_one') before being handed to the agent.
+
+    :param agent_x: agent playing with Environment.SYMBOL_X
+    :param agent_o: agent playing with Environment.SYMBOL_O
+    :param venv: tateti.environment.vector.VectorEnvironment
+    :param n_steps: number of lockstep moves to perform
+    :return: tuple of (total reward per symbol, number of finished games)
+    """
+    agents = {Environment.SYMBOL_X: agent_x, Environment.SYMBOL_O: agent_o}
+    pending = {Environment.SYMBOL_X: {}, Environment.SYMBOL_O: {}}
+
+    total_reward = {Environment.SYMBOL_X: 0, Environment.SYMBOL_O: 0}
+    n_games = 0
+
+    for _ in range(n_steps):
+        states = venv.get_states()
+        action_masks = venv.get_action_masks()
+        turns = venv.turns.copy()
+
+        actions = np.empty(venv.n_envs, dtype=int)
+        for sym, agent in agents.items():
+            slots = np.flatnonzero(turns == sym)
+            if len(slots):
+                actions[slots] = agent.act_batch(states[slots], action_masks[slots], explore=True)
+
+        next_states, rewards, dones, _ = venv.take_action(actions)
+        winners = venv.last_winners
+
+        transitions = {Environment.SYMBOL_X: [], Environment.SYMBOL_O: []}
+        for k in range(venv.n_envs):
+            sym, other = turns[k], -turns[k]
+            transition = (states[k], venv.available_actions[actions[k]], rewards[k], next_states[k], dones[k])
+            total_reward[sym] += rewards[k]
+
+            # Previous move of the opponent is now complete, so it can be learned
+            previous = pending[other].pop(k, None)
+            if previous is not None:
+                if dones[k] and winners[k] == sym:
+                    # Punish the last action of the opponent, that lead it to lose
+                    previous = previous[:2] + (Environment.NEGATIVE_REWARD_LOST,) + previous[3:]
+                transitions[other].append(previous)
+
+            if dones[k]:
+                transitions[sym].append(transition)
+                n_games += 1
+            else:
+                pending[sym][k] = transition
+
+        for sym, agent in agents.items():
+            agent.update_batch(transitions[sym])
+
+    return total_reward, n_games
@@ -0,0 +1,55 @@
+# -*- coding: utf-8 -*-
+
+"""Caches to avoid recomputing the outputs of agents' models"""
+
+__author__ = 'leferrad'
+
+from collections import OrderedDict
+
+
+class QValueCache(object):
+    """
+    Bounded LRU cache of Q-values per board key, tied to a version of the model weights.
+    Whenever a different version is requested, all the entries cached for the previous one are dropped.
+    """
+    def __init__(self, max_size=10000):
+        assert max_size > 0
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.version = 0
+
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def _check_version(self, version):
+        if version != self.version:
+            self.entries.clear()
+            self.version = version
+
+    def get(self, key, version):
+        self._check_version(version)
+
+        q_values = self.entries.get(key)
+        if q_values is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+            self.entries.move_to_end(key)
+
+        return q_values
+
+    def put(self, key, q_values, version):
+        if version != self.version:
+            # Computed with weights that are not the current ones anymore
+            return
+
+        self.entries[key] = q_values
+        self.entries.move_to_end(key)
+        if len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)  # Least recently used
+
+    def clear(self):
+        self.entries.clear()
@@ -7,33 +7,73 @@ __author__ = 'leferrad'
 # NOTE: pretty based on https://keon.io/deep-q-learning/
 
 from tateti.agent.base import BaseAgent
+from tateti.agent.cache import QValueCache
+from tateti.agent.inference import NumpyQNetwork
+from tateti.agent.memory import ReplayMemory, PrioritizedReplayMemory
+from tateti.environment import symmetry
 from tateti.environment.tictactoe import Environment
+from tateti.util import metrics
+from tateti.util.checkpoint import read_checkpoint, write_checkpoint
+from tateti.util.rng import spawn_seeds
 
-from keras.models import Sequential
-from keras.layers import Dense
-from keras.optimizers import Adam
 import numpy as np
 
-from collections import deque
-import random
+from collections import OrderedDict, deque
+import os
+
+
+ACT_SECONDS = metrics.histogram("tateti_dqn_act_seconds", "Time to choose an action with the DQN agent")
+PREDICT_SECONDS = metrics.histogram("tateti_dqn_predict_seconds", "Time of a forward pass to serve Q-values")
+REPLAY_SECONDS = metrics.histogram("tateti_dqn_experience_replay_seconds", "Time of an experience replay")
 
 
 class DQNAgent(BaseAgent):
 
     def __init__(self, env, model=None, gamma=0.95, phi_function="integer", strategy_function='egreedy',
-                 memory_size=400, batch_size=10):
-        BaseAgent.__init__(self, env=env, gamma=gamma, phi_function=phi_function, strategy_function=strategy_function)
-
-        self.memory = deque(maxlen=int(memory_size))
+                 memory_size=400, batch_size=10, prioritized=False, alpha=0.6, beta=0.4,
+                 cache_q_values=False, cache_size=10000, cache_symmetric=False, augment=False, seed=123):
+        # Independent random streams for the exploration and the sampling of replays
+        strategy_seed, memory_seed = spawn_seeds(seed, 2)
+
+        BaseAgent.__init__(self, env=env, gamma=gamma, phi_function=phi_function, strategy_function=strategy_function,
+                           seed=strategy_seed)
+
+        self.prioritized = prioritized
+        if prioritized:
+            self.memory = PrioritizedReplayMemory(capacity=memory_size, n_dims=env.n_dimensions,
+                                                  alpha=alpha, beta=beta, seed=memory_seed)
+        else:
+            self.memory = ReplayMemory(capacity=memory_size, n_dims=env.n_dimensions, seed=memory_seed)
         self.batch_size = batch_size
 
+        # Every transition replayed can be augmented with its 8 symmetric versions
+        self.augment = augment
+
+        # Q-values can be cached per board, or per canonical board if the model was trained to treat
+        # symmetric boards as equivalent (see 'enable_q_cache')
+        self.q_cache = None
+        self.q_cache_symmetric = False
+        if cache_q_values:
+            self.enable_q_cache(max_size=cache_size, symmetric=cache_symmetric)
+
+        # Counter of updates on model weights, to know when cached Q-values become stale
+        self.weights_version = 0
+
         if model is None:
             model = self._build_default_model(observation_space=self.n_dims, action_space=self.n_actions)
 
         self.model = model
 
+        # Model used to serve actions instead of the trained one, when learning happens elsewhere
+        self.serving_model = None
+
     @staticmethod
     def _build_default_model(observation_space, action_space, n_hidden=24, activation="relu", lr=1e-3):
+        # Keras is imported just here, so agents only used for inference (e.g. with a NumpyQNetwork) don't need it
+        from keras.models import Sequential
+        from keras.layers import Dense
+        from keras.optimizers import Adam
+
         model = Sequential()
         model.add(Dense(n_hidden, input_shape=(observation_space,), activation=activation))
         model.add(Dense(n_hidden, activation=activation))
@@ -44,33 +84,109 @@ class DQNAgent(BaseAgent):
         return model
 
     def remember(self, state, action, reward, next_state, terminal):
-        self.memory.append((state, action, reward, next_state, terminal))
+        self.memory.append(state, self.actions[action], reward, next_state, terminal)
 
-    def act(self, state, env_string, explore=True):
+    @metrics.timed(ACT_SECONDS)
+    def act(self, state, env_string, explore=True, action_mask=None):
         # Filter available actions to take
-        sym_empty = Environment.sym_repr[Environment.SYMBOL_EMPTY]
-        available_actions = [i for (i, s) in enumerate(env_string) if s == sym_empty]
+        if action_mask is None:
+            action_mask = Environment.get_action_mask_from_str(env_string)
+        available_actions = np.flatnonzero(action_mask)
 
         # Get Q-values for available actions
-        state_x = self.phi(state)
-        q_values = self.predict(state_x)
-        q_values = [q_values[i] for i in available_actions]
+        q_values = self.get_q_values(state)[available_actions]
 
         # Get index of sampled available action from strategy used
         action_int = self.strategy.sample_action(v=q_values, explore=explore)
         action_int = available_actions[action_int]  # Index of available to index of all actions
-        action = Environment.available_actions[action_int]  # Get action to take
+        action = self.available_actions[action_int]  # Get action to take
 
         return action
 
+    def act_batch(self, states, action_masks, explore=True):
+        # Get Q-values for all the states with a single forward pass
+        q_values = self.predict(self.phi(states))
+        if len(q_values.shape) == 1:
+            q_values = np.expand_dims(q_values, axis=0)
+
+        # Actions for the whole batch at once, sampled only among the legal ones
+        return self.strategy.sample_actions(q_values, action_masks, explore=explore)
+
+    def get_q_values(self, state):
+        # Q-values for a single state, through the cache of boards if enabled
+        if self.q_cache is None:
+            return self.predict(self.phi(state))
+
+        version = self.weights_version
+        if not self.q_cache_symmetric:
+            key = tuple(state)
+            q_values = self.q_cache.get(key, version)
+            if q_values is None:
+                q_values = self.predict(self.phi(state))
+                self.q_cache.put(key, q_values, version)
+            return q_values
+
+        key, t = symmetry.canonical_key(state)
+        q_values = self.q_cache.get(key, version)
+        if q_values is None:
+            q_values = self.predict(self.phi(symmetry.transform_state(state, t)))
+            self.q_cache.put(key, q_values, version)
+
+        return symmetry.inverse_transform_values(q_values, t)
+
+    def export_numpy(self):
+        # Inference-only copy of the current model, that just needs NumPy to run
+        if isinstance(self.model, NumpyQNetwork):
+            return NumpyQNetwork(self.model.weights, self.model.biases, self.model.activations)
+        return NumpyQNetwork.from_keras(self.model)
+
+    def enable_q_cache(self, max_size=10000, symmetric=False):
+        """
+        Cache the Q-values served per board
+
+        :param max_size: int, max of boards cached
+        :param symmetric: boolean, if True then boards are cached per canonical board, so the Q-values of
+                          a board are also served for its symmetric equivalents. That is only correct for
+                          models trained to be invariant to symmetries (i.e. with 'augment')
+        """
+        if symmetric and not self.augment:
+            raise ValueError("Symmetric cache of Q-values requires a model trained with 'augment'")
+        if symmetric and self.n_actions != Environment.n_actions:
+            raise ValueError("Symmetric cache of Q-values is only supported on the %dx%d board"
+                             % (Environment.BOARD_LENGTH, Environment.BOARD_LENGTH))
+        self.q_cache = QValueCache(max_size=max_size)
+        self.q_cache_symmetric = symmetric
+
+    def __setstate__(self, state):
+        # Agents pickled before some attributes existed get their defaults (as done for strategies)
+        self.__dict__.update(state)
+        for name, default in (("prioritized", False), ("augment", False), ("q_cache", None),
+                              ("q_cache_symmetric", False), ("weights_version", 0), ("serving_model", None)):
+            if name not in state:
+                setattr(self, name, default)
+
+        if isinstance(self.memory, deque):
+            # Memory used to be a deque of transitions, with the actions taken instead of their indexes
+            memory = ReplayMemory(capacity=self.memory.maxlen or max(len(self.memory), 1), n_dims=self.n_dims)
+            for obs, action, reward, next_obs, terminal in self.memory:
+                memory.append(obs, self.actions[tuple(action)], reward, next_obs, terminal)
+            self.memory = memory
+
+    @metrics.timed(PREDICT_SECONDS)
     def predict(self, x):
+        # Actions are served from the serving model if there is one (e.g. a BackgroundLearner)
+        model = self.serving_model if self.serving_model is not None else self.model
+        return self._predict(model, x)
+
+    @staticmethod
+    def _predict(model, x):
         if not isinstance(x, np.ndarray):
             x = np.asarray(x)
 
         if len(x.shape) == 1:
-            return self.model.predict(np.expand_dims(x, axis=0))[0]
+            return model.predict(np.expand_dims(x, axis=0))[0]
         else:
-            return self.model.predict(x)
+            return model.predict(x)
 
     def fit(self, x, q):
         if not isinstance(x, np.ndarray):
@@ -86,19 +202,54 @@ class DQNAgent(BaseAgent):
             q = np.expand_dims(q, axis=0)
 
         self.model.fit(x, q, verbose=0)
+        self._on_weights_updated()
 
+    @metrics.timed(REPLAY_SECONDS)
     def experience_replay(self):
-        batch = random.sample(self.memory, self.batch_size)
-        for state, action, reward, state_next, terminal in batch:
-            q_update = reward
-            if not terminal:
-                q_update = (reward + self.gamma * np.amax(self.predict(state_next)))
-            q_values = self.predict(state)
-
-            a = self.actions[action]
-            q_values[a] = q_update
-
-            self.fit(state, q_values)
+        weights = None
+        if self.prioritized:
+            batch, indexes, weights = self.memory.sample_prioritized(self.batch_size)
+        else:
+            batch = self.memory.sample(self.batch_size)
+
+        states, actions, rewards, next_states, terminals = batch
+        states, next_states = states.astype(float), next_states.astype(float)
+
+        if self.augment:
+            # Add the symmetric equivalents of each transition (the first symmetry is the identity)
+            symmetries, inverse_symmetries = symmetry.get_symmetries(n_cells=states.shape[1])
+            n_symmetries = len(symmetries)
+            states = states[:, symmetries].reshape((-1, states.shape[1]))
+            next_states = next_states[:, symmetries].reshape((-1, next_states.shape[1]))
+            actions = inverse_symmetries[:, actions].T.ravel()
+            rewards = np.repeat(rewards, n_symmetries)
+            terminals = np.repeat(terminals, n_symmetries)
+            if weights is not None:
+                weights = np.repeat(weights, n_symmetries)
+
+        # Just one forward pass for next states and another one for current states
+        q_update = rewards + self.gamma * np.amax(self._predict(self.model, next_states), axis=1) * ~terminals
+        q_values = self._predict(self.model, states)
+        rows = np.arange(len(actions))
+
+        if self.prioritized:
+            # Priorities are given by the TD errors of the transitions sampled
+            td_errors = q_update - q_values[rows, actions]
+            if self.augment:
+                td_errors = td_errors[::n_symmetries]
+            self.memory.update_priorities(indexes, td_errors)
+
+        q_values[rows, actions] = q_update
+
+        # And a single gradient step for the whole batch, weighted by importance sampling if prioritized
+        self.model.train_on_batch(states, q_values, sample_weight=weights)
+        self._on_weights_updated()
+
+    def _on_weights_updated(self):
+        # Cached Q-values become stale only if they are served from the model trained. Otherwise, the serving
+        # model (e.g. a BackgroundLearner) bumps the version when it publishes new weights
+        if self.serving_model is None:
+            self.weights_version += 1
 
     def update(self, state, action, reward, next_state, terminal):
 
@@ -112,8 +263,105 @@ class DQNAgent(BaseAgent):
 
         self.experience_replay()
 
-    def punish_lost(self):
-        state, action, reward, next_state, terminal = self.memory.pop()  # Get last trace to be modified
-        reward = Environment.NEGATIVE_REWARD_LOST  # Modify reward as a "punishment" for losing match
-        self.remember(state, action, reward, next_state, terminal)  # Add updated trace to be learned
+    def update_batch(self, transitions):
+        if not transitions:
+            return
+
+        for state, action, reward, next_state, terminal in transitions:
+            self.remember(state, action, reward, next_state, terminal)
+            self.strategy.update()
+
+        if len(self.memory) < self.batch_size:
+            # Not enough memory to apply experience replay
+            return
 
+        # A single replay for the whole batch of transitions
+        self.experience_replay()
+
+    def punish_lost(self):
+        # Modify reward of last trace as a "punishment" for losing match
+        self.memory.update_last_reward(Environment.NEGATIVE_REWARD_LOST)
+
+    MEMORY_SUFFIX = ".memory.npz"
+
+    def save_checkpoint(self, filename, save_memory=False):
+        """
+        Save the agent as a checkpoint, with the model weights on a memory-mappable file and
+        the parameters of the agent on its metadata header
+
+        :param filename: string, path to checkpoint file
+        :param save_memory: boolean, if True then the replay memory is saved as well on '<filename>.memory.npz'
+        """
+        network = self.export_numpy()
+        arrays = OrderedDict(("weights_%i" % i, w) for (i, w) in enumerate(network.get_weights()))
+        metadata = {"agent": type(self).__name__,
+                    "activations": network.activations,
+                    "n_dimensions": self.n_dims,
+                    "gamma": self.gamma,
+                    "phi_function": self.phi_function,
+                    "strategy_function": self.strategy_function,
+                    "memory_size": self.memory.capacity,
+                    "batch_size": self.batch_size,
+                    "prioritized": self.prioritized,
+                    "augment": self.augment}
+
+        write_checkpoint(filename, arrays, metadata)
+
+        if save_memory:
+            self.memory.save(filename + self.MEMORY_SUFFIX)
+
+    @classmethod
+    def load_checkpoint_model(cls, filename, inference_only=False):
+        """
+        Load just the model of a checkpoint saved with 'save_checkpoint'
+
+        :param filename: string, path to checkpoint file
+        :param inference_only: boolean, if True then return a NumpyQNetwork that uses the weights
+                               straight from the file mapped on memory (i.e. without copies nor Keras)
+        :return: tuple of (model, dict of metadata)
+        """
+        arrays, metadata = read_checkpoint(filename, mmap=True)
+        weights = list(arrays.values())
+        network = NumpyQNetwork(weights=weights[::2], biases=weights[1::2], activations=metadata["activations"])
+
+        if inference_only:
+            return network, metadata
+
+        model = cls._build_default_model(observation_space=network.input_dim, action_space=network.output_dim,
+                                         n_hidden=weights[0].shape[1], activation=metadata["activations"][0])
+        if [w.shape for w in model.get_weights()] != [w.shape for w in weights]:
+            raise ValueError("Model on checkpoint '%s' doesn't have the default architecture" % filename)
+        model.set_weights(weights)
+
+        return model, metadata
+
+    @classmethod
+    def load_checkpoint(cls, filename, env, inference_only=False, load_memory=False):
+        """
+        Load an agent from a checkpoint saved with 'save_checkpoint'
+
+        :param filename: string, path to checkpoint file
+        :param env: Environment
+        :param inference_only: boolean, if True then the model is a NumpyQNetwork that uses the weights
+                               straight from the file mapped on memory (i.e. without copies nor Keras)
+        :param load_memory: boolean, if True then load the replay memory saved along the checkpoint (if any)
+        :return: DQNAgent
+        """
+        model, metadata = cls.load_checkpoint_model(filename, inference_only=inference_only)
+
+        # Checkpoints saved before boards could have other sizes are for the default one
+        n_dimensions = metadata.get("n_dimensions", Environment.n_dimensions)
+        if n_dimensions != env.n_dimensions:
+            raise ValueError("Checkpoint '%s' is for boards of %i cells, but the environment has %i"
+                             % (filename, n_dimensions, env.n_dimensions))
+
+        agent = cls(env=env, model=model, gamma=metadata["gamma"], phi_function=metadata["phi_function"],
+                    strategy_function=metadata["strategy_function"], memory_size=metadata["memory_size"],
+                    batch_size=metadata["batch_size"], prioritized=metadata["prioritized"],
+                    augment=metadata.get("augment", False))
+
+        memory_filename = filename + cls.MEMORY_SUFFIX
+        if load_memory and os.path.exists(memory_filename):
+            agent.memory.load(memory_filename)
+
+        return agent
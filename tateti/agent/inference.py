@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+
+"""Lightweight inference of Q-networks with just NumPy, to serve agents without the Keras/TensorFlow stack"""
+
+__author__ = 'leferrad'
+
+import numpy as np
+
+
+def relu(x):
+    return np.maximum(x, 0.0, out=x)
+
+
+def linear(x):
+    return x
+
+
+def tanh(x):
+    return np.tanh(x, out=x)
+
+
+def sigmoid(x):
+    return 1.0 / (1.0 + np.exp(-x))
+
+
+available_activations = {"relu": relu, "linear": linear, "tanh": tanh, "sigmoid": sigmoid}
+
+
+class NumpyQNetwork(object):
+    """
+    Forward pass of a stack of Dense layers (as the one built by DQNAgent._build_default_model),
+    exposing the 'predict' / 'get_weights' / 'set_weights' subset of the Keras model API.
+    """
+    def __init__(self, weights, biases, activations, dtype=np.float32):
+        assert len(weights) == len(biases) == len(activations)
+        for name in activations:
+            assert name in available_activations, "Activation '%s' not supported" % name
+
+        self.dtype = dtype
+        self.weights = [np.asarray(w, dtype=dtype) for w in weights]
+        self.biases = [np.asarray(b, dtype=dtype) for b in biases]
+        self.activations = list(activations)
+        self._activation_funcs = [available_activations[name] for name in activations]
+        self._layers = tuple(zip(self.weights, self.biases, self._activation_funcs))
+
+    @property
+    def input_dim(self):
+        return self.weights[0].shape[0]
+
+    @property
+    def output_dim(self):
+        return self.weights[-1].shape[1]
+
+    @classmethod
+    def from_keras(cls, model):
+        weights, biases, activations = [], [], []
+        for layer in model.layers:
+            w, b = layer.get_weights()
+            weights.append(w)
+            biases.append(b)
+            activations.append(layer.get_config()["activation"])
+
+        return cls(weights=weights, biases=biases, activations=activations)
+
+    def predict(self, x, verbose=0):
+        # Same as Keras: a batch of inputs as a 2-D array, returning a batch of outputs
+        h = np.asarray(x, dtype=self.dtype)
+        for w, b, activation in self._layers:
+            h = activation(np.dot(h, w) + b)
+        return h
+
+    def get_weights(self):
+        # Same order as on Keras models: [W_1, b_1, W_2, b_2, ...]
+        return [a for (w, b) in zip(self.weights, self.biases) for a in (w, b)]
+
+    def set_weights(self, weights):
+        assert len(weights) == 2 * len(self.weights)
+        new_weights, new_biases = [], []
+        for i, (w, b) in enumerate(zip(weights[::2], weights[1::2])):
+            assert w.shape == self.weights[i].shape and b.shape == self.biases[i].shape, "Incompatible weights"
+            new_weights.append(np.asarray(w, dtype=self.dtype))
+            new_biases.append(np.asarray(b, dtype=self.dtype))
+
+        # Layers are replaced all at once, so a concurrent 'predict' uses either the old or the new ones
+        self.weights, self.biases = new_weights, new_biases
+        self._layers = tuple(zip(new_weights, new_biases, self._activation_funcs))
+
+    def save(self, filename):
+        arrays = {"W_%i" % i: w for (i, w) in enumerate(self.weights)}
+        arrays.update({"b_%i" % i: b for (i, b) in enumerate(self.biases)})
+        np.savez(filename, activations=np.asarray(self.activations), **arrays)
+
+    @classmethod
+    def load(cls, filename):
+        with np.load(filename) as data:
+            activations = [str(a) for a in data["activations"]]
+            n_layers = len(activations)
+            weights = [data["W_%i" % i] for i in range(n_layers)]
+            biases = [data["b_%i" % i] for i in range(n_layers)]
+
+        return cls(weights=weights, biases=biases, activations=activations)
@@ -0,0 +1,171 @@
+# -*- coding: utf-8 -*-
+
+"""Background learning of agents, decoupled from the path that serves their actions"""
+
+__author__ = 'leferrad'
+
+from tateti.agent.inference import NumpyQNetwork
+from tateti.util.fileio import get_logger
+
+import contextlib
+import threading
+
+
+logger = get_logger(__name__, level="debug")
+
+
+class ServingBuffer(object):
+    """
+    Reference to the network that serves actions. Networks published are never modified: new weights
+    come in a new network that replaces the previous one with a single assignment (which is atomic),
+    so a reader still using the previous network never sees a mix of old and new layers.
+    """
+    def __init__(self, network):
+        self.network = network
+        self.version = 0
+
+    def read(self):
+        return self.network
+
+    def swap(self, network):
+        self.network = network
+        self.version += 1
+
+
+def get_graph_and_session(model):
+    """
+    Under the graph mode of TensorFlow 1.x, Keras models can only be used within the graph and session
+    where they were built, which are bound to the thread that built them. So they are captured here,
+    to be entered by the threads that use the model later
+
+    :param model: model of an agent (Keras model or NumpyQNetwork)
+    :return: tuple of (graph, session), or None if there is no need to enter them (e.g. NumPy models,
+             or the eager mode of TensorFlow 2.x)
+    """
+    if isinstance(model, NumpyQNetwork):
+        return None
+
+    try:
+        import tensorflow as tf
+        from keras import backend
+    except ImportError:
+        return None
+
+    if not hasattr(tf, "get_default_graph") or not hasattr(backend, "get_session"):
+        return None
+
+    return tf.get_default_graph(), backend.get_session()
+
+
+@contextlib.contextmanager
+def model_context(graph_and_session):
+    # Enter the graph and session given by 'get_graph_and_session', if any
+    if graph_and_session is None:
+        yield
+        return
+
+    graph, session = graph_and_session
+    with graph.as_default(), session.as_default():
+        yield
+
+
+class BackgroundLearner(object):
+    """
+    Thread that applies experience replay on a DQNAgent, so the agent only does inference when acting.
+
+    Actions are served by NumPy copies of the model (see NumpyQNetwork) kept on a ServingBuffer,
+    which gets a new copy with the weights trained every 'publish_every' replays.
+
+    A replay is only done when transitions were added to the memory since the previous one, so the learner
+    doesn't keep training on the same experience (competing for the CPU with the serving path).
+
+    The learner has to be created on the thread that built the model of the agent, since Keras models
+    under TensorFlow 1.x are bound to the graph and session of that thread (which the learner enters).
+    """
+    def __init__(self, agent, publish_every=10, interval=0.05, idle_wait=0.1):
+        self.agent = agent
+        self.publish_every = publish_every
+        self.interval = interval  # Seconds to wait between replays
+        self.idle_wait = idle_wait  # Seconds to wait when there is no new experience to replay
+
+        self.buffer = ServingBuffer(agent.export_numpy())
+        self.graph_and_session = get_graph_and_session(agent.model)
+
+        self.thread = None
+        self.stop_event = threading.Event()
+        # Held while the model is trained or published, since it may be also replaced from other threads
+        # (e.g. on reloads, see 'swap_model')
+        self.lock = threading.Lock()
+        self.n_replays = 0
+        self.n_replayed = 0  # Transitions appended to the memory up to the last replay
+
+    def predict(self, x, verbose=0):
+        # Same interface as models, so it can be used as the serving model of the agent
+        return self.buffer.read().predict(x)
+
+    def publish(self):
+        with self.lock:
+            self._publish()
+
+    def _publish(self):
+        with model_context(self.graph_and_session):
+            self.buffer.swap(self.agent.export_numpy())
+
+        # Invalidate Q-values that could have been cached from the previous weights
+        self.agent.weights_version += 1
+
+    def swap_model(self, model):
+        """
+        Replace the model trained by the agent (e.g. with one reloaded), never in the middle of a replay,
+        and publish its weights to serve actions
+
+        :param model: model with the same architecture as the current one
+        """
+        with self.lock:
+            self.agent.model = model
+            self.graph_and_session = get_graph_and_session(model)
+            self._publish()
+
+    def _run(self):
+        with model_context(self.graph_and_session):
+            self._loop()
+
+    def _loop(self):
+        while not self.stop_event.is_set():
+            memory = self.agent.memory
+            if len(memory) < self.agent.batch_size or memory.n_appended == self.n_replayed:
+                self.stop_event.wait(self.idle_wait)
+                continue
+
+            with self.lock:
+                self.n_replayed = memory.n_appended
+                self.agent.experience_replay()
+                self.n_replays += 1
+
+                if self.n_replays % self.publish_every == 0:
+                    self._publish()
+
+            if self.interval > 0:
+                self.stop_event.wait(self.interval)
+
+    def start(self):
+        assert self.thread is None, "Learner already started"
+
+        self.agent.serving_model = self
+        self.stop_event.clear()
+        self.thread = threading.Thread(target=self._run, name="background-learner", daemon=True)
+        self.thread.start()
+        logger.info("Background learner started")
+
+    def stop(self):
+        if self.thread is None:
+            return
+
+        self.stop_event.set()
+        self.thread.join()
+        self.thread = None
+
+        # Serve again from the trained model, which is not being updated anymore
+        self.agent.serving_model = None
+        self.agent.weights_version += 1
+        logger.info("Background learner stopped after %i replays", self.n_replays)
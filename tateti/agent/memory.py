@@ -0,0 +1,202 @@
+# -*- coding: utf-8 -*-
+
+"""Memories to store the experience of agents, to be used for experience replay"""
+
+__author__ = 'leferrad'
+
+from tateti.util.rng import make_rng
+
+import numpy as np
+
+
+class ReplayMemory(object):
+    """
+    Ring buffer of transitions (state, action, reward, next_state, terminal), stored on preallocated arrays.
+    Once full, every new transition overwrites the oldest one.
+    """
+    def __init__(self, capacity, n_dims, state_dtype=np.int8, seed=None):
+        self.capacity = int(capacity)
+        assert self.capacity > 0
+        self.n_dims = n_dims
+
+        self.states = np.zeros((self.capacity, n_dims), dtype=state_dtype)
+        self.actions = np.zeros(self.capacity, dtype=np.int32)  # Index of action taken
+        self.rewards = np.zeros(self.capacity, dtype=np.float32)
+        self.next_states = np.zeros((self.capacity, n_dims), dtype=state_dtype)
+        self.terminals = np.zeros(self.capacity, dtype=bool)
+
+        self.cursor = 0  # Position where next transition will be written
+        self.size = 0
+        self.n_appended = 0  # Transitions ever stored, to know when there is new experience (e.g. to replay)
+
+        self.rng = make_rng(seed)
+
+    def __len__(self):
+        return self.size
+
+    def append(self, state, action, reward, next_state, terminal):
+        k = self.cursor
+        self.states[k] = state
+        self.actions[k] = action
+        self.rewards[k] = reward
+        self.next_states[k] = next_state
+        self.terminals[k] = terminal
+
+        self.cursor = (k + 1) % self.capacity
+        self.size = min(self.size + 1, self.capacity)
+        self.n_appended += 1
+
+    def last_index(self):
+        assert self.size > 0, "Memory is empty"
+        return (self.cursor - 1) % self.capacity
+
+    def update_last_reward(self, reward):
+        # Rewrite the reward of the last transition stored
+        self.rewards[self.last_index()] = reward
+
+    def get(self, indexes):
+        return (self.states[indexes], self.actions[indexes], self.rewards[indexes],
+                self.next_states[indexes], self.terminals[indexes])
+
+    def sample_indexes(self, batch_size):
+        return self.rng.choice(self.size, size=batch_size, replace=False)
+
+    def sample(self, batch_size):
+        # Random minibatch of transitions (without replacement), as a tuple of arrays
+        return self.get(self.sample_indexes(batch_size))
+
+    def ordered_indexes(self):
+        # Indexes of the transitions stored, from the oldest to the newest one
+        if self.size < self.capacity:
+            return np.arange(self.size)
+        return (np.arange(self.capacity) + self.cursor) % self.capacity
+
+    def save(self, filename):
+        states, actions, rewards, next_states, terminals = self.get(self.ordered_indexes())
+        np.savez(filename, states=states, actions=actions, rewards=rewards, next_states=next_states,
+                 terminals=terminals)
+
+    def load(self, filename):
+        # Replace the content of the memory with the transitions saved (just the newest ones if they don't fit)
+        with np.load(filename) as data:
+            n = min(len(data["actions"]), self.capacity)
+            self.states[:n] = data["states"][-n:]
+            self.actions[:n] = data["actions"][-n:]
+            self.rewards[:n] = data["rewards"][-n:]
+            self.next_states[:n] = data["next_states"][-n:]
+            self.terminals[:n] = data["terminals"][-n:]
+
+        self.size = n
+        self.cursor = n % self.capacity
+        self.n_appended += n
+
+
+class SumTree(object):
+    """
+    Binary tree where every node holds the sum of its children, and leaves hold priorities.
+    Sampling a leaf proportionally to its priority and updating a priority are both O(log n).
+    """
+    def __init__(self, capacity):
+        self.capacity = int(capacity)
+
+        # Leaves are stored at [n_leaves, 2 * n_leaves), and node k has children 2k and 2k + 1 (root is node 1)
+        self.depth = int(np.ceil(np.log2(max(self.capacity, 2))))
+        self.n_leaves = 2 ** self.depth
+        self.tree = np.zeros(2 * self.n_leaves, dtype=np.float64)
+
+    def total(self):
+        return self.tree[1]
+
+    def get(self, indexes):
+        return self.tree[self.n_leaves + np.asarray(indexes)]
+
+    def update(self, indexes, priorities):
+        nodes = self.n_leaves + np.asarray(indexes)
+        self.tree[nodes] = priorities
+
+        # Propagate changes up to the root, one level at a time
+        for _ in range(self.depth):
+            nodes = np.unique(nodes // 2)
+            self.tree[nodes] = self.tree[2 * nodes] + self.tree[2 * nodes + 1]
+
+    def find(self, values):
+        # Indexes of the leaves where the cumulative sum of priorities reaches the given values
+        values = np.array(values, dtype=np.float64)
+        nodes = np.ones(len(values), dtype=np.int64)
+
+        for _ in range(self.depth):
+            left = 2 * nodes
+            go_right = (values >= self.tree[left]) & (self.tree[left + 1] > 0)
+            values -= self.tree[left] * go_right
+            nodes = left + go_right
+
+        return nodes - self.n_leaves
+
+
+class PrioritizedReplayMemory(ReplayMemory):
+    """
+    Replay memory that samples transitions proportionally to their priority (based on the TD error),
+    with importance-sampling weights to correct the bias introduced.
+
+    See: Schaul, T., et al. (2015). Prioritized experience replay.
+    """
+    def __init__(self, capacity, n_dims, alpha=0.6, beta=0.4, beta_increment=1e-3, epsilon=1e-3,
+                 state_dtype=np.int8, seed=None):
+        ReplayMemory.__init__(self, capacity=capacity, n_dims=n_dims, state_dtype=state_dtype, seed=seed)
+
+        self.alpha = alpha  # How much prioritization is used (0 means uniform sampling)
+        self.beta = beta  # How much importance-sampling correction is used (annealed up to 1)
+        self.beta_increment = beta_increment
+        self.epsilon = epsilon  # To avoid zero priorities
+
+        self.tree = SumTree(self.capacity)
+        self.max_priority = 1.0
+
+    def append(self, state, action, reward, next_state, terminal):
+        k = self.cursor
+        ReplayMemory.append(self, state, action, reward, next_state, terminal)
+
+        # New transitions get the max priority, to be replayed at least once
+        self.tree.update([k], self.max_priority ** self.alpha)
+
+    def update_last_reward(self, reward):
+        ReplayMemory.update_last_reward(self, reward)
+
+        # The rewritten transition brings new information, so make sure it is replayed soon
+        self.tree.update([self.last_index()], self.max_priority ** self.alpha)
+
+    def load(self, filename):
+        ReplayMemory.load(self, filename)
+
+        # Priorities are not saved, so all the transitions loaded get the max priority
+        self.tree = SumTree(self.capacity)
+        if self.size:
+            self.tree.update(np.arange(self.size), self.max_priority ** self.alpha)
+
+    def update_priorities(self, indexes, td_errors):
+        priorities = np.abs(td_errors) + self.epsilon
+        self.max_priority = max(self.max_priority, float(np.max(priorities)))
+        self.tree.update(indexes, priorities ** self.alpha)
+
+    def sample_indexes(self, batch_size):
+        # Stratified sampling: one value per segment of the cumulative sum of priorities
+        segment = self.tree.total() / batch_size
+        values = (np.arange(batch_size) + self.rng.random(batch_size)) * segment
+        return np.minimum(self.tree.find(values), self.size - 1)
+
+    def sample_prioritized(self, batch_size):
+        """
+        Sample a minibatch of transitions according to their priorities
+
+        :param batch_size: int
+        :return: tuple of (transitions as tuple of arrays, indexes of transitions, importance-sampling weights)
+        """
+        indexes = self.sample_indexes(batch_size)
+
+        probabilities = self.tree.get(indexes) / self.tree.total()
+        weights = (self.size * probabilities) ** (-self.beta)
+        weights /= weights.max()
+
+        self.beta = min(1.0, self.beta + self.beta_increment)
+
+        return self.get(indexes), indexes, weights
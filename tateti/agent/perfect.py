@@ -0,0 +1,155 @@
+# -*- coding: utf-8 -*-
+
+"""Perfect play for Tic-Tac-Toe, through a table of minimax solutions for all the reachable positions"""
+
+__author__ = 'leferrad'
+
+from tateti.agent.base import BaseAgent
+from tateti.environment.symmetry import SYMMETRIES, board_hash, canonical_key
+from tateti.environment.tictactoe import Environment
+from tateti.util.rng import make_rng
+
+import numpy as np
+
+
+N_CELLS = Environment.n_dimensions
+
+# Cells of each move mask, to resolve the moves of a mask with a single lookup
+MASK_MOVES = [[k for k in range(N_CELLS) if (m >> k) & 1] for m in range(1 << N_CELLS)]
+
+
+def _winner(cells):
+    x_mask = sum(1 << k for (k, s) in enumerate(cells) if s == Environment.SYMBOL_X)
+    o_mask = sum(1 << k for (k, s) in enumerate(cells) if s == Environment.SYMBOL_O)
+    if Environment.WIN_TABLE[x_mask]:
+        return Environment.SYMBOL_X
+    if Environment.WIN_TABLE[o_mask]:
+        return Environment.SYMBOL_O
+    return None
+
+
+class PerfectPlayTable(object):
+    """
+    Minimax solution of every reachable position, for both players to move.
+    Values are given from the perspective of the player to move (1: win, 0: draw, -1: loss),
+    and best moves as a bitmask over cells.
+    """
+    def __init__(self):
+        n_states = 3 ** N_CELLS
+
+        # First dimension is the player to move (0: 'x', 1: 'o')
+        self.values = np.zeros((2, n_states), dtype=np.int8)
+        self.best_moves = np.zeros((2, n_states), dtype=np.uint16)
+        self.reachable = np.zeros((2, n_states), dtype=bool)
+
+        self._memo = {}
+        empty = (Environment.SYMBOL_EMPTY,) * N_CELLS
+        for player in (Environment.SYMBOL_X, Environment.SYMBOL_O):
+            self._visit(empty, player)
+        self._memo = {}
+
+    @staticmethod
+    def player_index(player):
+        return 0 if player == Environment.SYMBOL_X else 1
+
+    def _negamax(self, cells, player):
+        # Solve the position on its canonical form, memoized per (canonical board, player to move)
+        key, t = canonical_key(cells)
+        perm = SYMMETRIES[t]
+        if (key, player) not in self._memo:
+            canonical = tuple(cells[k] for k in perm)
+            self._memo[(key, player)] = self._solve(canonical, player)
+
+        value, best_mask = self._memo[(key, player)]
+
+        # Map best moves from the canonical frame back to the original one
+        return value, sum(1 << int(perm[k]) for k in MASK_MOVES[best_mask])
+
+    def _solve(self, cells, player):
+        winner = _winner(cells)
+        if winner is not None:
+            return (1 if winner == player else -1), 0
+
+        moves = [k for (k, s) in enumerate(cells) if s == Environment.SYMBOL_EMPTY]
+        if not moves:
+            return 0, 0
+
+        values = {}
+        for k in moves:
+            child = cells[:k] + (player,) + cells[k + 1:]
+            values[k] = -self._negamax(child, -player)[0]
+
+        value = max(values.values())
+        return value, sum(1 << k for (k, v) in values.items() if v == value)
+
+    def _visit(self, cells, player):
+        i, h = self.player_index(player), board_hash(cells)
+        if self.reachable[i, h]:
+            return
+
+        value, best_mask = self._negamax(cells, player)
+        self.values[i, h] = value
+        self.best_moves[i, h] = best_mask
+        self.reachable[i, h] = True
+
+        if best_mask:
+            # Not a terminal position, so keep exploring
+            for k in range(N_CELLS):
+                if cells[k] == Environment.SYMBOL_EMPTY:
+                    self._visit(cells[:k] + (player,) + cells[k + 1:], -player)
+
+    def value(self, state, player):
+        return int(self.values[self.player_index(player), board_hash(state)])
+
+    def get_best_moves(self, state, player):
+        return MASK_MOVES[self.best_moves[self.player_index(player), board_hash(state)]]
+
+
+_table = None
+
+
+def get_table():
+    # The table is solved just once per process, the first time it is needed
+    global _table
+    if _table is None:
+        _table = PerfectPlayTable()
+    return _table
+
+
+class PerfectAgent(BaseAgent):
+    """Agent that always plays a best move, by looking it up on the perfect play table"""
+    def __init__(self, env, sym=Environment.SYMBOL_X, seed=123):
+        # The table can only be solved for the classic game
+        if (env.board_length, env.win_length) != (Environment.BOARD_LENGTH, Environment.BOARD_LENGTH):
+            raise ValueError("Perfect play is only available for %i in a row on a board of %i x %i cells"
+                             % ((Environment.BOARD_LENGTH,) * 3))
+        BaseAgent.__init__(self, env=env)
+        self.sym = sym
+        self.table = get_table()
+        self.rng = make_rng(seed)
+
+    def side_to_move(self, state):
+        # The player with more symbols on the board played last. With as many symbols of each player,
+        # the one to move is the one that started, which can be any of them (so it must be this agent)
+        balance = sum(state)  # Symbols are -1 for 'x' and 1 for 'o'
+        if balance == 0:
+            return self.sym
+        return Environment.SYMBOL_O if balance < 0 else Environment.SYMBOL_X
+
+    def act(self, state, env_string, explore=True, action_mask=None):
+        if self.side_to_move(state) != self.sym:
+            raise ValueError("Agent plays with '%s', but it's the turn of the other player on board '%s'"
+                             % (Environment.sym_repr[self.sym], env_string))
+
+        moves = self.table.get_best_moves(state, self.sym)
+        assert moves, "No moves available for this state"
+
+        # When exploring, choose randomly among all the best moves to get more diverse games
+        k = moves[self.rng.integers(len(moves))] if explore else moves[0]
+        return Environment.available_actions[k]
+
+    def update(self, state, action, reward, next_state, terminal):
+        pass
+
+    def punish_lost(self):
+        pass
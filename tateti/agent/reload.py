@@ -0,0 +1,141 @@
+# -*- coding: utf-8 -*-
+
+"""Hot reload of the models of agents, to roll out newly trained models without restarting services"""
+
+__author__ = 'leferrad'
+
+from tateti.agent.dqn import DQNAgent
+from tateti.agent.inference import NumpyQNetwork
+from tateti.util.checkpoint import CHECKPOINT_EXTENSION
+from tateti.util.fileio import get_logger
+
+import os
+import threading
+
+
+logger = get_logger(__name__, level="debug")
+
+
+def load_model(filename, inference_only=False):
+    # Load just the model of an agent, from any of the formats supported by the agent services
+    if filename.endswith(CHECKPOINT_EXTENSION):
+        return DQNAgent.load_checkpoint_model(filename, inference_only=inference_only)[0]
+
+    if filename.endswith(".npz"):
+        return NumpyQNetwork.load(filename)
+
+    agent = DQNAgent.load(filename)
+    if agent is None:
+        raise ValueError("Agent couldn't be loaded from '%s'" % filename)
+    return agent.model
+
+
+def are_compatible(model, other):
+    # Models can be swapped if they have the same shapes of weights (i.e. same inputs and outputs)
+    return [w.shape for w in model.get_weights()] == [w.shape for w in other.get_weights()]
+
+
+class ModelReloader(object):
+    """
+    Watch the file of the model of an agent, loading it on a background thread when it changes
+    (or when a reload is requested, e.g. through an MQTT message).
+
+    The model loaded is kept as pending until 'apply_pending' is called by the serving loop
+    between moves, so the swap never happens in the middle of a move and serving never waits for a load.
+    """
+    def __init__(self, agent, filename, poll_interval=5.0, inference_only=False):
+        self.agent = agent
+        self.filename = filename
+        self.poll_interval = poll_interval
+        self.inference_only = inference_only
+
+        self.pending_model = None
+        self.pending_lock = threading.Lock()  # Model is handed over from the watcher thread to the serving one
+        self.last_mtime = self._get_mtime()
+        self.n_reloads = 0
+
+        self.reload_event = threading.Event()
+        self.reload_lock = threading.Lock()  # So requests are never cleared without being seen
+        self.stop_event = threading.Event()
+        self.thread = None
+
+    def _get_mtime(self):
+        try:
+            return os.path.getmtime(self.filename)
+        except OSError:
+            return None
+
+    def request_reload(self):
+        with self.reload_lock:
+            self.reload_event.set()
+
+    def _load(self):
+        try:
+            model = load_model(self.filename, inference_only=self.inference_only)
+        except Exception as e:
+            # The file may be still being written, so it will be retried on the next change
+            logger.error("Model couldn't be loaded from '%s': %s", self.filename, str(e))
+            return
+
+        if not are_compatible(model, self.agent.model):
+            logger.error("Model loaded from '%s' is not compatible with the current one, so it is discarded",
+                         self.filename)
+            return
+
+        with self.pending_lock:
+            # A model still pending is replaced by the newer one
+            self.pending_model = model
+        logger.info("New model loaded from '%s', ready to be swapped in", self.filename)
+
+    def _run(self):
+        while not self.stop_event.is_set():
+            self.reload_event.wait(self.poll_interval)
+            with self.reload_lock:
+                requested = self.reload_event.is_set()
+                self.reload_event.clear()
+
+            mtime = self._get_mtime()
+            if mtime is None:
+                continue
+
+            if requested or mtime != self.last_mtime:
+                self.last_mtime = mtime
+                self._load()
+
+    def apply_pending(self):
+        """
+        Swap in the model loaded, if any. To be called between moves
+
+        :return: boolean, True if a new model was swapped in
+        """
+        with self.pending_lock:
+            model, self.pending_model = self.pending_model, None
+        if model is None:
+            return False
+
+        serving_model = self.agent.serving_model
+        if serving_model is not None and hasattr(serving_model, "swap_model"):
+            # Agent is trained by a background learner, which swaps the model between replays
+            # and publishes its weights
+            serving_model.swap_model(model)
+        else:
+            self.agent.model = model
+            self.agent.weights_version += 1  # Cached Q-values belong to the previous model
+
+        self.n_reloads += 1
+        logger.info("New model swapped in (%i reloads so far)", self.n_reloads)
+        return True
+
+    def start(self):
+        assert self.thread is None, "Reloader already started"
+        self.stop_event.clear()
+        self.thread = threading.Thread(target=self._run, name="model-reloader", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        if self.thread is None:
+            return
+        self.stop_event.set()
+        self.reload_event.set()
+        self.thread.join()
+        self.thread = None
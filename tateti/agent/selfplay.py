@@ -0,0 +1,212 @@
+# -*- coding: utf-8 -*-
+
+"""Parallel self-play, to generate experience on many processes while a central learner trains the agent"""
+
+__author__ = 'leferrad'
+
+from tateti.agent.base import play_one
+from tateti.agent.dqn import DQNAgent
+from tateti.environment.tictactoe import Environment
+from tateti.util.fileio import get_logger
+from tateti.util.rng import spawn_seeds
+
+import functools
+import multiprocessing
+import queue
+
+
+logger = get_logger(__name__, level="debug")
+
+
+def dqn_agent_factory(env, seed=None, phi_function="scaled", **kwargs):
+    # Module-level function, so it can be pickled to be sent to worker processes
+    return DQNAgent(env=env, seed=seed, phi_function=phi_function, **kwargs)
+
+
+class RecordingAgent(object):
+    """Wrapper of an agent that plays as usual, but records its transitions instead of learning from them"""
+    def __init__(self, agent):
+        self.agent = agent
+        self.transitions = []
+
+    def act(self, state, env_string, explore=True, action_mask=None):
+        return self.agent.act(state, env_string, explore=explore, action_mask=action_mask)
+
+    def update(self, state, action, reward, next_state, terminal):
+        self.transitions.append((state, action, reward, next_state, terminal))
+
+    def punish_lost(self):
+        state, action, reward, next_state, terminal = self.transitions[-1]
+        self.transitions[-1] = (state, action, Environment.NEGATIVE_REWARD_LOST, next_state, terminal)
+
+
+def self_play_worker(agent_factory, seed, transitions_queue, weights_queue, stop_event,
+                     board_length=Environment.BOARD_LENGTH, win_length=None):
+    """
+    Loop of a worker process: play games of the agent against itself and send the transitions
+    to the learner, using the last weights (and exploration rate) received from it.
+    """
+    # Independent streams for the environment and the agent, both derived from the seed of the worker
+    env_seed, agent_seed = spawn_seeds(seed, 2)
+    env = Environment(seed=env_seed, board_length=board_length, win_length=win_length)
+    agent = agent_factory(env, seed=agent_seed)
+
+    while not stop_event.is_set():
+        # Keep only the most recent weights published by the learner
+        published = None
+        while True:
+            try:
+                published = weights_queue.get_nowait()
+            except queue.Empty:
+                break
+        if published is not None:
+            weights, epsilon = published
+            agent.model.set_weights(weights)
+            if epsilon is not None:
+                # Workers don't learn, so their exploration rate follows the one of the learner
+                agent.strategy.epsilon = epsilon
+
+        # Each side records its own transitions, so 'punish_lost' affects the right one
+        agent_x, agent_o = RecordingAgent(agent), RecordingAgent(agent)
+        play_one(agent_x, agent_o, env)
+        env.reset()
+
+        transitions_queue.put(agent_x.transitions + agent_o.transitions)
+
+
+class SelfPlayRunner(object):
+    """
+    Run self-play games on 'n_workers' processes, each of them with its own Environment and a
+    read-only copy of the agent's weights. The transitions generated are learned by the agent
+    on the current process, which pushes its updated weights to workers every 'sync_every' steps.
+
+    The agent to be built on workers is given by 'agent_factory', a picklable function that takes
+    an Environment and a seed, and returns an agent (by default, a DQNAgent built with 'agent_kwargs').
+    Every worker gets a child seed spawned from 'seed', so runs are reproducible whatever the number of workers.
+    Games are played on boards of 'board_length' x 'board_length' cells with 'win_length' symbols in a row to win,
+    which must be the size of board of the agent.
+    """
+    def __init__(self, agent, n_workers=4, sync_every=100, agent_kwargs=None, agent_factory=None,
+                 seed=123, start_method="spawn", max_queue_size=1000, board_length=Environment.BOARD_LENGTH,
+                 win_length=None):
+        assert agent.n_actions == board_length ** 2, "Size of board doesn't match the one of the agent"
+
+        if agent_factory is None:
+            agent_factory = functools.partial(dqn_agent_factory, **(agent_kwargs or {}))
+
+        self.agent = agent
+        self.agent_factory = agent_factory
+        self.n_workers = n_workers
+        self.sync_every = sync_every
+        self.seed = seed
+        self.board_length = board_length
+        self.win_length = win_length
+
+        # Spawned processes by default, since forking a process with Keras/TensorFlow loaded is not safe
+        self.context = multiprocessing.get_context(start_method)
+        self.max_queue_size = max_queue_size
+
+        self.transitions_queue = None
+        self.stop_event = None
+        self.workers = []
+        self.weights_queues = []
+
+        self.n_steps = 0
+        self.n_games = 0
+
+    def start(self):
+        self.transitions_queue = self.context.Queue(maxsize=self.max_queue_size)
+        self.stop_event = self.context.Event()
+
+        worker_seeds = spawn_seeds(self.seed, self.n_workers)
+
+        for i in range(self.n_workers):
+            # Room for just one publication of weights, since workers only need the last one
+            weights_queue = self.context.Queue(maxsize=1)
+            worker = self.context.Process(target=self_play_worker,
+                                          args=(self.agent_factory, worker_seeds[i], self.transitions_queue,
+                                                weights_queue, self.stop_event, self.board_length, self.win_length),
+                                          daemon=True)
+            worker.start()
+            self.workers.append(worker)
+            self.weights_queues.append(weights_queue)
+
+        self.push_weights()
+        logger.info("Started %i self-play workers", self.n_workers)
+
+    def push_weights(self):
+        # The learner never blocks here: a worker may be blocked itself on the queue of transitions,
+        # which only the learner drains. Weights not taken yet by a worker are replaced by the new ones
+        published = (self.agent.model.get_weights(), getattr(self.agent.strategy, "epsilon", None))
+        for weights_queue in self.weights_queues:
+            try:
+                weights_queue.get_nowait()
+            except queue.Empty:
+                pass
+
+            try:
+                weights_queue.put_nowait(published)
+            except queue.Full:
+                # Previous weights are still in flight, and the next publication will be received instead
+                pass
+
+    def run(self, n_steps, timeout=60):
+        """
+        Learn from transitions generated by workers
+
+        :param n_steps: number of transitions to learn
+        :param timeout: max seconds to wait for a game from workers
+        :return: number of games learned
+        """
+        assert self.workers, "Runner must be started first"
+
+        n_games = 0
+        steps = 0
+        while steps < n_steps:
+            try:
+                transitions = self.transitions_queue.get(timeout=timeout)
+            except queue.Empty:
+                logger.warning("No games received from workers in %i seconds", timeout)
+                break
+
+            for state, action, reward, next_state, terminal in transitions:
+                self.agent.update(state=state, action=action, reward=reward, next_state=next_state, terminal=terminal)
+
+                self.n_steps += 1
+                steps += 1
+                if self.n_steps % self.sync_every == 0:
+                    self.push_weights()
+
+            n_games += 1
+
+        self.n_games += n_games
+        return n_games
+
+    def stop(self):
+        if self.stop_event is not None:
+            self.stop_event.set()
+
+        # Drain the queue, so workers blocked on it are able to finish
+        while any(w.is_alive() for w in self.workers):
+            try:
+                self.transitions_queue.get(timeout=0.1)
+            except queue.Empty:
+                pass
+
+        for worker in self.workers:
+            worker.join()
+
+        for weights_queue in self.weights_queues:
+            # Weights never received by a worker must not keep this process waiting on exit
+            weights_queue.cancel_join_thread()
+            weights_queue.close()
+
+        self.workers, self.weights_queues = [], []
+        logger.info("Stopped self-play workers")
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stop()
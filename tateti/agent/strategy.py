@@ -9,18 +9,78 @@ __author__ = 'leferrad'
 # - https://sudeepraja.github.io/Bandits/
 # - https://mpatacchiola.github.io/blog/2017/08/14/dissecting-reinforcement-learning-6.html
 
+from tateti.util.rng import make_rng
+
 import numpy as np
 
 
+def masked_argmax(q, legal_mask):
+    # Argmax per row of q (2-D), over the legal actions only
+    return np.argmax(np.where(legal_mask, q, -np.inf), axis=1)
+
+
+def softmax(q, legal_mask=None, temperature=1.0):
+    """
+    Numerically stable softmax per row of q (2-D), giving probability zero to illegal actions
+
+    :param q: numpy.ndarray of shape (n, n_actions)
+    :param legal_mask: numpy.ndarray of booleans with the same shape of q, or None if all actions are legal
+    :param temperature: float, higher values give more uniform probabilities
+    :return: numpy.ndarray of shape (n, n_actions)
+    """
+    z = np.asarray(q, dtype=np.float64) / temperature
+    if legal_mask is not None:
+        z = np.where(legal_mask, z, -np.inf)
+
+    # Subtracting the max per row avoids overflows on the exponential
+    z_max = np.max(z, axis=1, keepdims=True)
+    exp_z = np.exp(z - np.where(np.isfinite(z_max), z_max, 0.0))
+    sum_exp_z = np.sum(exp_z, axis=1, keepdims=True)
+
+    return exp_z / np.where(sum_exp_z > 0, sum_exp_z, 1.0)
+
+
 class Strategy(object):
     def __init__(self, exploit_func, seed=123):
         self.exploit_func = exploit_func
         self.seed = seed
-        np.random.seed(seed)
+        self.rng = make_rng(seed)
+
+    def __setstate__(self, state):
+        # Strategies pickled before having their own generator get one from their seed
+        self.__dict__.update(state)
+        if "rng" not in state:
+            self.rng = make_rng(self.seed)
 
     def sample_action(self, v):
         pass
 
+    def explore_actions(self, q, legal_mask):
+        # Uniform sampling of a legal action per row, through the argmax of random keys
+        return masked_argmax(self.rng.random(q.shape), legal_mask)
+
+    def sample_actions(self, q, legal_mask, explore=True):
+        """
+        Batched version of 'sample_action', sampling one action per row of Q-values at once.
+        Exploitation takes the argmax over legal actions (as 'argmax_value' does for a single row).
+
+        :param q: numpy.ndarray of shape (n, n_actions), Q-values of each state
+        :param legal_mask: numpy.ndarray of booleans with the same shape of q, True for legal actions
+        :param explore: boolean, whether to explore or just exploit
+        :return: numpy.ndarray of n indexes of actions
+        """
+        q = np.atleast_2d(q)
+        legal_mask = np.atleast_2d(legal_mask).astype(bool)
+
+        actions = masked_argmax(q, legal_mask)
+        if explore:
+            # Same criteria of 'sample_action', drawn for all the rows at once
+            explore_rows = self.rng.uniform(0, 1, size=len(q)) > self.epsilon
+            if np.any(explore_rows):
+                actions[explore_rows] = self.explore_actions(q[explore_rows], legal_mask[explore_rows])
+
+        return actions
+
     def update(self):
         pass
 
@@ -34,8 +94,8 @@ class EpsilonGreedy(Strategy):
 
     def sample_action(self, v, explore=True):
         # Assuming as many actions as number of elements in v
-        if explore and np.random.uniform(0, 1) > self.epsilon:
-            a_int = np.random.choice(range(len(v)))
+        if explore and self.rng.uniform(0, 1) > self.epsilon:
+            a_int = self.rng.integers(len(v))
         else:
             a_int = self.exploit_func(v)
 
@@ -60,8 +120,8 @@ class DecayEpsilonGreedy(Strategy):
 
     def sample_action(self, v, explore=True):
         # Assuming as many actions as number of elements in v
-        if explore and np.random.uniform(0, 1) > self.epsilon:
-            a_int = np.random.choice(range(len(v)))
+        if explore and self.rng.uniform(0, 1) > self.epsilon:
+            a_int = self.rng.integers(len(v))
         else:
             a_int = self.exploit_func(v)
 
@@ -76,13 +136,13 @@ class DecayEpsilonGreedy(Strategy):
 
 
 class Boltzmann(Strategy):
-    # TODO: not having deterministic results
-
-    def __init__(self, exploit_func, epsilon=0.9, decay=0.95, epsilon_min=0.05, seed=123):
+    """Boltzmann (a.k.a softmax) exploration, with a temperature to control how greedy it is"""
+    def __init__(self, exploit_func, epsilon=0.9, decay=0.95, epsilon_min=0.05, temperature=1.0, seed=123):
         self.epsilon_init = epsilon
         self.epsilon = epsilon
         self.epsilon_min = epsilon_min
         self.decay = decay
+        self.temperature = temperature
 
         Strategy.__init__(self, exploit_func=exploit_func, seed=seed)
 
@@ -94,28 +154,28 @@ class Boltzmann(Strategy):
         self.epsilon = self.epsilon_init
 
     @staticmethod
-    def get_boltzmann_values(p):
-        max_p = np.max(p)
-        exp_p = [np.exp((p_i - max_p)) for p_i in p]
-        sum_exp_p = np.sum(exp_p)
-        softmax_p = [exp_p_i / sum_exp_p for exp_p_i in exp_p]
-
-        # Fix to have positive values (round error)
-        softmax_p = [np.max((s, 1e-10)) for s in softmax_p]
-
-        # Fix to sum 1 (round error)
-        delta = (1.0 - np.sum(softmax_p)) / len(softmax_p)
-        softmax_p = [s + delta for s in softmax_p]
-
-        return softmax_p
+    def get_boltzmann_values(p, temperature=1.0):
+        return softmax(np.atleast_2d(p), temperature=temperature)[0]
 
     def sample_action(self, v, explore=True):
         # Assuming as many actions as number of elements in v
-        if explore and np.random.uniform(0, 1) > self.epsilon:
+        if explore and self.rng.uniform(0, 1) > self.epsilon:
             # Explore through Boltzmann method
-            probability_actions = self.get_boltzmann_values(v)
-            a_int = np.random.choice(range(len(v)), p=probability_actions)
+            probability_actions = self.get_boltzmann_values(v, temperature=self.temperature)
+            a_int = self.rng.choice(len(v), p=probability_actions)
         else:
             a_int = self.exploit_func(v)
 
         return a_int
+
+    def explore_actions(self, q, legal_mask):
+        # Inverse transform sampling on the cumulative probabilities of each row
+        probability_actions = softmax(q, legal_mask, temperature=self.temperature)
+        cum_probability = np.cumsum(probability_actions, axis=1)
+        u = self.rng.uniform(0, 1, size=(len(q), 1)) * cum_probability[:, -1:]
+        actions = np.sum(cum_probability < u, axis=1)
+
+        # Round errors could lead to an index beyond the last legal action
+        n_actions = q.shape[1]
+        last_legal = n_actions - 1 - np.argmax(legal_mask[:, ::-1], axis=1)
+        return np.minimum(actions, last_legal)
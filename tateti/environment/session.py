@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+
+"""Management of many concurrent games of Tic-Tac-Toe, hosted on a single process"""
+
+__author__ = 'leferrad'
+
+from tateti.environment.tictactoe import Environment
+from tateti.util.rng import make_seed_sequence
+
+from collections import OrderedDict
+import time
+
+
+class GameSession(object):
+    """State of a single game hosted, which is just its environment and the last message reported"""
+    __slots__ = ('game_id', 'env', 'last_message', 'last_active', 'last_published')
+
+    def __init__(self, game_id, env):
+        self.game_id = game_id
+        self.env = env
+        self.last_message = None
+        self.last_active = time.time()
+        self.last_published = 0.0
+
+
+class SessionManager(object):
+    """
+    Sessions of games keyed by a game ID, which are created on demand and evicted once they have been
+    idle for more than 'idle_timeout' seconds, or when there are more than 'max_sessions' of them
+    (in which case the least recently active ones go first).
+    """
+    def __init__(self, max_sessions=10000, idle_timeout=300.0, reward_function='standard', seed=123,
+                 board_length=Environment.BOARD_LENGTH, win_length=None):
+        assert max_sessions > 0
+        self.max_sessions = max_sessions
+        self.idle_timeout = idle_timeout
+        self.reward_function = reward_function
+        self.board_length = board_length
+        self.win_length = win_length
+        self.seed = seed
+        self.seed_sequence = make_seed_sequence(seed)  # Each game gets its own child stream
+
+        self.sessions = OrderedDict()  # Sorted from least to most recently active
+        self.n_created = 0
+        self.n_evicted = 0
+
+    def __len__(self):
+        return len(self.sessions)
+
+    def __contains__(self, game_id):
+        return game_id in self.sessions
+
+    def __iter__(self):
+        return iter(list(self.sessions.values()))
+
+    def get(self, game_id, create=True):
+        """
+        Get the session of a game, marking it as active
+
+        :param game_id: string
+        :param create: boolean, if True then create the session when it doesn't exist
+        :return: tuple of (GameSession or None, boolean flagging if it was just created)
+        """
+        session = self.sessions.get(game_id)
+        created = False
+
+        if session is None:
+            if not create:
+                return None, False
+
+            env = Environment(reward_function=self.reward_function, seed=self.seed_sequence.spawn(1)[0],
+                              board_length=self.board_length, win_length=self.win_length)
+            session = GameSession(game_id, env)
+            self.sessions[game_id] = session
+            self.n_created += 1
+            created = True
+
+            while len(self.sessions) > self.max_sessions:
+                self.sessions.popitem(last=False)
+                self.n_evicted += 1
+        else:
+            self.sessions.move_to_end(game_id)
+
+        session.last_active = time.time()
+        return session, created
+
+    def evict_idle(self, now=None):
+        # Remove sessions without activity for a while, returning the number of sessions removed
+        if now is None:
+            now = time.time()
+
+        n_evicted = 0
+        while self.sessions:
+            session = next(iter(self.sessions.values()))
+            if now - session.last_active <= self.idle_timeout:
+                break
+            self.sessions.popitem(last=False)
+            n_evicted += 1
+
+        self.n_evicted += n_evicted
+        return n_evicted
+
+    def remove(self, game_id):
+        return self.sessions.pop(game_id, None)
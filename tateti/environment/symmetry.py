@@ -0,0 +1,108 @@
+# -*- coding: utf-8 -*-
+
+"""Symmetries of the Tic-Tac-Toe board (rotations and reflections), to identify equivalent states"""
+
+# NOTE: module constants are given for the default board, and functions support any square board
+# through the number of cells of the states (or the argument 'n_cells')
+
+__author__ = 'leferrad'
+
+from tateti.environment.tictactoe import Environment
+
+import numpy as np
+
+import math
+
+
+N_CELLS = Environment.n_dimensions
+POWERS_OF_3 = [3 ** k for k in range(N_CELLS)]
+
+
+def _build_symmetries(length):
+    # Permutations of cells for the 8 symmetries of the square board (i.e. the group D4),
+    # such that transformed[k] = board[perm[k]]. The first one is the identity
+    grid = np.arange(length * length).reshape((length, length))
+    perms = []
+    for k in range(4):
+        rotated = np.rot90(grid, k)
+        perms.append(rotated.ravel())
+        perms.append(np.fliplr(rotated).ravel())
+    return np.asarray(perms)
+
+
+SYMMETRIES = _build_symmetries(Environment.BOARD_LENGTH)
+INVERSE_SYMMETRIES = np.argsort(SYMMETRIES, axis=1)
+
+_SYMMETRIES_LIST = [list(perm) for perm in SYMMETRIES]
+
+# Tables per number of cells of the board, built on demand
+_symmetries = {N_CELLS: (SYMMETRIES, INVERSE_SYMMETRIES, _SYMMETRIES_LIST)}
+_powers_of_3 = {N_CELLS: POWERS_OF_3}
+
+
+def _get_tables(n_cells):
+    tables = _symmetries.get(n_cells)
+    if tables is None:
+        length = math.isqrt(n_cells)
+        assert length ** 2 == n_cells, "Number of cells doesn't correspond to a square board"
+        symmetries = _build_symmetries(length)
+        tables = _symmetries[n_cells] = (symmetries, np.argsort(symmetries, axis=1),
+                                         [list(perm) for perm in symmetries])
+    return tables
+
+
+def get_symmetries(n_cells=N_CELLS):
+    """
+    Permutations of cells for the 8 symmetries of a square board, and their inverses
+
+    :param n_cells: int, number of cells of the board
+    :return: tuple of (symmetries, inverse symmetries), as arrays of shape (8, n_cells)
+    """
+    return _get_tables(n_cells)[:2]
+
+
+def board_hash(state):
+    """
+    Base-3 hash of a board, with one digit per cell (0 for empty, 1 for 'o', 2 for 'x')
+
+    :param state: list of symbols, as given by Environment.get_state()
+    :return: int in range [0, 3 ** n_cells)
+    """
+    powers = _powers_of_3.get(len(state))
+    if powers is None:
+        powers = _powers_of_3[len(state)] = [3 ** k for k in range(len(state))]
+    return sum(p * (int(s) % 3) for (p, s) in zip(powers, state))
+
+
+def canonical_key(state):
+    """
+    Canonical key of a board, shared by all its symmetric equivalents
+
+    :param state: list of symbols, as given by Environment.get_state()
+    :return: tuple of (lowest hash among the symmetric boards, index of the symmetry that leads to it)
+    """
+    state = list(state)
+    symmetries_list = _get_tables(len(state))[2]
+    return min((board_hash([state[k] for k in perm]), t) for (t, perm) in enumerate(symmetries_list))
+
+
+def transform_state(state, t):
+    # Board seen on the frame of symmetry 't' (e.g. the canonical one)
+    state = np.asarray(state)
+    return state[..., _get_tables(state.shape[-1])[0][t]]
+
+
+def transform_action(a, t, n_cells=N_CELLS):
+    # Index of action 'a' on the frame of symmetry 't'
+    return _get_tables(n_cells)[1][t][a]
+
+
+def inverse_transform_action(a, t, n_cells=N_CELLS):
+    # Index of action 'a', given on the frame of symmetry 't', back on the original frame
+    return _get_tables(n_cells)[0][t][a]
+
+
+def inverse_transform_values(v, t):
+    # Values per action (e.g. Q-values), given on the frame of symmetry 't', back on the original frame
+    v = np.asarray(v)
+    return v[..., _get_tables(v.shape[-1])[1][t]]
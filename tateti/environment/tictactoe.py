@@ -6,10 +6,17 @@
 
 __author__ = 'leferrad'
 
+from tateti.util import metrics
+from tateti.util.rng import make_rng
+
 import numpy as np
 
 import copy
 import itertools
+import math
+
+
+TAKE_ACTION_SECONDS = metrics.histogram("tateti_env_take_action_seconds", "Time to take an action on the environment")
 
 
 def standard_reward(env, sym, reward_positive=1, reward_negative=0):
@@ -24,25 +31,145 @@ def standard_reward(env, sym, reward_positive=1, reward_negative=0):
 available_rewards = {'standard': standard_reward}
 
 
+def _build_win_masks(length, win_length):
+    # Bitmasks of every line of 'win_length' consecutive cells (horizontal, vertical or diagonal)
+    # on a board of 'length' x 'length' cells, where cell (i, j) is mapped to the bit i * length + j
+    masks = []
+    for (di, dj) in ((0, 1), (1, 0), (1, 1), (1, -1)):  # rows, columns, diagonals and anti-diagonals
+        for i in range(length):
+            for j in range(length):
+                cells = [(i + n * di, j + n * dj) for n in range(win_length)]
+                if all(0 <= ci < length and 0 <= cj < length for (ci, cj) in cells):
+                    masks.append(sum(1 << (ci * length + cj) for (ci, cj) in cells))
+
+    return tuple(masks)
+
+
+def _build_cell_win_masks(n_cells, win_masks):
+    # For every cell, the winning lines that go through it (i.e. the only ones that a move on it can complete)
+    return tuple(tuple(w for w in win_masks if (w >> k) & 1) for k in range(n_cells))
+
+
+def _build_win_table(length, win_masks):
+    # For every possible bitmask of a single player, flag whether it contains a winning line
+    return [any(m & w == w for w in win_masks) for m in range(1 << (length * length))]
+
+
+def _build_action_masks(n_cells):
+    # For every possible bitmask of empty cells, the boolean mask of legal actions (read-only, since rows are shared)
+    masks = ((np.arange(1 << n_cells)[:, np.newaxis] >> np.arange(n_cells)) & 1).astype(bool)
+    masks.flags.writeable = False
+    return masks
+
+
+def _build_mask_moves(actions):
+    # For every possible bitmask of empty cells, the list of legal actions
+    return [tuple(a for (k, a) in enumerate(actions) if (m >> k) & 1) for m in range(1 << len(actions))]
+
+
+class BoardGeometry(object):
+    """
+    Precomputed data of a board of 'board_length' x 'board_length' cells, where a player wins by getting
+    'win_length' symbols in a row. It is immutable, so it is shared by all the environments of the same size.
+    """
+    # Boards up to this number of cells also get lookup tables indexed by the bitmask of empty cells
+    MAX_TABLE_CELLS = 12
+
+    def __init__(self, board_length, win_length):
+        assert board_length > 0, "Board length must be positive"
+        assert 0 < win_length <= board_length, "Win length must be in range [1, board_length]"
+
+        self.board_length = board_length
+        self.win_length = win_length
+
+        self.available_actions = list(itertools.product(range(board_length), range(board_length)))
+        self.n_actions = len(self.available_actions)
+        self.n_dimensions = board_length ** 2
+
+        self.full_mask = (1 << self.n_dimensions) - 1
+        self.win_masks = _build_win_masks(board_length, win_length)
+        self.cell_win_masks = _build_cell_win_masks(self.n_dimensions, self.win_masks)
+
+        self.action_masks, self.mask_moves = None, None
+        if self.n_dimensions <= self.MAX_TABLE_CELLS:
+            self.action_masks = _build_action_masks(self.n_dimensions)
+            self.mask_moves = _build_mask_moves(self.available_actions)
+
+    def __deepcopy__(self, memo):
+        # Immutable, so copies of environments can keep sharing it
+        return self
+
+
+_geometries = {}
+
+
+def get_geometry(board_length, win_length=None):
+    """
+    Get the (cached) geometry of a board
+
+    :param board_length: int, number of rows and columns of the board
+    :param win_length: int, number of symbols in a row to win (by default, 'board_length')
+    :return: BoardGeometry
+    """
+    if win_length is None:
+        win_length = board_length
+
+    geometry = _geometries.get((board_length, win_length))
+    if geometry is None:
+        geometry = _geometries[(board_length, win_length)] = BoardGeometry(board_length, win_length)
+    return geometry
+
+
 class Environment(object):
-    BOARD_LENGTH = 3  # TODO: parameter of Environment
+    # Default size of board, which is the one of the classic game (3 in a row on a 3 x 3 board)
+    BOARD_LENGTH = 3
     SYMBOL_X = -1
     SYMBOL_O = 1
     SYMBOL_EMPTY = 0
     NEGATIVE_REWARD_LOST = -1.0
 
+    # Attributes of the default board, overridden per instance by the ones of its actual size
     available_actions = list(itertools.product(range(BOARD_LENGTH), range(BOARD_LENGTH)))
     n_actions = len(available_actions)
     n_dimensions = BOARD_LENGTH ** 2
 
     sym_repr = {SYMBOL_X: "x", SYMBOL_O: "o", SYMBOL_EMPTY: " "}
 
-    def __init__(self, reward_function='standard', seed=123):
-        self.board = np.zeros((Environment.BOARD_LENGTH, Environment.BOARD_LENGTH))
+    # Bitboard representation: cell (i, j) is the bit i * BOARD_LENGTH + j of each player mask
+    FULL_MASK = (1 << n_dimensions) - 1
+    WIN_MASKS = _build_win_masks(BOARD_LENGTH, BOARD_LENGTH)
+    WIN_TABLE = _build_win_table(BOARD_LENGTH, WIN_MASKS)
+
+    # Legal moves are given by the bitmask of empty cells, which is kept up to date on every move
+    ACTION_MASKS = _build_action_masks(n_dimensions)
+    MASK_MOVES = _build_mask_moves(available_actions)
+    EMPTY_CELLS_TRANSLATION = str.maketrans({sym_repr[SYMBOL_EMPTY]: "1",
+                                             sym_repr[SYMBOL_X]: "0",
+                                             sym_repr[SYMBOL_O]: "0"})
+    EMPTY_CELL_CODE = ord(sym_repr[SYMBOL_EMPTY])
+
+    def __init__(self, reward_function='standard', seed=123, board_length=BOARD_LENGTH, win_length=None):
+        self.geometry = get_geometry(board_length, win_length)
+        self.board_length = self.geometry.board_length
+        self.win_length = self.geometry.win_length
+        self.available_actions = self.geometry.available_actions
+        self.n_actions = self.geometry.n_actions
+        self.n_dimensions = self.geometry.n_dimensions
+
+        self.x_mask = 0
+        self.o_mask = 0
+        self.empty_mask = self.geometry.full_mask
+
+        # Dense versions of the board, updated on every move so they don't have to be rebuilt from the bitboards
+        self.cells = [self.SYMBOL_EMPTY] * self.n_dimensions
+        self.cells_repr = [self.sym_repr[self.SYMBOL_EMPTY]] * self.n_dimensions
+
+        # Symbol of the player that has a winning line, found when its last move is done
+        self.winner_sym = None
 
         self.winner = None
         self.ended = False
-        self.num_states = 3 ** (Environment.BOARD_LENGTH * Environment.BOARD_LENGTH)
+        self.num_states = 3 ** self.n_dimensions
         
         self.actions_taken = []
         self.score = {k: 0 for k in self.sym_repr.values()}
@@ -50,71 +177,109 @@ class Environment(object):
         assert reward_function in available_rewards
         self.reward_function = lambda sym: available_rewards[reward_function](self, sym)
 
-        # Set seed on random module
+        # Own random generator, so environments don't interfere with each other (seed may also be a SeedSequence)
         self.seed = seed
-        np.random.seed(seed)
+        self.rng = make_rng(seed)
 
         # First player is randomly chosen
-        self.turn = np.random.choice([self.SYMBOL_X, self.SYMBOL_O])
+        self.turn = self.rng.choice([self.SYMBOL_X, self.SYMBOL_O])
+
+    @property
+    def board(self):
+        # Dense copy of the board, just for compatibility with code that inspects the board as an array.
+        # It is read-only so writes on it fail, instead of being silently lost (moves go through 'move')
+        board = np.asarray(self.cells, dtype=float).reshape((self.board_length, self.board_length))
+        board.flags.writeable = False
+        return board
+
+    @board.setter
+    def board(self, board):
+        self.x_mask, self.o_mask = 0, 0
+        for k, x in enumerate(np.asarray(board).ravel()):
+            if x == self.SYMBOL_X:
+                self.x_mask |= 1 << k
+            elif x == self.SYMBOL_O:
+                self.o_mask |= 1 << k
+        self._update_from_masks()
+
+    def _update_from_masks(self):
+        # Rebuild everything derived from the bitboards, scanning all the winning lines
+        self.empty_mask = self.geometry.full_mask & ~(self.x_mask | self.o_mask)
+        self.cells = [self.SYMBOL_X if (self.x_mask >> k) & 1 else self.SYMBOL_O if (self.o_mask >> k) & 1
+                      else self.SYMBOL_EMPTY for k in range(self.n_dimensions)]
+        self.cells_repr = [self.sym_repr[x] for x in self.cells]
+
+        self.winner_sym = None
+        for player, mask in ((self.SYMBOL_X, self.x_mask), (self.SYMBOL_O, self.o_mask)):
+            if any(mask & w == w for w in self.geometry.win_masks):
+                self.winner_sym = player
+                break
 
     def is_empty(self, i, j):
-        return self.board[i, j] == 0
+        return (self.empty_mask >> (i * self.board_length + j)) & 1 == 1
+
+    def is_legal(self, action):
+        i, j = action
+        return 0 <= i < self.board_length and 0 <= j < self.board_length and self.is_empty(i, j)
 
     def is_draw(self):
         return self.ended and self.winner is None
 
     def get_state(self):
-        return [int(x) for x in np.nditer(self.board)]
+        return list(self.cells)
 
     def get_env_string(self):
-        return "".join([self.sym_repr[x] for x in self.get_state()])
+        return "".join(self.cells_repr)
 
     def get_possible_moves(self):
-        return [(i, j) for (i, j) in self.available_actions if self.is_empty(i, j)]
+        if self.geometry.mask_moves is not None:
+            return list(self.geometry.mask_moves[self.empty_mask])
+        return [self.available_actions[k] for k in np.flatnonzero(self.get_action_mask())]
+
+    def get_action_mask(self):
+        # Boolean array with an element per action, flagging the legal ones
+        if self.geometry.action_masks is not None:
+            return self.geometry.action_masks[self.empty_mask]  # read-only
+        # Bits of the empty mask, unpacked from its bytes (the first cell is the least significant bit)
+        n = self.n_dimensions
+        mask_bytes = np.frombuffer(self.empty_mask.to_bytes((n + 7) // 8, "little"), dtype=np.uint8)
+        return np.unpackbits(mask_bytes, count=n, bitorder="little").astype(bool)
+
+    @staticmethod
+    def get_empty_mask_from_str(env_str):
+        # Bit k of the mask is set if cell k is empty (the first cell is the least significant bit)
+        return int(env_str.translate(Environment.EMPTY_CELLS_TRANSLATION)[::-1], 2)
+
+    @staticmethod
+    def get_action_mask_from_str(env_str):
+        # The size of the board is given by the length of the string
+        if len(env_str) == Environment.n_dimensions:
+            return Environment.ACTION_MASKS[Environment.get_empty_mask_from_str(env_str)]
+        return np.frombuffer(env_str.encode("ascii"), dtype=np.uint8) == Environment.EMPTY_CELL_CODE
 
     @staticmethod
     def get_possible_moves_from_str(env_str):
-        return list(map(lambda x_a: x_a[1],  # Get corresponding action
-                        filter(lambda x_a: x_a[0] == " ",  # Get only empty cells
-                               # x_a: tuple of (element of cell, action)
-                               zip(env_str, Environment.available_actions))))
+        if len(env_str) == Environment.n_dimensions:
+            return list(Environment.MASK_MOVES[Environment.get_empty_mask_from_str(env_str)])
+
+        board_length = math.isqrt(len(env_str))
+        assert board_length ** 2 == len(env_str), "String of environment doesn't represent a square board"
+        empty = Environment.sym_repr[Environment.SYMBOL_EMPTY]
+        return [divmod(k, board_length) for (k, s) in enumerate(env_str) if s == empty]
 
     def game_over(self):
         # returns true if game over (a player has won or it's a draw)
         # otherwise returns false
         # also sets 'winner' instance variable and 'ended' instance variable
 
-        # check rows
-        for i in range(Environment.BOARD_LENGTH):
-            for player in (self.SYMBOL_X, self.SYMBOL_O):
-                if self.board[i].sum() == player * Environment.BOARD_LENGTH:
-                    self.winner = self.sym_repr[player]
-                    self.ended = True
-                    return True
-
-        # check columns
-        for j in range(Environment.BOARD_LENGTH):
-            for player in (self.SYMBOL_X, self.SYMBOL_O):
-                if self.board[:, j].sum() == player * Environment.BOARD_LENGTH:
-                    self.winner = self.sym_repr[player]
-                    self.ended = True
-                    return True
-
-        # check diagonals
-        for player in (self.SYMBOL_X, self.SYMBOL_O):
-            # top-left -> bottom-right diagonal
-            if self.board.trace() == player * Environment.BOARD_LENGTH:
-                self.winner = self.sym_repr[player]
-                self.ended = True
-                return True
-            # top-right -> bottom-left diagonal
-            if np.fliplr(self.board).trace() == player * Environment.BOARD_LENGTH:
-                self.winner = self.sym_repr[player]
-                self.ended = True
-                return True
+        # winning lines are checked on every move, just through the cell played (see 'move')
+        if self.winner_sym is not None:
+            self.winner = self.sym_repr[self.winner_sym]
+            self.ended = True
+            return True
 
         # check if draw
-        if not np.any(self.board == 0):
+        if self.empty_mask == 0:
             # winner stays None
             self.winner = None
             self.ended = True
@@ -134,26 +299,53 @@ class Environment(object):
         # |   |   | o |
         # -------------
 
-        for i in range(Environment.BOARD_LENGTH):
-            logger_func("-------------")
-            line = "|".join([" " + self.sym_repr[s] + " " for s in [self.board[i, j]
-                                                                    for j in range(Environment.BOARD_LENGTH)]])
+        separator = "-" * (4 * self.board_length + 1)
+        for i in range(self.board_length):
+            logger_func(separator)
+            line = "|".join([" " + s + " " for s in self.cells_repr[i * self.board_length:(i + 1) * self.board_length]])
             line = '|'+line+'|'
             logger_func(line)
 
-        logger_func("-------------")
+        logger_func(separator)
 
     def move(self, sym, i, j):
         # Assert correct input
-        assert i in range(Environment.BOARD_LENGTH)
-        assert j in range(Environment.BOARD_LENGTH)
+        assert i in range(self.board_length)
+        assert j in range(self.board_length)
         assert sym in (Environment.SYMBOL_X, Environment.SYMBOL_O)
 
-        self.board[i, j] = sym
-
+        k = i * self.board_length + j
+        bit = 1 << k
+        if sym == Environment.SYMBOL_X:
+            overwritten = self.o_mask & bit
+            self.x_mask |= bit
+            self.o_mask &= ~bit
+            mask = self.x_mask
+            sym = Environment.SYMBOL_X  # Plain int on the state, even if 'sym' is a NumPy one
+        else:
+            overwritten = self.x_mask & bit
+            self.o_mask |= bit
+            self.x_mask &= ~bit
+            mask = self.o_mask
+            sym = Environment.SYMBOL_O
+        self.empty_mask &= ~bit
+        self.cells[k] = sym
+        self.cells_repr[k] = self.sym_repr[sym]
+
+        if overwritten:
+            # The opponent may have lost a winning line, so all of them have to be checked again
+            self._update_from_masks()
+        elif self.winner_sym is None:
+            # Just the lines through this cell can have been completed by the move
+            for w in self.geometry.cell_win_masks[k]:
+                if mask & w == w:
+                    self.winner_sym = sym
+                    break
+
+    @metrics.timed(TAKE_ACTION_SECONDS)
     def take_action(self, sym, action):
         assert sym == self.turn
-        assert action in self.get_possible_moves()
+        assert self.is_legal(action)
 
         # Then this is a legal action that will be taken on the env
         i, j = action
@@ -174,9 +366,8 @@ class Environment(object):
         winner = self.winner if self.winner is not None else self.sym_repr[self.SYMBOL_EMPTY]
         self.score[winner] += 1
 
-    @staticmethod
-    def sample_action():
-        return np.random.choice(list(Environment.available_actions))
+    def sample_action(self):
+        return self.available_actions[self.rng.integers(self.n_actions)]
 
     def render(self):
         return self.draw_board(print)
@@ -185,11 +376,15 @@ class Environment(object):
         return copy.deepcopy(self) if deep else copy.copy(self)
 
     def reset(self):
-        self.board = np.zeros((Environment.BOARD_LENGTH, Environment.BOARD_LENGTH))
+        self.x_mask = 0
+        self.o_mask = 0
+        self.empty_mask = self.geometry.full_mask
+        self.cells = [self.SYMBOL_EMPTY] * self.n_dimensions
+        self.cells_repr = [self.sym_repr[self.SYMBOL_EMPTY]] * self.n_dimensions
+        self.winner_sym = None
         self.actions_taken = []
         self.ended = False
         self.winner = None
 
         # First player is randomly chosen
-        self.turn = np.random.choice([self.SYMBOL_X, self.SYMBOL_O])
-
+        self.turn = self.rng.choice([self.SYMBOL_X, self.SYMBOL_O])
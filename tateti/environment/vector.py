@@ -0,0 +1,136 @@
+# -*- coding: utf-8 -*-
+
+"""Vectorized version of the environment, to run many games of Tic-Tac-Toe in lockstep"""
+
+__author__ = 'leferrad'
+
+from tateti.environment.tictactoe import Environment, get_geometry
+from tateti.util.rng import make_rng
+
+import numpy as np
+
+
+def standard_batch_reward(winners, syms, reward_positive=1, reward_negative=0):
+    # Batched version of 'standard_reward': positive reward only for the players that have just won
+    return np.where(winners == syms, reward_positive, reward_negative).astype(float)
+
+
+available_batch_rewards = {'standard': standard_batch_reward}
+
+
+def _mask_cells(mask, n_cells):
+    # Indexes of the cells set on a bitmask
+    return [k for k in range(n_cells) if (mask >> k) & 1]
+
+
+class VectorEnvironment(object):
+    def __init__(self, n_envs, reward_function='standard', seed=123, board_length=Environment.BOARD_LENGTH,
+                 win_length=None):
+        assert n_envs > 0
+        self.n_envs = n_envs
+
+        self.geometry = get_geometry(board_length, win_length)
+        self.board_length = self.geometry.board_length
+        self.win_length = self.geometry.win_length
+        self.available_actions = self.geometry.available_actions
+        self.n_actions = self.geometry.n_actions
+        self.n_dimensions = self.geometry.n_dimensions
+
+        # Indexes of cells for every winning line, over the flattened board
+        self.win_lines = np.asarray([_mask_cells(w, self.n_dimensions) for w in self.geometry.win_masks])
+
+        # Winning lines through each cell, padded to the same number per cell by repeating the first one
+        # (so a move only requires checking the lines of the cell played)
+        cell_lines = [[_mask_cells(w, self.n_dimensions) for w in masks] for masks in self.geometry.cell_win_masks]
+        max_lines = max(len(lines) for lines in cell_lines)
+        self.cell_win_lines = np.asarray([lines + lines[:1] * (max_lines - len(lines)) for lines in cell_lines])
+
+        # One flattened board per row, with the same encoding as 'Environment.get_state()'
+        self.boards = np.zeros((n_envs, self.n_dimensions), dtype=np.int8)
+        self.n_moves = np.zeros(n_envs, dtype=np.int32)
+        self.turns = np.empty(n_envs, dtype=np.int8)
+        self.last_winners = np.zeros(n_envs, dtype=np.int8)
+
+        self.score = {k: 0 for k in Environment.sym_repr.values()}
+
+        assert reward_function in available_batch_rewards
+        self.reward_function = available_batch_rewards[reward_function]
+
+        self.seed = seed
+        self.rng = make_rng(seed)
+
+        self.reset()
+
+    def reset(self, slots=None):
+        # Reset the given slots (all of them by default), choosing the first player randomly
+        if slots is None:
+            slots = np.arange(self.n_envs)
+
+        self.boards[slots] = Environment.SYMBOL_EMPTY
+        self.n_moves[slots] = 0
+        self.turns[slots] = self.rng.choice([Environment.SYMBOL_X, Environment.SYMBOL_O], size=len(slots))
+
+    def get_states(self):
+        return self.boards.copy()
+
+    def get_env_strings(self):
+        return ["".join([Environment.sym_repr[x] for x in board]) for board in self.boards]
+
+    def get_action_masks(self):
+        # Boolean array of shape (n_envs, n_actions), flagging legal moves per board
+        return self.boards == Environment.SYMBOL_EMPTY
+
+    def get_winners(self, boards=None):
+        # Symbol of the winner per board, or SYMBOL_EMPTY if there is no winner
+        if boards is None:
+            boards = self.boards
+
+        line_sums = boards[:, self.win_lines].sum(axis=2, dtype=np.int32)
+        winners = np.full(len(boards), Environment.SYMBOL_EMPTY, dtype=np.int8)
+        for player in (Environment.SYMBOL_X, Environment.SYMBOL_O):
+            winners[np.any(line_sums == player * self.win_length, axis=1)] = player
+
+        return winners
+
+    def _get_move_winners(self, actions, syms):
+        # Like 'get_winners', but just checking the lines through the cells just played by 'syms'
+        lines = self.boards[np.arange(self.n_envs)[:, np.newaxis, np.newaxis], self.cell_win_lines[actions]]
+        won = np.any(np.all(lines == syms[:, np.newaxis, np.newaxis], axis=2), axis=1)
+        return np.where(won, syms, Environment.SYMBOL_EMPTY).astype(np.int8)
+
+    def take_action(self, actions):
+        """
+        Perform one move on every board, for the player that has the turn on each of them.
+        The boards that reach a game over are automatically reset after the move.
+
+        :param actions: array of shape (n_envs,), with indexes of 'available_actions'
+        :return: tuple of (next states, rewards, dones, turns), with one row per board
+        """
+        actions = np.asarray(actions)
+        assert actions.shape == (self.n_envs,)
+
+        slots = np.arange(self.n_envs)
+        assert np.all(self.boards[slots, actions] == Environment.SYMBOL_EMPTY), "Illegal action on some board"
+
+        syms = self.turns.copy()
+        self.boards[slots, actions] = syms
+        self.n_moves += 1
+
+        winners = self._get_move_winners(actions, syms)
+        dones = (winners != Environment.SYMBOL_EMPTY) | (self.n_moves == self.n_dimensions)
+        rewards = self.reward_function(winners, syms)
+
+        next_states = self.boards.copy()
+        self.turns = -syms  # Symbols of players are opposite numbers
+        self.last_winners = np.where(dones, winners, Environment.SYMBOL_EMPTY).astype(np.int8)
+
+        done_slots = np.flatnonzero(dones)
+        if len(done_slots):
+            self._update_score(self.last_winners[done_slots])
+            self.reset(done_slots)
+
+        return next_states, rewards, dones, self.turns.copy()
+
+    def _update_score(self, winners):
+        for player in (Environment.SYMBOL_X, Environment.SYMBOL_O, Environment.SYMBOL_EMPTY):
+            self.score[Environment.sym_repr[player]] += int(np.sum(winners == player))
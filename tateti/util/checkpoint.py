@@ -0,0 +1,114 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Checkpoint format to store arrays (e.g. model weights) in a file that can be memory-mapped without copies"""
+
+__author__ = 'leferrad'
+
+import numpy as np
+
+from collections import OrderedDict
+import contextlib
+import json
+import os
+import struct
+
+
+# Layout of a checkpoint file:
+# - preamble: magic bytes, format version and length of the header (little-endian uint32 each)
+# - header: JSON document with the metadata given, plus the dtype, shape and offset of each array
+# - data: contiguous buffer of each array, aligned to ALIGNMENT bytes
+MAGIC = b"TTCKPT\x00\x00"
+FORMAT_VERSION = 1
+PREAMBLE = struct.Struct("<8sII")
+ALIGNMENT = 64
+
+CHECKPOINT_EXTENSION = ".ckpt"
+
+
+def _align(offset):
+    return (offset + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+
+def write_checkpoint(filename, arrays, metadata=None):
+    """
+    Write arrays and metadata into a checkpoint file
+
+    :param filename: string
+    :param arrays: dict of name -> numpy.ndarray (order is kept)
+    :param metadata: dict, JSON serializable
+    """
+    arrays = OrderedDict((name, np.ascontiguousarray(a)) for (name, a) in arrays.items())
+
+    # Offsets depend on the header size, which depends on the offsets, so give the header a fixed upper bound
+    entries = [{"name": name, "dtype": a.dtype.str, "shape": list(a.shape), "offset": 0}
+               for (name, a) in arrays.items()]
+    header = {"metadata": metadata or {}, "arrays": entries}
+    max_offset_digits = 20
+    header_size = len(json.dumps(header).encode("utf-8")) + len(entries) * max_offset_digits
+
+    offset = _align(PREAMBLE.size + header_size)
+    for entry, a in zip(entries, arrays.values()):
+        entry["offset"] = offset
+        offset = _align(offset + a.nbytes)
+
+    header_bytes = json.dumps(header).encode("utf-8")
+    header_bytes += b" " * (header_size - len(header_bytes))
+
+    # Written on a temporary file that then replaces the checkpoint, so readers (e.g. a reloader) never
+    # see a half-written file, and processes with the previous file mapped on memory keep their own copy
+    tmp_filename = filename + ".tmp"
+    try:
+        with open(tmp_filename, "wb") as f:
+            f.write(PREAMBLE.pack(MAGIC, FORMAT_VERSION, len(header_bytes)))
+            f.write(header_bytes)
+            for entry, a in zip(entries, arrays.values()):
+                f.write(b"\x00" * (entry["offset"] - f.tell()))
+                f.write(a.tobytes())
+        os.replace(tmp_filename, filename)
+    except BaseException:
+        # The temporary file doesn't exist if it couldn't be even created (e.g. missing directory)
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(tmp_filename)
+        raise
+
+
+def read_checkpoint_header(filename):
+    with open(filename, "rb") as f:
+        preamble = f.read(PREAMBLE.size)
+        if len(preamble) < PREAMBLE.size:
+            raise ValueError("File '%s' is not a checkpoint" % filename)
+
+        magic, version, header_size = PREAMBLE.unpack(preamble)
+        if magic != MAGIC:
+            raise ValueError("File '%s' is not a checkpoint" % filename)
+        if version > FORMAT_VERSION:
+            raise ValueError("Checkpoint format version %i not supported (max: %i)" % (version, FORMAT_VERSION))
+
+        return json.loads(f.read(header_size).decode("utf-8"))
+
+
+def read_checkpoint(filename, mmap=True):
+    """
+    Read arrays and metadata from a checkpoint file
+
+    :param filename: string
+    :param mmap: boolean, if True then arrays are read-only views of the file mapped on memory (no copies)
+    :return: tuple of (dict of name -> numpy.ndarray, dict of metadata)
+    """
+    header = read_checkpoint_header(filename)
+
+    if mmap:
+        buffer = np.memmap(filename, dtype=np.uint8, mode="r")
+    else:
+        with open(filename, "rb") as f:
+            buffer = f.read()
+
+    arrays = OrderedDict()
+    for entry in header["arrays"]:
+        dtype = np.dtype(entry["dtype"])
+        count = int(np.prod(entry["shape"]))
+        arrays[entry["name"]] = np.frombuffer(buffer, dtype=dtype, count=count,
+                                              offset=entry["offset"]).reshape(entry["shape"])
+
+    return arrays, header["metadata"]
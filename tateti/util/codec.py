@@ -0,0 +1,207 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Codecs for the messages exchanged between environment and agents through MQTT"""
+
+__author__ = 'leferrad'
+
+import json
+import math
+import struct
+
+
+# Binary format: header of (magic, version, kind), followed by the fields of the kind of message.
+# The board is packed with 2 bits per cell (0: empty, 1: 'o', 2: 'x'), and a game ID may be appended at the end.
+# Version 1 is for boards of 3 x 3 cells, and version 2 for any square board, which is packed at the end
+# of the fields (after its number of cells). Boards of 3 x 3 cells are still encoded with version 1,
+# so they can be decoded by older services.
+# There is no negotiation of versions between services: decoders just check the version byte, and reject
+# messages of versions they don't support (so services have to be upgraded before peers send a new version)
+BINARY_MAGIC = 0xB7
+BINARY_VERSION = 2
+SUPPORTED_BINARY_VERSIONS = (1, 2)
+
+KIND_ENV = 1  # Status of the environment: state, reward, is_over, turn
+KIND_ACTION = 2  # Action requested by an agent: action, env_str, sym
+
+N_CELLS = 9
+BOARD_LENGTH = 3
+
+HEADER = struct.Struct("<BBB")
+ENV_FIELDS = struct.Struct("<3sBBf")  # board, turn, is_over, reward
+ACTION_FIELDS = struct.Struct("<3sBB")  # board, action index, sym
+ENV_FIELDS_V2 = struct.Struct("<HBBf")  # number of cells, turn, is_over, reward (+ board)
+ACTION_FIELDS_V2 = struct.Struct("<HHB")  # number of cells, action index, sym (+ board)
+
+SYMBOLS = " ox"  # Symbol per cell code
+CELL_CODES = {s: c for (c, s) in enumerate(SYMBOLS)}
+
+
+def board_size(n_cells):
+    # Number of bytes of a packed board
+    return (2 * n_cells + 7) // 8
+
+
+def board_length(n_cells):
+    length = math.isqrt(n_cells)
+    if length ** 2 != n_cells:
+        raise ValueError("Board of %i cells is not square" % n_cells)
+    return length
+
+
+def pack_board(env_str):
+    value = 0
+    for k, s in enumerate(env_str):
+        value |= CELL_CODES[s] << (2 * k)
+    return value.to_bytes(board_size(len(env_str)), "little")
+
+
+def unpack_board(data, n_cells=N_CELLS):
+    value = int.from_bytes(data, "little")
+    return "".join(SYMBOLS[(value >> (2 * k)) & 3] for k in range(n_cells))
+
+
+def state_from_env_str(env_str):
+    # Same encoding as Environment.get_state(): -1 for 'x', 1 for 'o' and 0 for empty cells
+    return [{"x": -1, "o": 1, " ": 0}[s] for s in env_str]
+
+
+def _pack_game_id(msg):
+    if "game_id" not in msg:
+        return b""
+    game_id = str(msg["game_id"]).encode("utf-8")
+    assert len(game_id) < 256, "Game ID too long"
+    return struct.pack("<B", len(game_id)) + game_id
+
+
+def _unpack_game_id(data, msg):
+    if data:
+        n = data[0]
+        msg["game_id"] = data[1:1 + n].decode("utf-8")
+    return msg
+
+
+def _unpack_board_bytes(payload, offset, n_cells):
+    # Board packed at the end of the fields of version 2, followed by the optional game ID
+    if n_cells == 0:
+        raise ValueError("Binary message with an empty board")
+    end = offset + board_size(n_cells)
+    if len(payload) < end:
+        raise ValueError("Binary message truncated: board of %i cells doesn't fit" % n_cells)
+    return payload[offset:end], end
+
+
+def encode_binary(msg):
+    n_cells = len(msg["env_str"])
+    if n_cells == N_CELLS:
+        return _encode_binary_v1(msg)
+
+    length, board = board_length(n_cells), pack_board(msg["env_str"])
+    if "action" in msg:
+        i, j = msg["action"]
+        fields = ACTION_FIELDS_V2.pack(n_cells, i * length + j, CELL_CODES[msg.get("sym", " ")]) + board
+        kind = KIND_ACTION
+    else:
+        fields = ENV_FIELDS_V2.pack(n_cells, CELL_CODES[msg["turn"]], int(msg["is_over"]), msg["reward"]) + board
+        kind = KIND_ENV
+
+    return HEADER.pack(BINARY_MAGIC, BINARY_VERSION, kind) + fields + _pack_game_id(msg)
+
+
+def _encode_binary_v1(msg):
+    if "action" in msg:
+        i, j = msg["action"]
+        fields = ACTION_FIELDS.pack(pack_board(msg["env_str"]), i * BOARD_LENGTH + j, CELL_CODES[msg.get("sym", " ")])
+        kind = KIND_ACTION
+    else:
+        fields = ENV_FIELDS.pack(pack_board(msg["env_str"]), CELL_CODES[msg["turn"]], int(msg["is_over"]),
+                                 msg["reward"])
+        kind = KIND_ENV
+
+    return HEADER.pack(BINARY_MAGIC, 1, kind) + fields + _pack_game_id(msg)
+
+
+def decode_binary(payload):
+    try:
+        return _decode_binary(payload)
+    except (struct.error, IndexError, ZeroDivisionError) as e:
+        # e.g. truncated payloads, or codes of symbols out of range
+        raise ValueError("Malformed binary message: %s" % str(e))
+
+
+def _decode_binary(payload):
+    magic, version, kind = HEADER.unpack_from(payload)
+    if magic != BINARY_MAGIC:
+        raise ValueError("Binary message with a wrong magic byte: %i" % magic)
+    if version not in SUPPORTED_BINARY_VERSIONS:
+        raise ValueError("Binary message version %i not supported" % version)
+
+    offset = HEADER.size
+    if kind == KIND_ACTION:
+        if version == 1:
+            board, action, sym = ACTION_FIELDS.unpack_from(payload, offset)
+            n_cells, offset = N_CELLS, offset + ACTION_FIELDS.size
+        else:
+            n_cells, action, sym = ACTION_FIELDS_V2.unpack_from(payload, offset)
+            offset += ACTION_FIELDS_V2.size
+            board, offset = _unpack_board_bytes(payload, offset, n_cells)
+        msg = {"action": divmod(action, board_length(n_cells)), "env_str": unpack_board(board, n_cells)}
+        if sym != CELL_CODES[" "]:
+            msg["sym"] = SYMBOLS[sym]
+    elif kind == KIND_ENV:
+        if version == 1:
+            board, turn, is_over, reward = ENV_FIELDS.unpack_from(payload, offset)
+            n_cells, offset = N_CELLS, offset + ENV_FIELDS.size
+        else:
+            n_cells, turn, is_over, reward = ENV_FIELDS_V2.unpack_from(payload, offset)
+            offset += ENV_FIELDS_V2.size
+            board, offset = _unpack_board_bytes(payload, offset, n_cells)
+        env_str = unpack_board(board, n_cells)
+        msg = {"state": state_from_env_str(env_str), "reward": reward, "is_over": is_over,
+               "turn": SYMBOLS[turn], "env_str": env_str}
+    else:
+        raise ValueError("Kind of binary message not supported: %i" % kind)
+
+    return _unpack_game_id(payload[offset:], msg)
+
+
+def encode_json(msg):
+    return json.dumps(msg).encode("utf-8")
+
+
+def decode_json(payload):
+    msg = json.loads(payload.decode())
+    if not isinstance(msg, dict):
+        raise ValueError("JSON message is not an object")
+    return msg
+
+
+available_codecs = {"json": (encode_json, decode_json),
+                    "binary": (encode_binary, decode_binary)}
+
+
+def detect_codec(payload):
+    # Binary messages start with a magic byte that can't be the beginning of a JSON document
+    return "binary" if payload and payload[0] == BINARY_MAGIC else "json"
+
+
+def encode_message(msg, codec="json"):
+    """
+    Encode a message to be sent through MQTT
+
+    :param msg: dict, message of the environment or of an agent
+    :param codec: string, one of 'available_codecs'
+    :return: bytes
+    """
+    return available_codecs[codec][0](msg)
+
+
+def decode_message(payload):
+    """
+    Decode a message received through MQTT, detecting the codec used to encode it
+
+    :param payload: bytes
+    :return: dict
+    :raises ValueError: if the payload is malformed (e.g. corrupt, truncated, or of a version not supported)
+    """
+    return available_codecs[detect_codec(payload)][1](payload)
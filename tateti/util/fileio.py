@@ -1,47 +1,84 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
+import atexit
 import logging
 import logging.handlers
 import json
 import pickle
+import queue
 import tarfile
+import time
 import os
 
 
+# Settings shared by all the loggers obtained through 'get_logger', which can be changed with 'configure_logging'
+_logging_settings = {"production": False, "async_sink": False}
+_levels_requested = {}  # Level requested per logger name
+_handler = None
+_listener = None
+
+levels = {'debug': logging.DEBUG,
+          'info': logging.INFO,
+          'warning': logging.WARNING,
+          'error': logging.ERROR}
+
+# Min level of loggers in production mode, where debug messages are dropped before being formatted
+PRODUCTION_LEVEL = logging.INFO
+
+
+def _get_handler():
+    # Single handler for all the loggers, so getting a logger many times never duplicates its output
+    global _handler, _listener
+
+    if _handler is None:
+        formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+
+        # create console handler and set level to debug
+        ch = logging.StreamHandler()
+        ch.setLevel(logging.DEBUG)
+        ch.setFormatter(formatter)
+
+        if _logging_settings["async_sink"]:
+            # Callers just enqueue records, which are formatted and written by a background thread
+            log_queue = queue.Queue(-1)
+            _listener = logging.handlers.QueueListener(log_queue, ch, respect_handler_level=True)
+            _listener.start()
+            _handler = logging.handlers.QueueHandler(log_queue)
+        else:
+            _handler = ch
+
+    return _handler
+
+
+def _get_level(name):
+    level = _levels_requested[name]
+    if _logging_settings["production"]:
+        level = max(level, PRODUCTION_LEVEL)
+    return level
+
+
 def get_logger(name='tateti', level='debug', disabled=False):
     """
     Function to obtain a normal logger
 
     :param name: string
-    :param level: string, which can be 'info' or 'debug'
+    :param level: string, which can be 'debug', 'info', 'warning' or 'error'
     :param disabled: boolean, if True then the logger won't print anything
     :return: logging.Logger
     """
 
-    levels = {'info': logging.INFO,
-              'debug': logging.DEBUG}
-
     # If the level is not supported, then force it to be info
     if level not in levels:
         level = 'info'
-    level = levels[level]
+    _levels_requested[name] = levels[level]
 
     logger = logging.getLogger(name)
-    logger.setLevel(level)
-
-    # create formatter
-    formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    logger.setLevel(_get_level(name))
 
-    # create console handler and set level to debug
-    ch = logging.StreamHandler()
-    ch.setLevel(logging.DEBUG)
-
-    # add formatter to ch
-    ch.setFormatter(formatter)
-
-    # add ch to logger
-    logger.addHandler(ch)
+    handler = _get_handler()
+    if handler not in logger.handlers:
+        logger.addHandler(handler)
 
     # Finally, use this flag to easily disable logging if required
     logger.disabled = disabled
@@ -49,6 +86,90 @@ def get_logger(name='tateti', level='debug', disabled=False):
     return logger
 
 
+def configure_logging(production=False, async_sink=False):
+    """
+    Configure all the loggers obtained through 'get_logger' (before or after calling this function)
+
+    :param production: boolean, if True then debug messages are dropped whatever the level requested by modules
+    :param async_sink: boolean, if True then records are written by a background thread through a QueueHandler,
+                       so logging doesn't block the caller on I/O
+    """
+    global _handler, _listener
+
+    previous_handler, previous_listener = _handler, _listener
+
+    _logging_settings["production"] = production
+    _logging_settings["async_sink"] = async_sink
+
+    if async_sink != isinstance(previous_handler, logging.handlers.QueueHandler):
+        _handler, _listener = None, None
+
+    handler = _get_handler()
+    for name in _levels_requested:
+        logger = logging.getLogger(name)
+        logger.setLevel(_get_level(name))
+        if previous_handler is not handler and previous_handler in logger.handlers:
+            logger.removeHandler(previous_handler)
+        if handler not in logger.handlers:
+            logger.addHandler(handler)
+
+    if previous_listener is not None and previous_listener is not _listener:
+        # Flush the records still queued on the previous sink
+        previous_listener.stop()
+
+
+def stop_logging():
+    # Flush the records queued on the async sink (if any), e.g. before exiting
+    if _listener is not None:
+        _listener.stop()
+
+
+class RateLimiter(object):
+    """
+    Allow an action at most once every 'interval' seconds, e.g. to sample expensive log messages
+    (such as dumps of the board) on hot loops
+    """
+    def __init__(self, interval=1.0):
+        self.interval = interval
+        self.last_allowed = None
+        self.n_skipped = 0
+
+    def allow(self, now=None):
+        now = time.time() if now is None else now
+        if self.last_allowed is not None and now - self.last_allowed < self.interval:
+            self.n_skipped += 1
+            return False
+
+        self.last_allowed = now
+        return True
+
+
+def add_logging_arguments(parser):
+    # Arguments shared by services to configure logging
+    parser.add_argument('-lp', '--log-production', dest='log_production', action='store_true',
+                        help='Production logging: drop debug messages and sample the dumps of boards')
+    parser.add_argument('-la', '--log-async', dest='log_async', action='store_true',
+                        help='Write logs from a background thread, so the main loop never blocks on logging')
+
+
+def configure_logging_from_args(args):
+    """
+    Configure logging as requested by the arguments of 'add_logging_arguments'
+
+    :param args: argparse.Namespace, with an optional 'board_interval' (min seconds between dumps of the board)
+    :return: RateLimiter, for the dumps of boards
+    """
+    configure_logging(production=args.log_production, async_sink=args.log_async)
+    if args.log_async:
+        atexit.register(stop_logging)
+
+    board_interval = getattr(args, "board_interval", None)
+    if board_interval is None:
+        board_interval = 10.0 if args.log_production else 0.0
+
+    return RateLimiter(interval=board_interval)
+
+
 def serialize_python_object(obj, filename):
     try:
         with open(filename, 'wb') as f:
@@ -0,0 +1,362 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Lightweight metrics (counters, gauges, histograms and timers) and profiling hooks for the hot paths"""
+
+__author__ = 'leferrad'
+
+from tateti.util.fileio import get_logger
+
+import atexit
+import bisect
+import cProfile
+import functools
+import json
+import os
+import pstats
+import signal
+import sys
+import threading
+import time
+
+
+logger = get_logger(__name__, level="debug")
+
+# Buckets in seconds, from tens of microseconds (e.g. a move on the environment) to seconds (e.g. a replay)
+DEFAULT_BUCKETS = (1e-5, 2.5e-5, 5e-5, 1e-4, 2.5e-4, 5e-4, 1e-3, 2.5e-3, 5e-3,
+                   1e-2, 2.5e-2, 5e-2, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class MetricsRegistry(object):
+    """
+    Set of metrics of the process. Metrics are disabled by default, and then recording a value
+    just costs the check of the 'enabled' flag.
+    """
+    def __init__(self):
+        self.enabled = False
+        self.metrics = {}
+        self.lock = threading.Lock()
+
+    def get_or_create(self, metric_class, name, help_text, **kwargs):
+        # Modules declare their metrics on import, so the same name must always give the same metric
+        with self.lock:
+            metric = self.metrics.get(name)
+            if metric is None:
+                metric = metric_class(self, name, help_text, **kwargs)
+                self.metrics[name] = metric
+            assert isinstance(metric, metric_class), "Metric '%s' already registered with another type" % name
+            return metric
+
+    def __iter__(self):
+        with self.lock:
+            return iter(sorted(self.metrics.values(), key=lambda m: m.name))
+
+
+class Counter(object):
+    type_name = "counter"
+
+    def __init__(self, registry, name, help_text):
+        self.registry = registry
+        self.name = name
+        self.help_text = help_text
+        self.value = 0
+        self.lock = threading.Lock()
+
+    def inc(self, n=1):
+        if not self.registry.enabled:
+            return
+        with self.lock:
+            self.value += n
+
+    def samples(self):
+        return [(self.name, self.value)]
+
+    def snapshot(self):
+        return self.value
+
+
+class Gauge(object):
+    """Value that can go up and down, either set explicitly or given by a function evaluated when reported"""
+    type_name = "gauge"
+
+    def __init__(self, registry, name, help_text):
+        self.registry = registry
+        self.name = name
+        self.help_text = help_text
+        self.value = 0
+        self.function = None
+
+    def set(self, value):
+        if self.registry.enabled:
+            self.value = value
+
+    def set_function(self, function):
+        # Zero cost on the hot path, since the function is only called to report the metric
+        self.function = function
+
+    def get(self):
+        return self.function() if self.function is not None else self.value
+
+    def samples(self):
+        return [(self.name, self.get())]
+
+    def snapshot(self):
+        return self.get()
+
+
+class Histogram(object):
+    type_name = "histogram"
+
+    def __init__(self, registry, name, help_text, buckets=DEFAULT_BUCKETS):
+        self.registry = registry
+        self.name = name
+        self.help_text = help_text
+        self.buckets = tuple(sorted(buckets))
+        self.counts = [0] * (len(self.buckets) + 1)  # Last one for values beyond the highest bucket
+        self.sum = 0.0
+        self.count = 0
+        self.lock = threading.Lock()
+
+    def observe(self, value):
+        if not self.registry.enabled:
+            return
+        k = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            self.counts[k] += 1
+            self.sum += value
+            self.count += 1
+
+    def time(self):
+        return Timer(self)
+
+    def samples(self):
+        with self.lock:
+            counts, total, count = list(self.counts), self.sum, self.count
+
+        # Buckets are cumulative on the Prometheus format
+        samples, cumulative = [], 0
+        for bound, n in zip(self.buckets + (float("inf"),), counts):
+            cumulative += n
+            samples.append(('%s_bucket{le="%s"}' % (self.name, "+Inf" if bound == float("inf") else repr(bound)),
+                            cumulative))
+        samples.append((self.name + "_sum", total))
+        samples.append((self.name + "_count", count))
+        return samples
+
+    def snapshot(self):
+        with self.lock:
+            return {"count": self.count, "sum": self.sum,
+                    "mean": self.sum / self.count if self.count else 0.0}
+
+
+class Timer(object):
+    """Context manager that observes the seconds elapsed on a histogram"""
+    __slots__ = ('histogram', 'start')
+
+    def __init__(self, histogram):
+        self.histogram = histogram
+        self.start = None
+
+    def __enter__(self):
+        if self.histogram.registry.enabled:
+            self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self.start is not None:
+            self.histogram.observe(time.perf_counter() - self.start)
+            self.start = None
+
+
+REGISTRY = MetricsRegistry()
+
+
+def enable():
+    REGISTRY.enabled = True
+
+
+def disable():
+    REGISTRY.enabled = False
+
+
+def is_enabled():
+    return REGISTRY.enabled
+
+
+def counter(name, help_text):
+    return REGISTRY.get_or_create(Counter, name, help_text)
+
+
+def gauge(name, help_text):
+    return REGISTRY.get_or_create(Gauge, name, help_text)
+
+
+def histogram(name, help_text, buckets=DEFAULT_BUCKETS):
+    return REGISTRY.get_or_create(Histogram, name, help_text, buckets=buckets)
+
+
+def timed(histogram):
+    """
+    Decorator to observe the seconds taken by each call of a function on a histogram
+
+    :param histogram: Histogram
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not histogram.registry.enabled:
+                return func(*args, **kwargs)
+
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                histogram.observe(time.perf_counter() - start)
+        return wrapper
+    return decorator
+
+
+def render_prometheus(registry=REGISTRY):
+    """
+    Render all the metrics in the text format of Prometheus
+
+    :return: string
+    """
+    lines = []
+    for metric in registry:
+        lines.append("# HELP %s %s" % (metric.name, metric.help_text))
+        lines.append("# TYPE %s %s" % (metric.name, metric.type_name))
+        lines += ["%s %s" % (name, repr(float(value))) for (name, value) in metric.samples()]
+    return "\n".join(lines) + "\n"
+
+
+def snapshot(registry=REGISTRY):
+    # Current values of metrics as a dict, e.g. to be published as JSON
+    return {metric.name: metric.snapshot() for metric in registry}
+
+
+class MetricsReporter(object):
+    """
+    Thread that periodically dumps the metrics, on a file in the Prometheus text format
+    (e.g. for the textfile collector of node_exporter) and/or as JSON on a MQTT topic
+    """
+    def __init__(self, interval=10.0, filename=None, mqtt=None, topic=None):
+        assert filename is not None or (mqtt is not None and topic is not None), "Nowhere to report metrics"
+        self.interval = interval
+        self.filename = filename
+        self.mqtt = mqtt
+        self.topic = topic
+
+        self.stop_event = threading.Event()
+        self.thread = None
+
+    def report(self):
+        if self.filename is not None:
+            # Write and rename, so readers never see a half-written file
+            tmp_filename = self.filename + ".tmp"
+            with open(tmp_filename, "w") as f:
+                f.write(render_prometheus())
+            os.replace(tmp_filename, self.filename)
+
+        if self.mqtt is not None and self.topic is not None:
+            self.mqtt.publish(self.topic, payload=json.dumps(snapshot()).encode("utf-8"))
+
+    def _run(self):
+        while not self.stop_event.wait(self.interval):
+            try:
+                self.report()
+            except Exception as e:
+                logger.error("Metrics couldn't be reported: %s", str(e))
+
+    def start(self):
+        assert self.thread is None, "Reporter already started"
+        self.stop_event.clear()
+        self.thread = threading.Thread(target=self._run, name="metrics-reporter", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        if self.thread is None:
+            return
+        self.stop_event.set()
+        self.thread.join()
+        self.thread = None
+        self.report()
+
+
+class Profiler(object):
+    """Hook to profile a section of code (e.g. the loop of a service) with cProfile, dumping stats to a file"""
+    def __init__(self, filename):
+        self.filename = filename
+        self.profile = cProfile.Profile()
+
+    def start(self):
+        self.profile.enable()
+
+    def stop(self):
+        self.profile.disable()
+        self.profile.dump_stats(self.filename)
+        logger.info("Profiling stats written on '%s'", self.filename)
+
+    def print_stats(self, sort_by="cumulative", limit=30):
+        pstats.Stats(self.profile).sort_stats(sort_by).print_stats(limit)
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+
+def start_profiler(filename):
+    """
+    Profile the current thread until the process exits (even if stopped with SIGTERM, as Docker does)
+
+    :param filename: string, file to dump cProfile stats on
+    :return: Profiler
+    """
+    profiler = Profiler(filename)
+    atexit.register(profiler.stop)
+
+    # Exit through SystemExit on SIGTERM, so the stats are dumped by 'atexit'
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+    profiler.start()
+    return profiler
+
+
+def add_arguments(parser):
+    # Arguments shared by services to enable metrics and profiling
+    parser.add_argument('-mt', '--metrics', dest='metrics', action='store_true',
+                        help='Record metrics of the hot paths (disabled by default, since they have a small cost)')
+    parser.add_argument('-mi', '--metrics-interval', type=float, dest='metrics_interval', default=10.0,
+                        help='Seconds between dumps of metrics')
+    parser.add_argument('-mf', '--metrics-file', type=str, dest='metrics_file', default=None,
+                        help='File to dump metrics on, in the Prometheus text format')
+    parser.add_argument('-pf', '--profile', type=str, dest='profile', default=None,
+                        help='File to dump cProfile stats of the main loop on exit (profiling disabled by default)')
+
+
+def setup_from_args(args, mqtt=None, topic=None):
+    """
+    Enable metrics and profiling, and start the reporter of metrics, as requested by the arguments of 'add_arguments'
+
+    :param args: argparse.Namespace
+    :param mqtt: MQTTClient, to publish metrics as JSON on 'topic' (optional)
+    :param topic: string, MQTT topic for metrics (optional)
+    :return: MetricsReporter, or None if metrics are not reported
+    """
+    if args.profile is not None:
+        start_profiler(args.profile)
+
+    if not args.metrics:
+        return None
+
+    enable()
+
+    if args.metrics_file is None and (mqtt is None or topic is None):
+        return None
+
+    reporter = MetricsReporter(interval=args.metrics_interval, filename=args.metrics_file, mqtt=mqtt, topic=topic)
+    reporter.start()
+    return reporter
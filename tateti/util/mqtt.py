@@ -1,14 +1,143 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
+from tateti.util import metrics
 from tateti.util.fileio import get_logger
 
 import paho.mqtt.client as mqtt
 
+from collections import deque
+import threading
 import time
+import weakref
 
 logger = get_logger(name=__name__, level='debug')
 
+PUBLISHED = metrics.counter("tateti_mqtt_published_total", "Messages published")
+PUBLISHED_BYTES = metrics.counter("tateti_mqtt_published_bytes_total", "Bytes of the payloads published")
+RECEIVED = metrics.counter("tateti_mqtt_received_total", "Messages received")
+QUEUE_DEPTH = metrics.gauge("tateti_mqtt_queue_depth", "Messages waiting on the inbound queues")
+DROPPED = metrics.counter("tateti_mqtt_dropped_total", "Messages dropped by the inbound queues when full")
+
+# Inbound queues alive on the process, so the depth reported covers all of them (e.g. many clients on benchmarks)
+_queues = weakref.WeakSet()
+_queues_lock = threading.Lock()
+
+
+def _total_queue_depth():
+    with _queues_lock:
+        queues = list(_queues)
+    return sum(len(q) for q in queues)
+
+
+# Evaluated only when metrics are reported
+QUEUE_DEPTH.set_function(_total_queue_depth)
+
+
+class MessageQueue(object):
+    """
+    Bounded and thread-safe FIFO queue of messages, with a policy to apply when it is full:
+
+    - 'drop_oldest': discard the oldest message queued to make room for the new one
+    - 'drop_newest': discard the new message
+    - 'keep_latest': keep just the latest message per topic (and drop the oldest one if still full)
+    - 'block': wait for room up to 'block_timeout' seconds, then discard the new message
+
+    Payloads are not decoded here, so 'keep_latest' is only valid when each game has its own topics:
+    messages of different games on a shared topic (identified by the 'game_id' of their payloads)
+    would replace each other.
+    """
+    DROP_OLDEST = "drop_oldest"
+    DROP_NEWEST = "drop_newest"
+    KEEP_LATEST = "keep_latest"
+    BLOCK = "block"
+
+    policies = (DROP_OLDEST, DROP_NEWEST, KEEP_LATEST, BLOCK)
+
+    def __init__(self, max_size=4, policy=DROP_OLDEST, block_timeout=1.0):
+        assert max_size > 0
+        assert policy in self.policies, "Policy '%s' not supported" % policy
+
+        self.max_size = max_size
+        self.policy = policy
+        self.block_timeout = block_timeout
+
+        self.queue = deque()
+        self.lock = threading.Lock()
+        self.not_empty = threading.Condition(self.lock)
+        self.not_full = threading.Condition(self.lock)
+
+        self.n_enqueued = 0
+        self.n_dropped = 0
+
+        with _queues_lock:
+            _queues.add(self)
+
+    def __len__(self):
+        with self.lock:
+            return len(self.queue)
+
+    def put(self, msg):
+        """
+        Add a message to the queue, applying the overflow policy if needed
+
+        :param msg: message to queue
+        :return: boolean, True if the message was queued
+        """
+        with self.lock:
+            if self.policy == self.KEEP_LATEST:
+                # Replace a previous message of the same topic (at most one per topic is queued)
+                previous = [m for m in self.queue if m.topic == msg.topic]
+                for m in previous:
+                    self.queue.remove(m)
+                self._drop(len(previous))
+
+            if len(self.queue) >= self.max_size:
+                if self.policy == self.BLOCK:
+                    self.not_full.wait_for(lambda: len(self.queue) < self.max_size, timeout=self.block_timeout)
+
+                if self.policy in (self.DROP_NEWEST, self.BLOCK) and len(self.queue) >= self.max_size:
+                    self._drop(1)
+                    return False
+
+                while len(self.queue) >= self.max_size:
+                    self.queue.popleft()
+                    self._drop(1)
+
+            self.queue.append(msg)
+            self.n_enqueued += 1
+            self.not_empty.notify()
+            return True
+
+    def _drop(self, n):
+        # Called with the lock held
+        if n > 0:
+            self.n_dropped += n
+            DROPPED.inc(n)
+
+    def get(self, block=False, timeout=None):
+        """
+        Take the oldest message of the queue
+
+        :param block: boolean, if True then wait until there is a message
+        :param timeout: float, max seconds to wait when blocking (None to wait forever)
+        :return: message, or None if there is no message
+        """
+        with self.lock:
+            if block:
+                self.not_empty.wait_for(lambda: self.queue, timeout=timeout)
+
+            if not self.queue:
+                return None
+
+            msg = self.queue.popleft()
+            self.not_full.notify()
+            return msg
+
+    def stats(self):
+        with self.lock:
+            return {"size": len(self.queue), "enqueued": self.n_enqueued, "dropped": self.n_dropped}
+
 
 class MQTTClient(object):
     rc_dict = {
@@ -21,15 +150,15 @@ class MQTTClient(object):
         6: "Currently not used",
     }
 
-    def __init__(self, host, port, max_buffer=4):
+    def __init__(self, host, port, max_buffer=4, overflow_policy=MessageQueue.DROP_OLDEST):
         self.host = host
         self.port = port
 
         self.client = mqtt.Client()
         self.connected = True
 
-        self.client.msgs_queue = []
-        self.client.max_buffer = max_buffer  # Max amount of messages to persist on
+        # Max amount of messages to persist on, and what to do when it is exceeded
+        self.client.msgs_queue = MessageQueue(max_size=max_buffer, policy=overflow_policy)
 
         self.client.on_connect = on_connect
         self.client.on_disconnect = on_disconnect
@@ -55,6 +184,8 @@ class MQTTClient(object):
 
     def publish(self, topic, payload):
         if self.connected:
+            PUBLISHED.inc()
+            PUBLISHED_BYTES.inc(len(payload))
             result, mid = self.client.publish(topic, payload, 0)
             return result, mid
 
@@ -67,34 +198,66 @@ class MQTTClient(object):
         self.client.subscribe(subs)
 
     def get_message(self):
-        if self.client.msgs_queue:
-            return self.client.msgs_queue.pop(0)
-        return None
+        return self.client.msgs_queue.get()
+
+    def wait_message(self, timeout=None):
+        """
+        Block until a message is received, instead of polling with 'get_message'
+
+        :param timeout: float, max seconds to wait (None to wait forever)
+        :return: message received, or None if the timeout expired
+        """
+        return self.client.msgs_queue.get(block=True, timeout=timeout)
+
+    def wait_messages(self, max_messages, window, timeout=None):
+        """
+        Block until a message is received, and then keep collecting messages for a short time window
+
+        :param max_messages: int, max of messages to collect
+        :param window: float, seconds to keep collecting messages after the first one
+        :param timeout: float, max seconds to wait for the first message (None to wait forever)
+        :return: list of messages received (empty if the timeout expired)
+        """
+        msg = self.wait_message(timeout=timeout)
+        if msg is None:
+            return []
+
+        msgs = [msg]
+        deadline = time.time() + window
+        while len(msgs) < max_messages:
+            remaining = deadline - time.time()
+            msg = self.wait_message(timeout=remaining) if remaining > 0 else self.get_message()
+            if msg is None:
+                break
+            msgs.append(msg)
+
+        return msgs
+
+    def get_stats(self):
+        # Counters of the inbound queue, to detect messages lost under bursty load
+        return self.client.msgs_queue.stats()
 
 
 # The callback for when the client receives a CONNACK response from the server.
 def on_connect(client, userdata, flags, rc):
 
-    client.logger.debug("MQTT Connected with result %s" % str(MQTTClient.rc_dict[rc]))
+    client.logger.debug("MQTT Connected with result %s", MQTTClient.rc_dict[rc])
     if rc == 0:
         client.connected = True
 
 
 def on_disconnect(client, userdata, rc):
-    client.logger.debug("MQTT Disconnected with result code: %s  client:%s, userdata: %s" %
-                        (rc, str(client), str(userdata)))
+    client.logger.debug("MQTT Disconnected with result code: %s  client:%s, userdata: %s", rc, client, userdata)
     client.connected = False
 
 
 def on_publish(client, userdata, mid):
-    client.logger.debug("MQTT Message %s published.", str(mid))
+    client.logger.debug("MQTT Message %s published.", mid)
 
 
 # The callback for when a PUBLISH message is received from the server.
 def on_message(client, userdata, msg):
     # print("Message received on topic " + msg.topic + " with QoS " + str(msg.qos) + " and payload " + msg.payload)
-    client.msgs_queue.append(msg)
-    if len(client.msgs_queue) > client.max_buffer:
-        # Assert a max of 'client.max_buffer' messages
-        # Just a single pop (it shouldn't accumulate more than 1 message with this function)
-        client.msgs_queue.pop(0)
+    RECEIVED.inc()
+    if not client.msgs_queue.put(msg):
+        logger.debug("Inbound queue is full, message on topic '%s' was dropped", msg.topic)
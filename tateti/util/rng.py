@@ -0,0 +1,54 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Random number generation with independent, reproducible streams per component"""
+
+__author__ = 'leferrad'
+
+import numpy as np
+
+
+# NOTE: every component that needs randomness gets its own np.random.Generator from a seed, instead of
+# seeding the global state of NumPy. Components that create others (e.g. workers, games) spawn child
+# seeds from a SeedSequence, so their streams are independent but reproducible from a single seed.
+
+
+def make_seed_sequence(seed=None):
+    """
+    Get a SeedSequence from a seed
+
+    :param seed: None (for fresh entropy), int or np.random.SeedSequence
+    :return: np.random.SeedSequence
+    """
+    if isinstance(seed, np.random.SeedSequence):
+        return seed
+    return np.random.SeedSequence(seed)
+
+
+def make_rng(seed=None):
+    """
+    Get a random generator from a seed
+
+    :param seed: None (for fresh entropy), int, np.random.SeedSequence or np.random.Generator
+                 (which is returned as it is, so it can be shared on purpose)
+    :return: np.random.Generator
+    """
+    if isinstance(seed, np.random.Generator):
+        return seed
+    return np.random.default_rng(make_seed_sequence(seed))
+
+
+def spawn_seeds(seed, n):
+    """
+    Spawn independent child seeds from a seed, e.g. one per worker or per game
+
+    :param seed: None, int or np.random.SeedSequence
+    :param n: int, number of child seeds
+    :return: list of np.random.SeedSequence
+    """
+    return make_seed_sequence(seed).spawn(n)
+
+
+def spawn_rngs(seed, n):
+    # Independent generators from child seeds of 'seed'
+    return [np.random.default_rng(s) for s in spawn_seeds(seed, n)]
@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+
+"""Tests for the memory-mappable checkpoint format"""
+
+__author__ = 'leferrad'
+
+from tateti.agent.dqn import DQNAgent
+from tateti.environment.tictactoe import Environment
+from tateti.util.checkpoint import read_checkpoint, write_checkpoint
+
+import numpy as np
+
+from test_dqn_agent import random_network
+
+from collections import OrderedDict
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+
+def some_arrays(seed=0):
+    rng = np.random.default_rng(seed)
+    return OrderedDict([("weights", rng.normal(size=(9, 24)).astype(np.float32)),
+                        ("bias", rng.normal(size=24)),
+                        ("counts", rng.integers(-5, 5, size=(3, 4, 5)).astype(np.int8)),
+                        ("empty", np.zeros((0, 3), dtype=np.float32))])
+
+
+class TestCheckpoint(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.filename = os.path.join(self.directory, "agent.ckpt")
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def assertArraysEqual(self, arrays, expected):
+        self.assertEqual(list(arrays.keys()), list(expected.keys()))
+        for name, a in expected.items():
+            self.assertEqual(arrays[name].dtype, a.dtype)
+            np.testing.assert_array_equal(arrays[name], a)
+
+    def test_round_trip(self):
+        arrays, metadata = some_arrays(), {"gamma": 0.95, "activations": ["relu", "linear"]}
+        write_checkpoint(self.filename, arrays, metadata)
+
+        for mmap in (True, False):
+            arrays_read, metadata_read = read_checkpoint(self.filename, mmap=mmap)
+            self.assertArraysEqual(arrays_read, arrays)
+            self.assertEqual(metadata_read, metadata)
+            self.assertFalse(arrays_read["weights"].flags.writeable)
+
+    def test_replacement_is_atomic(self):
+        old_arrays, new_arrays = some_arrays(seed=1), some_arrays(seed=2)
+        write_checkpoint(self.filename, old_arrays)
+        mapped, _ = read_checkpoint(self.filename, mmap=True)
+
+        write_checkpoint(self.filename, new_arrays)
+        self.assertEqual(os.listdir(self.directory), ["agent.ckpt"])
+
+        # Readers of the previous file keep seeing it whole, while new readers see the new one
+        self.assertArraysEqual(mapped, old_arrays)
+        self.assertArraysEqual(read_checkpoint(self.filename)[0], new_arrays)
+
+    def test_failed_write_keeps_previous_checkpoint(self):
+        arrays = some_arrays(seed=1)
+        write_checkpoint(self.filename, arrays)
+
+        with mock.patch("tateti.util.checkpoint.os.replace", side_effect=OSError("disk full")):
+            self.assertRaises(OSError, write_checkpoint, self.filename, some_arrays(seed=2))
+
+        self.assertEqual(os.listdir(self.directory), ["agent.ckpt"])
+        self.assertArraysEqual(read_checkpoint(self.filename)[0], arrays)
+
+    def test_error_opening_file_is_not_masked(self):
+        with mock.patch("tateti.util.checkpoint.open", create=True, side_effect=PermissionError("denied")):
+            self.assertRaises(PermissionError, write_checkpoint, self.filename, some_arrays())
+
+    def test_agent_round_trip(self):
+        env = Environment()
+        agent = DQNAgent(env, model=random_network(env.n_dimensions, env.n_actions), phi_function="scaled")
+        agent.save_checkpoint(self.filename)
+
+        loaded = DQNAgent.load_checkpoint(self.filename, env, inference_only=True)
+        states = np.random.default_rng(0).integers(-1, 2, size=(20, env.n_dimensions))
+        np.testing.assert_allclose(loaded.model.predict(states), agent.model.predict(states), rtol=1e-6)
+        self.assertEqual((loaded.phi_function, loaded.gamma), (agent.phi_function, agent.gamma))
+
+        self.assertRaises(ValueError, DQNAgent.load_checkpoint, self.filename,
+                          Environment(board_length=4), inference_only=True)
+
+
+if __name__ == '__main__':
+    unittest.main()
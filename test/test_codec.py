@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+
+"""Tests for the codecs of MQTT messages"""
+
+__author__ = 'leferrad'
+
+from tateti.environment.tictactoe import Environment
+from tateti.util import codec
+
+import numpy as np
+
+import unittest
+
+
+def random_env_str(n_cells, seed=0):
+    rng = np.random.default_rng(seed)
+    return "".join(codec.SYMBOLS[c] for c in rng.integers(3, size=n_cells))
+
+
+def env_message(env_str, game_id=None):
+    msg = {"state": codec.state_from_env_str(env_str), "reward": 0.5, "is_over": 1, "turn": "o",
+           "env_str": env_str}
+    if game_id is not None:
+        msg["game_id"] = game_id
+    return msg
+
+
+class TestBinaryCodec(unittest.TestCase):
+    def assertRoundTrip(self, msg, version):
+        payload = codec.encode_binary(msg)
+        self.assertEqual(payload[1], version)
+        self.assertEqual(codec.decode_message(payload), msg)
+
+    def test_env_message_round_trip(self):
+        self.assertRoundTrip(env_message(random_env_str(9)), version=1)
+        self.assertRoundTrip(env_message(random_env_str(9), game_id="42"), version=1)
+        for n_cells in (16, 49, 225):
+            self.assertRoundTrip(env_message(random_env_str(n_cells), game_id="g"), version=2)
+
+    def test_action_message_round_trip(self):
+        self.assertRoundTrip({"action": (2, 1), "env_str": random_env_str(9), "sym": "x"}, version=1)
+        self.assertRoundTrip({"action": (0, 2), "env_str": random_env_str(9), "game_id": "7"}, version=1)
+        self.assertRoundTrip({"action": (14, 3), "env_str": random_env_str(225), "sym": "o"}, version=2)
+
+    def test_state_matches_environment(self):
+        env = Environment(seed=1)
+        for action in ((0, 0), (1, 1), (2, 0)):
+            env.take_action(env.turn, action)
+        msg = codec.decode_message(codec.encode_binary(env_message(env.get_env_string())))
+        self.assertEqual(msg["state"], env.get_state())
+
+    def test_bad_magic_is_rejected(self):
+        payload = bytearray(codec.encode_binary(env_message(random_env_str(9))))
+        payload[0] = 0x00
+        self.assertRaises(ValueError, codec.decode_binary, bytes(payload))
+
+    def test_bad_version_is_rejected(self):
+        for version in (0, 3, 255):
+            payload = bytearray(codec.encode_binary(env_message(random_env_str(9))))
+            payload[1] = version
+            self.assertRaises(ValueError, codec.decode_message, bytes(payload))
+
+    def test_malformed_payloads_are_rejected(self):
+        payload = codec.encode_binary(env_message(random_env_str(49)))
+        for truncated in (payload[:2], payload[:5], payload[:-1]):
+            self.assertRaises(ValueError, codec.decode_message, truncated)
+
+        # Unknown kind, and cells with a code out of the symbols
+        self.assertRaises(ValueError, codec.decode_message, codec.HEADER.pack(codec.BINARY_MAGIC, 1, 9))
+        fields = codec.ENV_FIELDS.pack(b"\xff\xff\xff", 1, 0, 0.0)
+        self.assertRaises(ValueError, codec.decode_message,
+                          codec.HEADER.pack(codec.BINARY_MAGIC, 1, codec.KIND_ENV) + fields)
+
+
+class TestJSONCodec(unittest.TestCase):
+    def test_round_trip(self):
+        msg = env_message(random_env_str(9), game_id="3")
+        payload = codec.encode_message(msg, "json")
+        self.assertEqual(codec.detect_codec(payload), "json")
+        self.assertEqual(codec.decode_message(payload), msg)
+
+    def test_malformed_payloads_are_rejected(self):
+        for payload in (b"", b"{not json", b"[1, 2]", b"\xff\xfe"):
+            self.assertRaises(ValueError, codec.decode_message, payload)
+
+
+if __name__ == '__main__':
+    unittest.main()
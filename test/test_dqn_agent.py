@@ -0,0 +1,124 @@
+# -*- coding: utf-8 -*-
+
+"""Tests for the DQN agent"""
+
+__author__ = 'leferrad'
+
+from tateti.agent import phi, strategy
+from tateti.agent.base import argmax_value
+from tateti.agent.dqn import DQNAgent
+from tateti.agent.inference import NumpyQNetwork
+from tateti.agent.memory import ReplayMemory
+from tateti.environment.tictactoe import Environment
+
+import numpy as np
+
+from collections import deque
+import pickle
+import unittest
+
+
+class TrainableNumpyQNetwork(NumpyQNetwork):
+    # Stand-in of a Keras model, so replays can run without Keras
+    def train_on_batch(self, x, y, sample_weight=None):
+        self.last_batch = (x, y, sample_weight)
+        return 0.0
+
+
+def random_network(n_dims, n_actions, n_hidden=8, seed=123):
+    rng = np.random.default_rng(seed)
+    sizes = [n_dims, n_hidden, n_actions]
+    weights = [rng.normal(size=(n_in, n_out)) for (n_in, n_out) in zip(sizes[:-1], sizes[1:])]
+    biases = [np.zeros(n_out) for n_out in sizes[1:]]
+    return TrainableNumpyQNetwork(weights, biases, activations=["relu", "linear"])
+
+
+def baseline_agent(env, n_transitions=20):
+    # Agent with just the attributes that DQNAgent had before the replay memory, caches and learners
+    agent = DQNAgent.__new__(DQNAgent)
+    egreedy = strategy.EpsilonGreedy.__new__(strategy.EpsilonGreedy)
+    egreedy.__dict__.update({"exploit_func": argmax_value, "seed": 123, "epsilon": 0.7})
+
+    agent.__dict__.update({"phi": phi.ScaledPhi(n_dims=env.n_dimensions), "strategy": egreedy,
+                           "actions": dict([(a, i) for (i, a) in enumerate(env.available_actions)]),
+                           "n_actions": env.n_actions, "n_dims": env.n_dimensions, "gamma": 0.95,
+                           "model": random_network(env.n_dimensions, env.n_actions),
+                           "memory": deque(maxlen=400), "batch_size": 10,
+                           "phi_function": "scaled", "strategy_function": "egreedy"})
+
+    # Transitions stored as they were, with the actions taken instead of their indexes
+    rng = np.random.default_rng(0)
+    for _ in range(n_transitions):
+        state = list(rng.integers(-1, 2, size=env.n_dimensions))
+        action = env.available_actions[rng.integers(env.n_actions)]
+        agent.memory.append((state, action, 0.0, state, False))
+
+    return agent
+
+
+class TestBaselinePickle(unittest.TestCase):
+    def setUp(self):
+        self.env = Environment()
+        self.agent = pickle.loads(pickle.dumps(baseline_agent(self.env)))
+
+    def test_new_attributes_get_defaults(self):
+        self.assertFalse(self.agent.prioritized)
+        self.assertFalse(self.agent.augment)
+        self.assertIsNone(self.agent.q_cache)
+        self.assertIsNone(self.agent.serving_model)
+        self.assertEqual(self.agent.weights_version, 0)
+
+    def test_memory_is_converted(self):
+        self.assertIsInstance(self.agent.memory, ReplayMemory)
+        self.assertEqual(len(self.agent.memory), 20)
+
+        states, actions, rewards, next_states, terminals = self.agent.memory.sample(5)
+        self.assertEqual(states.shape, (5, self.env.n_dimensions))
+        self.assertTrue(np.all((actions >= 0) & (actions < self.env.n_actions)))
+
+    def test_act_and_learn(self):
+        self.agent.enable_q_cache(max_size=100)
+        for _ in range(2):
+            action = self.agent.act(self.env.get_state(), self.env.get_env_string(), explore=False)
+            self.assertTrue(self.env.is_legal(action))
+
+        self.agent.update(self.env.get_state(), action, 1.0, self.env.get_state(), True)
+        self.agent.experience_replay()
+        self.assertEqual(len(self.agent.model.last_batch[0]), self.agent.batch_size)
+
+
+class TestQValueCache(unittest.TestCase):
+    def test_exact_cache_serves_same_actions(self):
+        env = Environment()
+        agent = DQNAgent(env, model=random_network(env.n_dimensions, env.n_actions), phi_function="scaled")
+        cached = DQNAgent(env, model=agent.model, phi_function="scaled", cache_q_values=True)
+
+        rng = np.random.default_rng(1)
+        for _ in range(50):
+            env.reset()
+            while not env.game_over():
+                state, env_str = env.get_state(), env.get_env_string()
+                expected = agent.act(state, env_str, explore=False)
+                for _ in range(2):  # Second time from the cache
+                    self.assertEqual(cached.act(state, env_str, explore=False), expected)
+                moves = env.get_possible_moves()
+                env.take_action(env.turn, moves[rng.integers(len(moves))])
+
+    def test_symmetric_cache_requires_augment(self):
+        env = Environment()
+        agent = DQNAgent(env, model=random_network(env.n_dimensions, env.n_actions), phi_function="scaled")
+        self.assertRaises(ValueError, agent.enable_q_cache, symmetric=True)
+
+        agent.augment = True
+        agent.enable_q_cache(symmetric=True)
+        self.assertTrue(agent.q_cache_symmetric)
+
+    def test_symmetric_cache_requires_classic_board(self):
+        env = Environment(board_length=7, win_length=4)
+        agent = DQNAgent(env, model=random_network(env.n_dimensions, env.n_actions), phi_function="scaled",
+                         augment=True)
+        self.assertRaises(ValueError, agent.enable_q_cache, symmetric=True)
+
+
+if __name__ == '__main__':
+    unittest.main()
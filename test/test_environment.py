@@ -0,0 +1,126 @@
+# -*- coding: utf-8 -*-
+
+"""Tests for the environment, against a plain implementation of the rules of the game"""
+
+__author__ = 'leferrad'
+
+from tateti.environment.tictactoe import Environment
+
+import numpy as np
+
+import unittest
+
+
+# Sizes of board (length, win length) tested, including ones without lookup tables of moves
+BOARD_SIZES = ((3, 3), (4, 3), (4, 4), (5, 4), (7, 4))
+
+DIRECTIONS = ((0, 1), (1, 0), (1, 1), (1, -1))
+
+
+class ReferenceEnvironment(object):
+    """Rules of the game on a dense board, scanning every line on each check (as the environment used to do)"""
+    def __init__(self, board_length=Environment.BOARD_LENGTH, win_length=None, turn=Environment.SYMBOL_X):
+        self.board_length = board_length
+        self.win_length = win_length or board_length
+        self.board = np.zeros((board_length, board_length), dtype=int)
+        self.turn = turn
+        self.winner = None
+
+    def get_state(self):
+        return [int(x) for x in self.board.ravel()]
+
+    def get_env_string(self):
+        return "".join(Environment.sym_repr[x] for x in self.get_state())
+
+    def get_possible_moves(self):
+        return [(i, j) for i in range(self.board_length) for j in range(self.board_length) if self.board[i, j] == 0]
+
+    def _find_winner(self):
+        length = self.board_length
+        for player in (Environment.SYMBOL_X, Environment.SYMBOL_O):
+            for i in range(length):
+                for j in range(length):
+                    for di, dj in DIRECTIONS:
+                        cells = [(i + n * di, j + n * dj) for n in range(self.win_length)]
+                        if all(0 <= ci < length and 0 <= cj < length and self.board[ci, cj] == player
+                               for (ci, cj) in cells):
+                            return player
+        return None
+
+    def game_over(self):
+        return self.winner is not None or not self.get_possible_moves()
+
+    def take_action(self, sym, action):
+        assert sym == self.turn and self.board[action] == Environment.SYMBOL_EMPTY
+        self.board[action] = sym
+        self.winner = self._find_winner()
+        reward = 1 if self.winner == sym else 0
+        self.turn = -sym
+        return self.get_state(), reward, self.game_over(), self.turn
+
+
+class TestEnvironment(unittest.TestCase):
+    def assertSameStatus(self, env, ref):
+        self.assertEqual(env.get_state(), ref.get_state())
+        self.assertEqual(env.get_env_string(), ref.get_env_string())
+        self.assertEqual(env.get_possible_moves(), ref.get_possible_moves())
+        self.assertEqual(env.get_possible_moves_from_str(env.get_env_string()), ref.get_possible_moves())
+
+        mask = env.get_action_mask()
+        self.assertEqual(mask.dtype, bool)
+        self.assertEqual([env.available_actions[k] for k in np.flatnonzero(mask)], ref.get_possible_moves())
+        np.testing.assert_array_equal(env.get_action_mask_from_str(env.get_env_string()), mask)
+
+        self.assertEqual(env.game_over(), ref.game_over())
+        self.assertEqual(env.winner, None if ref.winner is None else Environment.sym_repr[ref.winner])
+
+    def test_random_games_match_reference(self):
+        rng = np.random.default_rng(0)
+        for board_length, win_length in BOARD_SIZES:
+            env = Environment(seed=1, board_length=board_length, win_length=win_length)
+            n_games = 50 if board_length <= 4 else 10
+            for _ in range(n_games):
+                env.reset()
+                ref = ReferenceEnvironment(board_length, win_length, turn=env.turn)
+                self.assertSameStatus(env, ref)
+
+                while not ref.game_over():
+                    moves = ref.get_possible_moves()
+                    action = moves[rng.integers(len(moves))]
+                    self.assertEqual(env.take_action(env.turn, action), ref.take_action(ref.turn, action))
+                    self.assertSameStatus(env, ref)
+
+    def test_score(self):
+        env, rng = Environment(seed=1), np.random.default_rng(0)
+        for _ in range(30):
+            env.reset()
+            while not env.game_over():
+                moves = env.get_possible_moves()
+                env.take_action(env.turn, moves[rng.integers(len(moves))])
+        self.assertEqual(sum(env.score.values()), 30)
+
+    def test_board_is_read_only(self):
+        env = Environment(seed=1)
+        env.take_action(env.turn, (1, 1))
+        board = env.board
+        self.assertEqual(board[1, 1], env.get_state()[4])
+        with self.assertRaises(ValueError):
+            board[0, 0] = Environment.SYMBOL_X
+
+    def test_board_can_be_set(self):
+        rng = np.random.default_rng(0)
+        for board_length, win_length in BOARD_SIZES:
+            env = Environment(seed=1, board_length=board_length, win_length=win_length)
+            while not env.game_over():
+                moves = env.get_possible_moves()
+                env.take_action(env.turn, moves[rng.integers(len(moves))])
+
+                other = Environment(seed=2, board_length=board_length, win_length=win_length)
+                other.board = env.board
+                self.assertEqual(other.get_state(), env.get_state())
+                self.assertEqual(other.get_possible_moves(), env.get_possible_moves())
+                self.assertEqual((other.game_over(), other.winner), (env.game_over(), env.winner))
+
+
+if __name__ == '__main__':
+    unittest.main()
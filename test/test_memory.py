@@ -0,0 +1,142 @@
+# -*- coding: utf-8 -*-
+
+"""Tests for the replay memories of agents"""
+
+__author__ = 'leferrad'
+
+from tateti.agent.memory import PrioritizedReplayMemory, ReplayMemory, SumTree
+
+import numpy as np
+
+import os
+import shutil
+import tempfile
+import unittest
+
+
+N_DIMS = 9
+
+
+def transition(i):
+    # Transition identified by 'i' on all its fields
+    state = np.full(N_DIMS, i % 3 - 1)
+    return state, i % N_DIMS, float(i), -state, i % 2 == 0
+
+
+def fill(memory, n):
+    for i in range(n):
+        memory.append(*transition(i))
+    return memory
+
+
+class TestReplayMemory(unittest.TestCase):
+    def test_ring_buffer_keeps_newest(self):
+        memory = fill(ReplayMemory(capacity=5, n_dims=N_DIMS), 8)
+        self.assertEqual(len(memory), 5)
+        self.assertEqual(memory.n_appended, 8)
+
+        states, actions, rewards, next_states, terminals = memory.get(memory.ordered_indexes())
+        self.assertEqual(list(rewards), [3.0, 4.0, 5.0, 6.0, 7.0])
+        for k, i in enumerate(range(3, 8)):
+            state, action, reward, next_state, terminal = transition(i)
+            np.testing.assert_array_equal(states[k], state)
+            np.testing.assert_array_equal(next_states[k], next_state)
+            self.assertEqual((actions[k], terminals[k]), (action, terminal))
+
+    def test_update_last_reward(self):
+        memory = fill(ReplayMemory(capacity=5, n_dims=N_DIMS), 7)
+        memory.update_last_reward(-1.0)
+        self.assertEqual(memory.rewards[memory.last_index()], -1.0)
+        self.assertEqual(list(memory.get(memory.ordered_indexes())[2]), [2.0, 3.0, 4.0, 5.0, -1.0])
+
+    def test_sample(self):
+        memory = fill(ReplayMemory(capacity=50, n_dims=N_DIMS, seed=1), 20)
+        states, actions, rewards, next_states, terminals = memory.sample(10)
+        self.assertEqual(states.shape, (10, N_DIMS))
+        self.assertEqual(len(set(rewards)), 10)  # Without replacement
+        self.assertTrue(np.all(rewards < 20))
+
+        # Same seed, same samples
+        other = fill(ReplayMemory(capacity=50, n_dims=N_DIMS, seed=1), 20)
+        np.testing.assert_array_equal(other.sample(10)[2], rewards)
+
+    def test_save_and_load(self):
+        directory = tempfile.mkdtemp()
+        try:
+            filename = os.path.join(directory, "memory.npz")
+            fill(ReplayMemory(capacity=10, n_dims=N_DIMS), 13).save(filename)
+
+            memory = ReplayMemory(capacity=10, n_dims=N_DIMS)
+            memory.load(filename)
+            self.assertEqual(list(memory.get(memory.ordered_indexes())[2]), [float(i) for i in range(3, 13)])
+
+            # Just the newest transitions if they don't fit
+            memory = ReplayMemory(capacity=4, n_dims=N_DIMS)
+            memory.load(filename)
+            self.assertEqual(list(memory.get(memory.ordered_indexes())[2]), [9.0, 10.0, 11.0, 12.0])
+            memory.append(*transition(13))
+            self.assertEqual(list(memory.get(memory.ordered_indexes())[2]), [10.0, 11.0, 12.0, 13.0])
+        finally:
+            shutil.rmtree(directory)
+
+
+class TestSumTree(unittest.TestCase):
+    def test_total_follows_updates(self):
+        rng = np.random.default_rng(0)
+        for capacity in (1, 2, 7, 16, 100):
+            tree = SumTree(capacity)
+            priorities = np.zeros(capacity)
+            for _ in range(20):
+                indexes = rng.choice(capacity, size=min(capacity, 5), replace=False)
+                priorities[indexes] = rng.random(len(indexes))
+                tree.update(indexes, priorities[indexes])
+
+                self.assertAlmostEqual(tree.total(), priorities.sum())
+                np.testing.assert_allclose(tree.get(np.arange(capacity)), priorities)
+
+    def test_find(self):
+        tree = SumTree(5)
+        tree.update(np.arange(5), [1.0, 0.0, 2.0, 3.0, 4.0])
+
+        # Cumulative sums are [1, 1, 3, 6, 10], and leaves without priority are never found
+        values = [0.0, 0.5, 1.0, 2.9, 3.0, 5.9, 6.0, 9.99]
+        self.assertEqual(list(tree.find(values)), [0, 0, 2, 2, 3, 3, 4, 4])
+
+
+class TestPrioritizedReplayMemory(unittest.TestCase):
+    def test_new_transitions_get_max_priority(self):
+        memory = fill(PrioritizedReplayMemory(capacity=8, n_dims=N_DIMS, alpha=1.0, epsilon=0.0), 4)
+        memory.update_priorities([0, 1], [5.0, 0.5])
+        memory.append(*transition(4))
+        self.assertEqual(memory.tree.get([memory.last_index()])[0], 5.0)
+        self.assertAlmostEqual(memory.tree.total(), 5.0 + 0.5 + 1.0 + 1.0 + 5.0)
+
+    def test_sampling_frequency_follows_priority(self):
+        priorities = np.array([1.0, 2.0, 3.0, 4.0, 0.0, 10.0])
+        memory = fill(PrioritizedReplayMemory(capacity=len(priorities), n_dims=N_DIMS, alpha=1.0, epsilon=0.0,
+                                              seed=1), len(priorities))
+        memory.update_priorities(np.arange(len(priorities)), priorities)
+
+        counts = np.zeros(len(priorities))
+        for _ in range(500):
+            np.add.at(counts, memory.sample_indexes(40), 1)
+
+        np.testing.assert_allclose(counts / counts.sum(), priorities / priorities.sum(), atol=0.01)
+
+    def test_importance_sampling_weights(self):
+        memory = fill(PrioritizedReplayMemory(capacity=4, n_dims=N_DIMS, alpha=1.0, beta=0.5, epsilon=0.0,
+                                              seed=1), 4)
+        memory.update_priorities(np.arange(4), [1.0, 2.0, 4.0, 8.0])
+
+        batch, indexes, weights = memory.sample_prioritized(16)
+        self.assertEqual(len(batch[0]), 16)
+        self.assertAlmostEqual(weights.max(), 1.0)
+
+        # Less likely transitions get larger weights, to correct the bias of sampling them less
+        expected = (4 * memory.tree.get(indexes) / memory.tree.total()) ** -0.5
+        np.testing.assert_allclose(weights, expected / expected.max())
+        self.assertGreater(memory.beta, 0.5)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+
+"""Tests for the inbound queue of MQTT messages"""
+
+__author__ = 'leferrad'
+
+from tateti.util import metrics
+from tateti.util.mqtt import DROPPED, MessageQueue
+
+from collections import namedtuple
+import threading
+import time
+import unittest
+
+
+Message = namedtuple("Message", ["topic", "payload"])
+
+
+def fill(queue, topics):
+    return [queue.put(Message(topic, i)) for (i, topic) in enumerate(topics)]
+
+
+def drain(queue):
+    msgs = []
+    while True:
+        msg = queue.get()
+        if msg is None:
+            return msgs
+        msgs.append(msg)
+
+
+class TestMessageQueue(unittest.TestCase):
+    def test_drop_oldest(self):
+        queue = MessageQueue(max_size=3, policy=MessageQueue.DROP_OLDEST)
+        self.assertEqual(fill(queue, ["a"] * 5), [True] * 5)
+        self.assertEqual(queue.stats(), {"size": 3, "enqueued": 5, "dropped": 2})
+        self.assertEqual([m.payload for m in drain(queue)], [2, 3, 4])
+
+    def test_drop_newest(self):
+        queue = MessageQueue(max_size=3, policy=MessageQueue.DROP_NEWEST)
+        self.assertEqual(fill(queue, ["a"] * 5), [True] * 3 + [False] * 2)
+        self.assertEqual(queue.stats(), {"size": 3, "enqueued": 3, "dropped": 2})
+        self.assertEqual([m.payload for m in drain(queue)], [0, 1, 2])
+
+    def test_keep_latest(self):
+        queue = MessageQueue(max_size=3, policy=MessageQueue.KEEP_LATEST)
+        fill(queue, ["a", "b", "a", "c", "a", "b"])
+        self.assertEqual(queue.stats(), {"size": 3, "enqueued": 6, "dropped": 3})
+        self.assertEqual([(m.topic, m.payload) for m in drain(queue)], [("c", 3), ("a", 4), ("b", 5)])
+
+        # Still bounded when every message has its own topic
+        fill(queue, ["a", "b", "c", "d"])
+        self.assertEqual([m.topic for m in drain(queue)], ["b", "c", "d"])
+        self.assertEqual(queue.n_dropped, 4)
+
+    def test_block_times_out(self):
+        queue = MessageQueue(max_size=2, policy=MessageQueue.BLOCK, block_timeout=0.05)
+        start = time.time()
+        self.assertEqual(fill(queue, ["a"] * 3), [True, True, False])
+        self.assertGreaterEqual(time.time() - start, 0.05)
+        self.assertEqual(queue.stats(), {"size": 2, "enqueued": 2, "dropped": 1})
+
+    def test_block_waits_for_room(self):
+        queue = MessageQueue(max_size=2, policy=MessageQueue.BLOCK, block_timeout=5.0)
+        fill(queue, ["a"] * 2)
+
+        consumer = threading.Timer(0.05, queue.get)
+        consumer.start()
+        self.assertTrue(queue.put(Message("a", 2)))
+        consumer.join()
+
+        self.assertEqual(queue.stats(), {"size": 2, "enqueued": 3, "dropped": 0})
+        self.assertEqual([m.payload for m in drain(queue)], [1, 2])
+
+    def test_blocking_get(self):
+        queue = MessageQueue(max_size=2)
+        self.assertIsNone(queue.get(block=True, timeout=0.01))
+
+        threading.Timer(0.05, queue.put, args=(Message("a", 0),)).start()
+        self.assertEqual(queue.get(block=True, timeout=5.0).payload, 0)
+
+    def test_drops_are_counted_on_metrics(self):
+        metrics.enable()
+        try:
+            n_dropped = DROPPED.value
+            fill(MessageQueue(max_size=1, policy=MessageQueue.DROP_NEWEST), ["a"] * 4)
+            self.assertEqual(DROPPED.value - n_dropped, 3)
+        finally:
+            metrics.disable()
+
+
+if __name__ == '__main__':
+    unittest.main()
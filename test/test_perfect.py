@@ -0,0 +1,45 @@
+# -*- coding: utf-8 -*-
+
+"""Tests for the perfect play agent"""
+
+__author__ = 'leferrad'
+
+from tateti.agent.perfect import PerfectAgent
+from tateti.environment.tictactoe import Environment
+
+import numpy as np
+
+import unittest
+
+
+class TestPerfectAgent(unittest.TestCase):
+    def test_never_loses_against_random(self):
+        env, rng = Environment(seed=1), np.random.default_rng(3)
+        for sym in (Environment.SYMBOL_X, Environment.SYMBOL_O):
+            agent = PerfectAgent(env, sym=sym, seed=2)
+            for _ in range(50):
+                env.reset()
+                while not env.game_over():
+                    if env.turn == sym:
+                        action = agent.act(env.get_state(), env.get_env_string())
+                    else:
+                        moves = env.get_possible_moves()
+                        action = moves[rng.integers(len(moves))]
+                    env.take_action(env.turn, action)
+                self.assertIn(env.winner, (None, Environment.sym_repr[sym]))
+
+    def test_refuses_to_play_for_the_other_player(self):
+        env = Environment(seed=1)
+        env.turn = Environment.SYMBOL_X
+        env.take_action(Environment.SYMBOL_X, (1, 1))
+
+        # 'o' to move, so an agent of 'x' must not pick a move for it
+        agent = PerfectAgent(env, sym=Environment.SYMBOL_X)
+        self.assertRaises(ValueError, agent.act, env.get_state(), env.get_env_string(), explore=False)
+
+        agent = PerfectAgent(env, sym=Environment.SYMBOL_O)
+        self.assertTrue(env.is_legal(agent.act(env.get_state(), env.get_env_string(), explore=False)))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,58 @@
+# -*- coding: utf-8 -*-
+
+"""Tests for the management of many concurrent games"""
+
+__author__ = 'leferrad'
+
+from tateti.environment.session import SessionManager
+
+import unittest
+
+
+class TestSessionManager(unittest.TestCase):
+    def test_sessions_are_created_on_demand(self):
+        sessions = SessionManager(max_sessions=10)
+        session, created = sessions.get("a")
+        self.assertTrue(created)
+        self.assertEqual(session.game_id, "a")
+
+        same_session, created = sessions.get("a")
+        self.assertFalse(created)
+        self.assertIs(same_session, session)
+
+        self.assertEqual(sessions.get("b", create=False), (None, False))
+        self.assertEqual(len(sessions), 1)
+
+    def test_games_are_independent(self):
+        sessions = SessionManager(max_sessions=10)
+        env_a, env_b = sessions.get("a")[0].env, sessions.get("b")[0].env
+        env_a.take_action(env_a.turn, (1, 1))
+        self.assertNotEqual(env_a.get_env_string(), env_b.get_env_string())
+
+    def test_least_recently_active_is_evicted_when_full(self):
+        sessions = SessionManager(max_sessions=3)
+        for game_id in ("a", "b", "c"):
+            sessions.get(game_id)
+        sessions.get("a")  # Now 'b' is the least recently active
+        sessions.get("d")
+
+        self.assertEqual(len(sessions), 3)
+        self.assertNotIn("b", sessions)
+        for game_id in ("a", "c", "d"):
+            self.assertIn(game_id, sessions)
+        self.assertEqual((sessions.n_created, sessions.n_evicted), (4, 1))
+
+    def test_idle_sessions_are_evicted(self):
+        sessions = SessionManager(max_sessions=10, idle_timeout=60.0)
+        for game_id, last_active in (("a", 0.0), ("b", 70.0), ("c", 100.0)):
+            sessions.get(game_id)[0].last_active = last_active
+
+        self.assertEqual(sessions.evict_idle(now=120.0), 1)
+        self.assertEqual([s.game_id for s in sessions], ["b", "c"])
+        self.assertEqual(sessions.evict_idle(now=200.0), 2)
+        self.assertEqual(len(sessions), 0)
+        self.assertEqual(sessions.n_evicted, 3)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,58 @@
+# -*- coding: utf-8 -*-
+
+"""Tests for the vectorized environment, against a plain implementation of the rules of the game"""
+
+__author__ = 'leferrad'
+
+from tateti.environment.tictactoe import Environment
+from tateti.environment.vector import VectorEnvironment
+
+import numpy as np
+
+from test_environment import ReferenceEnvironment
+
+import unittest
+
+
+class TestVectorEnvironment(unittest.TestCase):
+    def test_random_games_match_reference(self):
+        rng = np.random.default_rng(0)
+        for board_length, win_length in ((3, 3), (4, 3), (5, 4)):
+            venv = VectorEnvironment(n_envs=8, seed=1, board_length=board_length, win_length=win_length)
+            refs = [ReferenceEnvironment(board_length, win_length, turn=t) for t in venv.turns]
+            actions_index = {a: k for (k, a) in enumerate(venv.available_actions)}
+            n_finished = 0
+
+            for _ in range(60):
+                np.testing.assert_array_equal(venv.get_states(), [ref.get_state() for ref in refs])
+                self.assertEqual(venv.get_env_strings(), [ref.get_env_string() for ref in refs])
+                self.assertEqual(list(venv.turns), [ref.turn for ref in refs])
+                masks = venv.get_action_masks()
+                for mask, ref in zip(masks, refs):
+                    self.assertEqual([venv.available_actions[k] for k in np.flatnonzero(mask)],
+                                     ref.get_possible_moves())
+
+                moves = [ref.get_possible_moves() for ref in refs]
+                actions = [m[rng.integers(len(m))] for m in moves]
+                next_states, rewards, dones, turns = venv.take_action([actions_index[a] for a in actions])
+
+                for slot, (ref, action) in enumerate(zip(refs, actions)):
+                    state, reward, done, _ = ref.take_action(ref.turn, action)
+                    self.assertEqual(list(next_states[slot]), state)
+                    self.assertEqual((rewards[slot], dones[slot]), (reward, done))
+                    self.assertEqual(venv.get_winners(next_states[slot:slot + 1])[0],
+                                     Environment.SYMBOL_EMPTY if ref.winner is None else ref.winner)
+
+                    if done:
+                        # Finished boards are reset, with a new first player
+                        self.assertEqual(venv.last_winners[slot],
+                                         Environment.SYMBOL_EMPTY if ref.winner is None else ref.winner)
+                        refs[slot] = ReferenceEnvironment(board_length, win_length, turn=turns[slot])
+                        n_finished += 1
+
+            self.assertGreater(n_finished, 0)
+            self.assertEqual(sum(venv.score.values()), n_finished)
+
+
+if __name__ == '__main__':
+    unittest.main()